@@ -28,10 +28,15 @@ from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.output_parsers import StrOutputParser
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
+from embedding_cache import CachedEmbeddings
+from token_stream import render_frames
+from context_builder import CONTEXT_FETCH_K, assemble_context
+from history_store import history_getter
+from history_window import windowed_history_getter
+from vector_wal import open_wal_store
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader, UnstructuredPowerPointLoader, UnstructuredHTMLLoader, UnstructuredCSVLoader,UnstructuredMarkdownLoader, UnstructuredImageLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import docx2txt
-import time
 from langchain.schema import Document
 st.set_page_config(page_title="Agent ", layout="wide")
 st.title("📚 RAG Agent(支持 PDF / DOCX / TXT / DOC上传与问答)")
@@ -39,8 +44,6 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
-if "session_store" not in st.session_state:
-    st.session_state.session_store = {}
 # Load environment variables
 load_dotenv()
 if not os.getenv("DEEPSEEK_API_KEY"):
@@ -52,7 +55,7 @@ VECTOR_DB_PATH = "./vector_db"
 os.makedirs(DATA_DIR, exist_ok=True)
 
 # --- 初始化 Embedding 和 Text Splitter ---
-embedder = OllamaEmbeddings(model="nomic-embed-text")
+embedder = CachedEmbeddings(OllamaEmbeddings(model="nomic-embed-text"))
 text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
 
 # --- 初始化 LLM ---
@@ -85,13 +88,9 @@ prompt = ChatPromptTemplate.from_messages([
 # Basic chain without history
 base_chain = prompt | llm | parser
 
-# Session store for maintaining conversation history
-
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    """Retrieve or create chat history for a given session ID"""
-    if session_id not in st.session_state.session_store:
-        st.session_state.session_store[session_id] = ChatMessageHistory()
-    return st.session_state.session_store[session_id]
+# Session store for maintaining conversation history (Redis or sqlite, with TTL and message cap)
+# Only the recent turns within HISTORY_TOKEN_BUDGET go into the prompt; older turns are summarized in the background
+get_session_history = windowed_history_getter(history_getter(), llm=llm)
 
 # Chain enhanced with message history capability
 chat_chain = RunnableWithMessageHistory(
@@ -108,22 +107,17 @@ class VectorDBManager:
 
     def load_db(self):
         """加载现有的向量数据库"""
-        if os.path.exists(self.db_path):
-            try:
-                # 向量库加载到内存中
-                self.vector_db = FAISS.load_local(
-                    self.db_path,
-                    embedder,
-                    allow_dangerous_deserialization=True
-                )
+        try:
+            # 向量库加载到内存中，并回放 WAL 里还没合并的写入(进程内只加载一次)
+            self.store = open_wal_store(self.db_path, embedder)
+            self.vector_db = self.store.vector_db
+            if self.vector_db is not None:
                 st.info("✅ 已加载现有向量数据库")
                 print("✅ 已加载现有向量数据库")
-                # 向量库保存到文件里
-                self.save_db()
-            except Exception as e:
-                st.warning(f"⚠️ 向量数据库为空: {e}")
-                print(f"⚠️ 向量数据库为空: {e}")
-                self.vector_db = None
+        except Exception as e:
+            st.warning(f"⚠️ 向量数据库为空: {e}")
+            print(f"⚠️ 向量数据库为空: {e}")
+            self.vector_db = None
 
     def process_uploaded_file(self, file: UploadFile) -> Document:
         """加载上传的文件到并返回文档块"""
@@ -169,20 +163,14 @@ class VectorDBManager:
             raise
 
     def add_documents(self, documents: List[Document]):
-        """向向量数据库添加新文档"""
-        if self.vector_db is None:
-            self.vector_db = FAISS.from_documents(
-                documents=documents,
-                embedding=embedder
-            )
-        else:
-            self.vector_db.add_documents(documents)
-        self.save_db()
+        """向向量数据库添加新文档(写 WAL，后台线程负责合并进主索引)"""
+        self.store.add_documents(documents)
+        self.vector_db = self.store.vector_db
 
     def save_db(self):
-        """保存向量数据库"""
+        """立即把 WAL 合并进主索引并保存"""
         if self.vector_db:
-            self.vector_db.save_local(VECTOR_DB_PATH)
+            self.store.compact()
             st.info(f"✅ 向量数据库已保存{VECTOR_DB_PATH}")
             print(f"✅ 向量数据库已保存{VECTOR_DB_PATH}")
     def similarity_search(self, query: str, k: int = 3):
@@ -227,7 +215,7 @@ with st.sidebar:
 
     if st.button("🧹 清空聊天历史"):
         st.session_state.messages = []
-        st.session_state.session_store = {}
+        get_session_history(st.session_state.session_id).clear()
         st.rerun()
     st.markdown(f"**向量数据库中文档块数量:** {vector_db_manager.doc_count()}")
 
@@ -243,8 +231,9 @@ if prompt := st.chat_input("请输入你的问题..."):
         st.markdown(prompt)
 
     # 从向量库搜索相关文档
-    docs = vector_db_manager.similarity_search(prompt, k=3)
-    context = "\n\n".join([doc.page_content for doc in docs])
+    docs = vector_db_manager.similarity_search(prompt, k=CONTEXT_FETCH_K)
+    # 合并相邻块、去重，按相关度填满 token 预算
+    context, context_stats = assemble_context(docs)
     # 生成回答
     response = chat_chain.stream(
         input = {
@@ -256,10 +245,12 @@ if prompt := st.chat_input("请输入你的问题..."):
     with st.chat_message("assistant"):
         placeholder = st.empty()
         response_text = ""
-        for chunk in response:
-            response_text += chunk
+        # 分片一到就接收，只按 UI_RENDER_INTERVAL 限制重绘频率
+        for response_text in render_frames(response):
             placeholder.markdown(response_text + "▌")
-            time.sleep(0.02)
         placeholder.markdown(response_text)
+        st.caption(f"上下文 {context_stats['context_tokens']} tokens"
+                   f"(合并 {context_stats['merged']} 块，去重 {context_stats['duplicates']} 段，"
+                   f"节省 {context_stats['saved_tokens']} tokens)")
 
     st.session_state.messages.append({"role": "assistant", "content": response_text})
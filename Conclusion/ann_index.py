@@ -0,0 +1,308 @@
+# ann_index.py
+# 近似最近邻索引: Flat / IVF-Flat / HNSW / IVF-PQ 的构建、训练、参数调节和召回率评估。
+# 直接替换 langchain FAISS 对象的 .index，index_to_docstore_id 的位置映射保持不变
+import sys
+import math
+import time
+from typing import Optional
+
+import numpy as np
+import faiss
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+
+# auto 模式下的分界点(向量条数)
+FLAT_MAX = 50_000
+HNSW_MAX = 1_000_000
+# 元数据过滤后剩下的向量不超过这么多条时做精确检索: 选择性很高时 ANN 的候选里几乎没有符合条件的，凑不满 k 条
+FILTER_EXACT_MAX = 20_000
+
+
+def choose_index_type(ntotal: int) -> str:
+    """按向量条数自动选择索引类型"""
+    if ntotal < FLAT_MAX:
+        return "flat"
+    if ntotal < HNSW_MAX:
+        return "hnsw"
+    return "ivf_pq"
+
+
+def describe_index(index) -> str:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexFlat):
+        return "flat"
+    return type(index).__name__
+
+
+def is_lossy(index) -> bool:
+    """IVF-PQ 存的是量化后的编码，取出的向量只是近似值"""
+    return describe_index(index) == "ivf_pq"
+
+
+def get_vectors(index) -> np.ndarray:
+    """取出索引里的全部向量(IVF-PQ 取出的是量化后的近似值)"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def writable_copy(index):
+    """
+    复制一份可以修改的内存索引。mmap 打开的 IVF 倒排表是 OnDiskInvertedLists，clone_index 不支持:
+    先复制不带倒排表数据的索引(量化器、PQ 码本等)，再把各个倒排表的编号和编码读进内存
+    """
+    try:
+        return faiss.clone_index(index)
+    except RuntimeError:
+        typed = faiss.downcast_index(index)
+        if not isinstance(typed, faiss.IndexIVF):
+            raise
+    copy = faiss.deserialize_index(faiss.serialize_index(index), faiss.IO_FLAG_SKIP_IVF_DATA)
+    invlists = faiss.ArrayInvertedLists(typed.nlist, typed.code_size)
+    for list_no in range(typed.nlist):
+        size = typed.invlists.list_size(list_no)
+        if size:
+            invlists.add_entries(list_no, size, typed.invlists.get_ids(list_no), typed.invlists.get_codes(list_no))
+    faiss.downcast_index(copy).replace_invlists(invlists, True)
+    invlists.this.disown()
+    return copy
+
+
+def remove_positions(index, positions):
+    """
+    删除这些位置的向量，后面的位置依次前移(和 FAISS.delete 重新编号 index_to_docstore_id 的方式一致)，
+    返回删除后的索引。index 必须是可写的内存副本
+    - Flat: remove_ids 本身就是压缩位置，原地删除
+    - IVF: remove_ids 只删倒排表里的条目、编号不变，再逐个倒排表把编号减去它前面被删掉的个数；
+      编码原样保留，不重新训练，IVF-PQ 也不会再叠加一次量化误差
+    - HNSW: 图里不能删点，用底层 Flat 存储里的原始向量(不是近似值)重新建图，返回新索引
+    """
+    removed = np.unique(np.asarray(list(positions), dtype=np.int64))
+    if not len(removed):
+        return index
+    # downcast 得到的对象不持有索引，index 本身要一直引用着
+    typed = faiss.downcast_index(index)
+    if isinstance(typed, faiss.IndexHNSW):
+        kept = np.delete(faiss.downcast_index(typed.storage).reconstruct_n(0, typed.ntotal), removed, axis=0)
+        rebuilt = build_index(kept, "hnsw", metric=typed.metric_type, hnsw_m=typed.hnsw.nb_neighbors(1))
+        rebuilt.hnsw.efSearch = typed.hnsw.efSearch
+        return rebuilt
+    if isinstance(typed, faiss.IndexIVF):
+        # 数组型 direct map 不支持 remove_ids，get_vectors 需要时会重建
+        typed.set_direct_map_type(faiss.DirectMap.NoMap)
+    typed.remove_ids(faiss.IDSelectorBatch(removed))
+    if isinstance(typed, faiss.IndexIVF):
+        invlists = typed.invlists
+        for list_no in range(typed.nlist):
+            size = invlists.list_size(list_no)
+            if size:
+                ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), size)
+                ids -= np.searchsorted(removed, ids)
+    return index
+
+
+def _nlist_for(n: int) -> int:
+    # 经验值 4*sqrt(n)，同时保证每个聚类中心至少有 39 个训练样本
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+
+def _pq_m_for(d: int) -> int:
+    # 每个子量化器约 8 维，且必须整除 d
+    m = max(1, d // 8)
+    while d % m:
+        m -= 1
+    return m
+
+
+def build_index(vectors: np.ndarray, index_type: str, metric: int = faiss.METRIC_L2,
+                nlist: Optional[int] = None, hnsw_m: int = 32, pq_m: Optional[int] = None,
+                train_size: int = 100_000, seed: int = 0):
+    """用给定向量构建指定类型的索引，需要训练的索引只用随机抽样的 train_size 条训练"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(d) if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(d)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m, metric)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = nlist or _nlist_for(n)
+        quantizer = faiss.IndexFlatIP(d) if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(d)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, metric)
+        else:
+            # PQ 每个子空间 256 个中心，样本太少时降低码本位数
+            nbits = 8 if n >= 256 * 39 else max(1, int(math.log2(max(2, n // 39))))
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m or _pq_m_for(d), nbits, metric)
+        rng = np.random.default_rng(seed)
+        sample = vectors if n <= train_size else vectors[rng.choice(n, train_size, replace=False)]
+        index.train(sample)
+    else:
+        raise ValueError(f"不支持的索引类型: {index_type}, 可选: {INDEX_TYPES}")
+    if n:
+        index.add(vectors)
+    return index
+
+
+def index_bytes(index) -> int:
+    """索引数据大约占用的字节数(向量编码 + HNSW 邻接表)，用于按内存预算卸载索引"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return index_bytes(index.storage) + index.hnsw.neighbors.size() * 4
+    try:
+        code_size = index.sa_code_size()
+    except RuntimeError:
+        code_size = index.d * 4
+    return index.ntotal * code_size
+
+
+def set_search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """调节查询参数: IVF 的 nprobe、HNSW 的 efSearch"""
+    index = faiss.downcast_index(index)
+    if nprobe is not None and isinstance(index, faiss.IndexIVF):
+        index.nprobe = nprobe
+    if ef_search is not None and isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+
+
+def search_params(index, selector=None, selected: Optional[int] = None):
+    """
+    单次检索的参数: 带上 IDSelector(只在选中的向量里搜)，同时沿用索引当前的 nprobe/efSearch，
+    否则传了 params 之后这两个参数会回到默认值。
+    selected 是选中的向量条数: 只选中 1/s 的向量时，同样的探查范围里符合条件的候选也只剩 1/s，
+    nprobe/efSearch 按 ntotal/selected 放大(nprobe 最多到 nlist)
+    """
+    index = faiss.downcast_index(index)
+    scale = index.ntotal / selected if selected else 1.0
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=min(index.nlist, math.ceil(index.nprobe * scale)))
+    if isinstance(index, faiss.IndexHNSW):
+        ef = index.hnsw.efSearch
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=max(ef, min(math.ceil(ef * scale), selected or ef)))
+    return faiss.SearchParameters(sel=selector)
+
+
+def filtered_search(index, queries: np.ndarray, k: int, selector=None, selected: Optional[int] = None):
+    """
+    只在 selector 选中的向量里检索，返回和 index.search 一样的 (距离, 位置)。
+    选中的不超过 FILTER_EXACT_MAX 条时精确检索: Flat 本来就是；HNSW 改在它底下的 Flat 存储上带 IDSelector 搜；
+    IVF 探查全部聚类。选中的更多时按选中比例放大 nprobe/efSearch(见 search_params)
+    """
+    if selector is None:
+        return index.search(queries, k)
+    index = faiss.downcast_index(index)
+    if selected is not None and selected <= FILTER_EXACT_MAX:
+        if isinstance(index, faiss.IndexHNSW):
+            return index.storage.search(queries, k, params=faiss.SearchParameters(sel=selector))
+        if isinstance(index, faiss.IndexIVF):
+            return index.search(queries, k, params=faiss.SearchParametersIVF(sel=selector, nprobe=index.nlist))
+    return index.search(queries, k, params=search_params(index, selector, selected))
+
+
+def convert_index(index, index_type: str, **kwargs):
+    """把现有索引转换成另一种类型，向量顺序不变"""
+    return build_index(get_vectors(index), index_type, metric=index.metric_type, **kwargs)
+
+
+def _overlap(truth: np.ndarray, found: np.ndarray) -> float:
+    hits = sum(len(set(t[t >= 0]) & set(f[f >= 0])) for t, f in zip(truth, found))
+    total = sum(len(t[t >= 0]) for t in truth)
+    return hits / total if total else 1.0
+
+
+def recall_at_k(index, flat_index, queries: np.ndarray, k: int = 10) -> float:
+    """以 Flat 精确检索结果为基准计算 recall@k"""
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    _, truth = flat_index.search(queries, k)
+    _, found = index.search(queries, k)
+    return _overlap(truth, found)
+
+
+def _sample_vectors(index, count: int, rng) -> np.ndarray:
+    """
+    随机取出 count 条库里的向量，不改动索引(IVF 不建 direct map，按倒排表里的偏移读取)。
+    IVF-PQ 取出的是量化后的近似值，用作查询没有问题
+    """
+    if isinstance(index, faiss.IndexIVF):
+        sizes = np.array([index.invlists.list_size(l) for l in range(index.nlist)], dtype=np.int64)
+        ends = np.cumsum(sizes)
+        picks = rng.choice(int(ends[-1]), count, replace=False)
+        lists = np.searchsorted(ends, picks, side="right")
+        offsets = picks - (ends[lists] - sizes[lists])
+        sample = np.empty((count, index.d), dtype=np.float32)
+        for row, (list_no, offset) in enumerate(zip(lists, offsets)):
+            index.reconstruct_from_offset(int(list_no), int(offset), faiss.swig_ptr(sample[row]))
+        return sample
+    return np.stack([index.reconstruct(int(i)) for i in rng.choice(index.ntotal, count, replace=False)])
+
+
+def _exact_search(index, queries: np.ndarray, k: int):
+    """
+    不复制向量的精确检索基准: Flat 就是它自己；HNSW 搜它底下存原始向量的 Flat 存储；
+    IVF-Flat 探查全部聚类。IVF-PQ 只有量化编码，没有精确基准，返回 None
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.downcast_index(index.storage).search(queries, k)[1]
+    if isinstance(index, faiss.IndexIVFPQ):
+        return None
+    if isinstance(index, faiss.IndexIVF):
+        return index.search(queries, k, params=faiss.SearchParametersIVF(nprobe=index.nlist))[1]
+    return index.search(queries, k)[1]
+
+
+def evaluate(index, k: int = 10, num_queries: int = 100, seed: int = 0,
+             vectors: Optional[np.ndarray] = None) -> dict:
+    """
+    随机抽取库里的 num_queries 条向量(加一点噪声)作为查询，报告 recall@k 和平均查询耗时。
+    只读取抽到的那几条向量，基准用 _exact_search 在索引自身上算，不复制整个库。
+    vectors 是入库时的原始向量(和索引同顺序)，给出时以它建 Flat 作基准(IVF-PQ 也能算召回率)；
+    IVF-PQ 没给 vectors 时只报告耗时，recall 记为 None
+    """
+    index = faiss.downcast_index(index)  # 调用方持有原对象
+    if index.ntotal == 0:
+        return {"type": describe_index(index), "ntotal": 0}
+    rng = np.random.default_rng(seed)
+    count = min(num_queries, index.ntotal)
+    if vectors is not None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        sample = vectors[rng.choice(len(vectors), count, replace=False)]
+    else:
+        sample = _sample_vectors(index, count, rng)
+    queries = (sample + rng.normal(0, 0.01, sample.shape)).astype(np.float32)
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    elapsed = time.perf_counter() - start
+    if vectors is not None:
+        truth = build_index(vectors, "flat", metric=index.metric_type).search(queries, k)[1]
+    else:
+        truth = _exact_search(index, queries, k)
+    return {
+        "type": describe_index(index),
+        "ntotal": index.ntotal,
+        f"recall@{k}": round(_overlap(truth, found), 4) if truth is not None else None,
+        "ms_per_query": round(elapsed * 1000 / len(queries), 3),
+    }
+
+
+if __name__ == "__main__":
+    # python ann_index.py bench [向量条数] [维度]: 用随机数据对比各种索引的速度和召回率
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+        d = int(sys.argv[3]) if len(sys.argv) > 3 else 128
+        data = np.random.default_rng(0).standard_normal((n, d)).astype(np.float32)
+        for index_type in INDEX_TYPES:
+            start = time.perf_counter()
+            index = build_index(data, index_type)
+            build_s = time.perf_counter() - start
+            set_search_params(index, nprobe=16, ef_search=64)
+            print(f"{index_type:9s} build={build_s:.2f}s {evaluate(index, vectors=data)}")
+    else:
+        print("用法: python ann_index.py bench [向量条数] [维度]")
@@ -0,0 +1,164 @@
+# answer_cache.py
+# 问答结果缓存，两级:
+#   1. 精确缓存: 归一化后的问题 + 检索到的文档块 id，完全一致才命中
+#   2. 语义缓存: 问题向量的余弦相似度超过阈值就命中(同一个问题的不同问法)
+# 带 TTL 和 LRU 淘汰；向量库一变(版本号变化)整个缓存失效。
+# 缓存的是模型流式输出的分片列表，命中时按原来的分片重新流式返回，客户端看不出区别
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+import numpy as np
+
+_PUNCT_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_question(question: str) -> str:
+    """全角转半角、小写、去掉空白和标点: "产品型号是什么？" 和 "产品型号是什么" 视为同一个问题"""
+    return _PUNCT_RE.sub("", unicodedata.normalize("NFKC", question).lower())
+
+
+def exact_key(question: str, chunk_ids: List[str], scope: str = "") -> str:
+    raw = scope + "\x00" + normalize_question(question) + "\x00" + "\x00".join(chunk_ids)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def history_fingerprint(messages) -> str:
+    """对话历史(送进 prompt 的窗口)的指纹: 回答依赖上文时，上文不同的会话不能共用缓存"""
+    raw = "\x00".join(f"{m.type}:{m.content}" for m in messages)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def doc_ids(docs) -> List[str]:
+    """检索结果的文档块 id；没有 id 的用正文哈希代替"""
+    return [doc.id or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest() for doc in docs]
+
+
+@dataclass
+class _Entry:
+    chunks: List[str]
+    vector: Optional[np.ndarray]
+    scope: str = ""
+    created: float = field(default_factory=time.monotonic)
+
+
+class AnswerCache:
+    """
+    用法:
+        cache = AnswerCache(embedder, version=lambda: vector_db_manager.version)
+        vector = cache.embed(question)                       # 问题向量只算一次
+        chunks = cache.get(question, chunk_ids, vector)      # 未命中返回 None
+        cache.put(question, chunk_ids, chunks, vector)       # 生成完整回答后写入
+        cache.invalidate(scope_prefix)                       # 索引发布新版本时清掉旧条目
+    scope 区分检索范围(例如元数据过滤条件): 语义缓存只在同一个 scope 里匹配
+    """
+
+    def __init__(self, embedder=None, max_entries: int = 1000, ttl: float = 3600.0,
+                 threshold: float = 0.95, version: Optional[Callable[[], object]] = None):
+        self.embedder = embedder  # 为 None 时只用精确缓存
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.version = version
+        self.entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.lock = threading.Lock()
+        self._version = version() if version else None
+        self.hits = {"exact": 0, "semantic": 0}
+        self.misses = 0
+
+    def _check_version(self):
+        if self.version is None:
+            return
+        current = self.version()
+        if current != self._version:
+            self.entries.clear()
+            self._version = current
+
+    def _expired(self, entry: _Entry) -> bool:
+        return time.monotonic() - entry.created > self.ttl
+
+    @staticmethod
+    def normalize(embedding) -> np.ndarray:
+        """已经算好的问题向量(例如检索时算的)直接归一化后使用，不再请求一次 embedding"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed(self, question: str) -> Optional[np.ndarray]:
+        if self.embedder is None:
+            return None
+        return self.normalize(self.embedder.embed_query(question))
+
+    def get(self, question: str, chunk_ids: List[str], vector: Optional[np.ndarray] = None,
+            scope: str = "") -> Optional[List[str]]:
+        key = exact_key(question, chunk_ids, scope)
+        with self.lock:
+            self._check_version()
+            entry = self.entries.get(key)
+            if entry is not None and not self._expired(entry):
+                self.entries.move_to_end(key)
+                self.hits["exact"] += 1
+                return entry.chunks
+            if entry is not None:
+                del self.entries[key]
+        if self.embedder is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        if vector is None:
+            vector = self.embed(question)
+        with self.lock:
+            candidates = [(k, e) for k, e in self.entries.items() if e.vector is not None and e.scope == scope]
+            best_key, best_score = None, -1.0
+            if candidates:
+                matrix = np.stack([e.vector for _, e in candidates])
+                scores = matrix @ vector
+                i = int(np.argmax(scores))
+                best_key, best_score = candidates[i][0], float(scores[i])
+            if best_key is not None and best_score >= self.threshold:
+                entry = self.entries[best_key]
+                if not self._expired(entry):
+                    self.entries.move_to_end(best_key)
+                    self.hits["semantic"] += 1
+                    return entry.chunks
+                del self.entries[best_key]
+            self.misses += 1
+        return None
+
+    def put(self, question: str, chunk_ids: List[str], chunks: List[str], vector: Optional[np.ndarray] = None,
+            scope: str = ""):
+        if not chunks:
+            return
+        if vector is None:
+            vector = self.embed(question)
+        key = exact_key(question, chunk_ids, scope)
+        with self.lock:
+            self._check_version()
+            self.entries[key] = _Entry(list(chunks), vector, scope)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, scope_prefix: Optional[str] = None) -> int:
+        """
+        删掉 scope 以 scope_prefix 开头的条目(不给时清空)，返回删除条数。
+        一个命名空间发布了新的索引版本后，它旧版本下的条目不会再命中，直接腾出位置
+        """
+        with self.lock:
+            if scope_prefix is None:
+                removed = len(self.entries)
+                self.entries.clear()
+                return removed
+            stale = [k for k, e in self.entries.items() if e.scope.startswith(scope_prefix)]
+            for key in stale:
+                del self.entries[key]
+            return len(stale)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": dict(self.hits), "misses": self.misses}
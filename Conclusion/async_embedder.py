@@ -0,0 +1,187 @@
+# async_embedder.py
+# 异步批量 embedding: 文本块按批发送到 Ollama /api/embed，连接池复用 HTTP 连接，
+# 并发数有上限(背压)，失败自动重试，每完成一批就把结果交给调用方写入索引
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from typing import AsyncIterator, List, Optional, Tuple
+
+import httpx
+
+from embedding_cache import EmbeddingCache, text_key
+
+OLLAMA_BASE_URL = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+
+
+class AsyncBatchEmbedder:
+    """
+    用法:
+        async for start, vectors in async_embedder.embed_batches(texts):
+            # texts[start:start + len(vectors)] 对应的向量
+    批次按完成顺序返回，不保证和输入顺序一致
+    """
+
+    def __init__(self, model: str = "nomic-embed-text", base_url: str = OLLAMA_BASE_URL,
+                 batch_size: int = 32, concurrency: int = 4, max_retries: int = 3,
+                 backoff: float = 0.5, timeout: float = 120.0,
+                 cache: Optional[EmbeddingCache] = None):
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.last_stats = {}
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # 连接池只在当前事件循环里创建一次，后续请求复用 keep-alive 连接
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency),
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post_batch(self, texts: List[str]) -> List[List[float]]:
+        client = self._get_client()
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = await client.post("/api/embed", json={"model": self.model, "input": texts})
+                resp.raise_for_status()
+                return resp.json()["embeddings"]
+            except (httpx.HTTPError, KeyError, ValueError) as e:
+                if attempt == self.max_retries:
+                    raise RuntimeError(f"embedding 请求失败(已重试 {self.max_retries} 次): {e}") from e
+                await asyncio.sleep(self.backoff * (2 ** attempt))
+
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """先查缓存，只把未命中的文本发给服务端"""
+        if self.cache is None:
+            return await self._post_batch(texts)
+        keys = [text_key(self.model, t) for t in texts]
+        cached = self.cache.get_many(keys)
+        missing = [i for i, vec in enumerate(cached) if vec is None]
+        vectors = [list(map(float, vec)) if vec is not None else None for vec in cached]
+        if missing:
+            fresh = await self._post_batch([texts[i] for i in missing])
+            self.cache.put_many([keys[i] for i in missing], fresh)
+            for i, vec in zip(missing, fresh):
+                vectors[i] = vec
+        return vectors
+
+    async def embed_batches(self, texts: List[str]) -> AsyncIterator[Tuple[int, List[List[float]]]]:
+        starts = list(range(0, len(texts), self.batch_size))
+        pending: asyncio.Queue = asyncio.Queue()
+        done: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        for start in starts:
+            pending.put_nowait(start)
+
+        async def worker():
+            while True:
+                try:
+                    start = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    vectors = await self._embed_batch(texts[start:start + self.batch_size])
+                    # done 队列满了说明下游写索引跟不上，worker 在这里等待，不再继续请求
+                    await done.put((start, vectors, None))
+                except Exception as e:
+                    await done.put((start, None, e))
+                    return
+
+        begin = time.perf_counter()
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, len(starts)))]
+        try:
+            for _ in starts:
+                start, vectors, error = await done.get()
+                if error is not None:
+                    raise error
+                yield start, vectors
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            elapsed = time.perf_counter() - begin
+            self.last_stats = {
+                "chunks": len(texts),
+                "batches": len(starts),
+                "seconds": round(elapsed, 3),
+                "chunks_per_sec": round(len(texts) / elapsed, 1) if elapsed > 0 else 0.0,
+            }
+
+    async def embed_query(self, text: str) -> List[float]:
+        """单条查询直接请求，不走批次队列和磁盘缓存(查询向量由调用方的 LRU 缓存)"""
+        return (await self._post_batch([text]))[0]
+
+    async def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """一次性返回全部向量(按输入顺序)"""
+        result: List[Optional[List[float]]] = [None] * len(texts)
+        async for start, vectors in self.embed_batches(texts):
+            result[start:start + len(vectors)] = vectors
+        return result
+
+
+# ---------- 本地替身服务，用于压测和调试，不需要真的启动 Ollama ----------
+
+def start_fake_embedding_server(port: int = 0, dim: int = 768, latency: float = 0.01):
+    """启动一个兼容 /api/embed 的本地 HTTP 服务，返回 (server, base_url)"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import hashlib
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(latency)
+            vectors = []
+            for text in body["input"]:
+                seed = hashlib.sha256(text.encode("utf-8")).digest()
+                vectors.append([seed[i % len(seed)] / 255.0 for i in range(dim)])
+            payload = json.dumps({"model": body["model"], "embeddings": vectors}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+async def _bench(chunks: int, batch_size: int, concurrency: int):
+    server, base_url = start_fake_embedding_server()
+    embedder = AsyncBatchEmbedder(base_url=base_url, batch_size=batch_size, concurrency=concurrency)
+    try:
+        texts = [f"chunk {i} " * 20 for i in range(chunks)]
+        vectors = await embedder.embed_documents(texts)
+        assert len(vectors) == chunks and all(v is not None for v in vectors)
+        print(f"✅ {embedder.last_stats}")
+    finally:
+        await embedder.aclose()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    # python async_embedder.py bench [chunks] [batch_size] [concurrency]
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        args = [int(a) for a in sys.argv[2:5]]
+        asyncio.run(_bench(*(args + [2000, 32, 4][len(args):])))
+    else:
+        print("用法: python async_embedder.py bench [chunks] [batch_size] [concurrency]")
@@ -1,93 +1,84 @@
-from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader, Docx2txtLoader, TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
-from typing import List, Union
+from embedding_cache import CachedEmbeddings
+from parallel_loader import DEFAULT_LOADERS
+from ingest_pipeline import StreamingIngestor, iter_parallel_documents
+from mmap_store import get_chunk_store, save_vector_store
+from metadata_index import MetadataIndex, ingest_metadata
+from hybrid_retriever import batch_dense_search
 import os
 
-def loader_documents(folder_path: str) -> List[Union[str, Exception]]:
-    """
-    Load documents from a directory with support for multiple file formats (PDF, DOCX, TXT).
-
-    Args:
-        folder_path (str): Path to the directory containing documents
-
-    Returns:
-        List of loaded documents or error messages
-    """
-    # Define loaders for different file extensions
-    loaders = {
-        '.pdf': PyPDFLoader,    # Handles PDF files
-        '.docx': Docx2txtLoader, # Handles Word documents
-        '.txt': TextLoader      # Handles plain text files
-    }
-
-    documents = []
-
-    # Recursively walk through the directory
-    for root, _, files in os.walk(folder_path):
+def main():
+    # Collect supported files (PDF, DOCX, TXT); they are parsed in worker processes below
+    file_paths = []
+    for root, _, files in os.walk("./data/"):  # Replace with your actual path
         for file in files:
-            ext = os.path.splitext(file)[1].lower()  # Get file extension
-
-            if ext in loaders:
-                file_path = os.path.join(root, file)
-                try:
-                    # Initialize appropriate loader for the file type
-                    loader = loaders[ext](file_path)
-                    # Load and add documents to the list
-                    documents.extend(loader.load())
-                    print(f"Successfully loaded: {file_path}")  # Log successful loads
-                except Exception as e:
-                    print(f"Error loading {file_path}: {e}")
-                    continue  # Skip to next file if error occurs
+            if os.path.splitext(file)[1].lower() in DEFAULT_LOADERS:
+                file_paths.append(os.path.join(root, file))
 
-    return documents
+    # Initialize text splitter with optimal parameters for semantic search
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=500,      # Size of each text chunk (in characters)
+        chunk_overlap=50,    # Overlap between chunks for context preservation
+        length_function=len, # Function to calculate text length
+        is_separator_regex=False  # Whether separators are regular expressions
+    )
 
-# Load documents from directory
-docs = loader_documents("./data/")  # Replace with your actual path
+    # Initialize Ollama Embedding model, wrapped in the shared on-disk cache
+    # so rebuilding an unchanged corpus makes no embedding calls
+    embedder = CachedEmbeddings(OllamaEmbeddings(
+        model="nomic-embed-text",  # Alternative: "deepseek-r1"
+        temperature=0.1,           # Control randomness (0-1)
+    ))
 
-# Initialize text splitter with optimal parameters for semantic search
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=500,      # Size of each text chunk (in characters)
-    chunk_overlap=50,    # Overlap between chunks for context preservation
-    length_function=len, # Function to calculate text length
-    is_separator_regex=False  # Whether separators are regular expressions
-)
+    # Same pipeline as rag_app's rebuild: files are parsed in parallel worker
+    # processes (a crashing or hanging parser only loses its own file), then
+    # splitter -> embedder -> index run through bounded queues, flushing vectors
+    # in fixed-size batches. Chunk text goes straight into the store's sqlite
+    # chunk store batch by batch, so memory stays flat regardless of how large ./data is
+    ingestor = StreamingIngestor(
+        embedder,
+        text_splitter,
+        batch_size=256,            # Chunks embedded and flushed per batch
+        queue_size=4,              # Max items buffered between stages
+        # Record source/ext/page/ingest time/tenant on every chunk for filtered search
+        annotate=lambda path, doc: ingest_metadata(path, doc.metadata, data_dir="./data/"),
+        docstore=get_chunk_store("./vector_db"),
+        normalize_L2=True          # Normalize vectors for better similarity comparison
+    )
+    vector_db = None
+    # Columnar metadata side index, aligned with vector positions
+    metadata_index = MetadataIndex()
+    for vector_db, _, _, chunks in ingestor.run(iter_parallel_documents(file_paths)):
+        metadata_index.append(chunk.metadata for chunk in chunks)
+    print(f"Indexed {ingestor.chunks} chunks")
+    if vector_db is None:
+        print("No documents found")
+        return
 
-# Split documents into chunks
-splits = text_splitter.split_documents(docs)
-print(f"Split documents into {len(splits)} chunks")
+    # Save vector store locally in the memory-mapped format
+    # (index + columnar text/metadata, no pickle) that the apps load
+    save_vector_store(vector_db, "./vector_db", metadata_index=metadata_index)
 
-# Initialize Ollama Embedding model
-embedder = OllamaEmbeddings(
-    model="nomic-embed-text",  # Alternative: "deepseek-r1"
-    temperature=0.1,           # Control randomness (0-1)
-)
+    # Test the vector store with a metadata filter. The filter becomes a bitmap
+    # passed to faiss as an IDSelector, so it is applied inside the ANN search
+    # instead of post-filtering an over-fetched result list
+    query = "产品型号是什么"
+    selection = metadata_index.select(
+        {"ext": [".pdf", ".docx", ".txt"]}  # Optional metadata filter (source/ext/tenant/page/ingested_after/...)
+    )
+    hits = batch_dense_search(vector_db, [embedder.embed_query(query)], k=3, selection=selection)[0]
+    similar_docs = [vector_db.docstore.search(_id) for _id, _ in hits]
 
-# Generate and save vector database
-vector_db = FAISS.from_documents(
-    documents=splits,          # Our chunked documents
-    embedding=embedder,        # Embedding model
-    normalize_L2=True          # Normalize vectors for better similarity comparison
-)
+    # Print results
+    print("\nTop 3 most similar documents:")
+    for i, doc in enumerate(similar_docs, 1):
+        print(f"\nDocument {i}:")
+        print(doc.page_content)
+        print(f"Metadata: {doc.metadata}")  # Show associated metadata
 
-# Save vector store locally
-vector_db.save_local(
-    folder_path="./vector_db",  # Directory to save index
-    index_name="my_faiss_index" # Name of the index file
-)
+    print(f"\nEmbedding cache: {embedder.cache.stats()}")
 
-# Test the vector store
-query = "产品型号是什么"
-similar_docs = vector_db.similarity_search(
-    query=query,       # Search query
-    k=3,               # Number of results to return
-    filter=None        # Optional metadata filter
-)
 
-# Print results
-print("\nTop 3 most similar documents:")
-for i, doc in enumerate(similar_docs, 1):
-    print(f"\nDocument {i}:")
-    print(doc.page_content)
-    print(f"Metadata: {doc.metadata}")  # Show associated metadata
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# chunk_store.py
+# 文档块存储: 向量 id -> 正文 + 元数据，替代 index.pkl 里整体 pickle 的 InMemoryDocstore。
+# 基于 sqlite，按主键查找，只追加写入，查询时只取出 top-k 命中的那几条
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Union
+
+from langchain_core.documents import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+CHUNK_STORE_NAME = "chunks.sqlite"
+
+
+class ChunkStore(Docstore, AddableMixin):
+    """
+    - add: 追加写入(INSERT)，不重写已有数据，记下写入时间
+    - delete: 只打删除标记(记下删除时间)，旧版本索引的读者仍然能查到，vacuum() 时才真正删除
+    - search: 按 id 取单条，正文按需读取
+    """
+
+    def __init__(self, path: str, mmap_size: int = 1 << 30):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id TEXT PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL, "
+            "deleted INTEGER NOT NULL DEFAULT 0, created INTEGER NOT NULL DEFAULT 0)"
+        )
+        # 旧版本建的表没有 created 列，补上(已有的记录按很早以前写入算)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(chunks)")}
+        if "created" not in columns:
+            self.conn.execute("ALTER TABLE chunks ADD COLUMN created INTEGER NOT NULL DEFAULT 0")
+        self.conn.commit()
+        # 用内存映射读数据库文件，多个进程共享页缓存
+        self.conn.execute(f"PRAGMA mmap_size={mmap_size}")
+        self.lock = threading.Lock()
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        now = int(time.time())
+        rows = [
+            (_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False, default=str), now)
+            for _id, doc in texts.items()
+        ]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks (id, text, metadata, deleted, created) VALUES (?, ?, ?, 0, ?)", rows
+            )
+            self.conn.commit()
+
+    def add_missing(self, docs: Iterable[Document]) -> int:
+        """批量写入还不存在的文档块(从旧格式迁移时用)，返回写入条数"""
+        now = int(time.time())
+        rows = [
+            (doc.id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False, default=str), now)
+            for doc in docs
+        ]
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO chunks (id, text, metadata, created) VALUES (?, ?, ?, ?)", rows
+            )
+            self.conn.commit()
+            return self.conn.total_changes - before
+
+    def delete(self, ids: List) -> None:
+        with self.lock:
+            now = int(time.time())
+            self.conn.executemany("UPDATE chunks SET deleted=? WHERE id=?", [(now, i) for i in ids])
+            self.conn.commit()
+
+    def search(self, search: str) -> Union[str, Document]:
+        with self.lock:
+            row = self.conn.execute("SELECT text, metadata FROM chunks WHERE id=?", (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def mget(self, ids: List[str]) -> List[Optional[Document]]:
+        """一次查询取回多条，按传入顺序返回，找不到的位置为 None"""
+        if not ids:
+            return []
+        # 每条语句最多 500 个参数，不会超过 sqlite 的变量个数上限
+        unique = list(dict.fromkeys(ids))
+        rows = []
+        with self.lock:
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows.extend(self.conn.execute(
+                    f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})", part
+                ).fetchall())
+        found = {r[0]: Document(id=r[0], page_content=r[1], metadata=json.loads(r[2])) for r in rows}
+        return [found.get(i) for i in ids]
+
+    def vacuum(self, live_ids: Optional[Iterable[str]] = None, deleted_before: Optional[float] = None,
+               created_before: Optional[float] = None) -> int:
+        """
+        真正删除打了删除标记的文档块；给出 live_ids 时，不在其中的孤儿记录(例如丢弃的草稿写入的)也一并删除。
+        deleted_before 给出时，在这之后才打删除标记的保留(别的进程可能还在用映射着它们的旧版本索引)；
+        created_before 给出时，在这之后才写入的孤儿记录保留(可能是还没有发布的写入)
+        """
+        expired = "deleted<>0" if deleted_before is None else f"(deleted<>0 AND deleted<{int(deleted_before)})"
+        with self.lock:
+            removed = self.conn.execute(f"DELETE FROM chunks WHERE {expired}").rowcount
+            if live_ids is not None:
+                self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS live (id TEXT PRIMARY KEY)")
+                self.conn.execute("DELETE FROM live")
+                self.conn.executemany("INSERT OR IGNORE INTO live (id) VALUES (?)", ((i,) for i in live_ids))
+                orphan = "deleted=0" if created_before is None else f"deleted=0 AND created<{int(created_before)}"
+                removed += self.conn.execute(
+                    f"DELETE FROM chunks WHERE {orphan} AND id NOT IN (SELECT id FROM live)"
+                ).rowcount
+                self.conn.execute("DELETE FROM live")
+            self.conn.commit()
+            return removed
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks WHERE deleted=0").fetchone()[0]
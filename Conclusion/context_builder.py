@@ -0,0 +1,167 @@
+# context_builder.py
+# 把检索结果拼成 prompt 里的上下文:
+#   1. 同一来源(文件+页)的相邻文档块合并成一段，切分时 chunk_overlap 重复的部分只保留一次
+#   2. 用字符 shingle 哈希去掉近似重复的段落(同一段内容出现在多个文件里等)
+#   3. 按相关度从高到低贪心填满 token 预算，不再固定取 k 条；放不下的段落截断到剩余预算，不整段丢掉
+# 返回上下文和统计(相对原来直接拼接前 3 条省下的 token 数等)
+import os
+import re
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from langchain_core.documents import Document
+
+from history_window import count_tokens
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+# 检索时多取一些候选，由预算决定最终放进多少
+CONTEXT_FETCH_K = int(os.getenv("CONTEXT_FETCH_K", "8"))
+CONTEXT_DUP_THRESHOLD = float(os.getenv("CONTEXT_DUP_THRESHOLD", "0.8"))
+# 剩余预算少于这么多 token 时不再截断塞入半段，直接结束
+CONTEXT_MIN_TOKENS = int(os.getenv("CONTEXT_MIN_TOKENS", "64"))
+# 原来的做法: 固定取前 3 条直接拼接，saved_tokens 以它为基准
+NAIVE_K = 3
+
+SEPARATOR = "\n\n"
+_SPACES = re.compile(r"\s+")
+
+
+class _Passage:
+    __slots__ = ("text", "score", "source", "start", "parts")
+
+    def __init__(self, doc: Document, score: float):
+        self.text = doc.page_content
+        self.score = score
+        meta = doc.metadata or {}
+        self.source = (meta.get("source"), meta.get("page"))
+        self.start = meta.get("start_index")
+        self.parts = 1
+
+    @property
+    def end(self) -> Optional[int]:
+        return None if self.start is None else self.start + len(self.text)
+
+
+def _text_overlap(a: str, b: str, min_overlap: int = 10, max_overlap: int = 200) -> int:
+    """a 的结尾和 b 的开头重合的最长长度，没有重合返回 0"""
+    for k in range(min(len(a), len(b), max_overlap), min_overlap - 1, -1):
+        if a.endswith(b[:k]):
+            return k
+    return 0
+
+
+def _try_merge(a: _Passage, b: _Passage) -> bool:
+    """b 紧接在 a 后面(或和 a 重叠)时把 b 并进 a；有 start_index 按位置判断，否则按文本重合判断"""
+    if a.source != b.source or a.source == (None, None):
+        return False
+    if a.start is not None and b.start is not None:
+        if b.start < a.start:
+            return False
+        if b.start > a.end + 1:
+            return False
+        a.text = a.text + b.text[max(0, a.end - b.start):]
+    else:
+        overlap = _text_overlap(a.text, b.text)
+        if not overlap:
+            return False
+        a.text = a.text + b.text[overlap:]
+    a.score = max(a.score, b.score)
+    a.parts += b.parts
+    return True
+
+
+def merge_adjacent(passages: List[_Passage]) -> List[_Passage]:
+    """反复两两尝试合并，直到没有可以合并的为止(候选只有十几条，平方复杂度可以接受)"""
+    merged = sorted(passages, key=lambda p: (str(p.source), p.start if p.start is not None else -1))
+    changed = True
+    while changed:
+        changed = False
+        for i, a in enumerate(merged):
+            for j, b in enumerate(merged):
+                if i != j and _try_merge(a, b):
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def shingles(text: str, size: int = 5) -> Set[int]:
+    """去掉空白后的字符 n-gram 哈希集合，中文不用分词也能比较"""
+    text = _SPACES.sub("", text)
+    if len(text) <= size:
+        return {hash(text)}
+    return {hash(text[i:i + size]) for i in range(len(text) - size + 1)}
+
+
+def _is_duplicate(candidate: Set[int], kept: List[Set[int]], threshold: float) -> bool:
+    """和已选段落的重合度(按较小的一方计算包含率)超过阈值就算重复"""
+    for other in kept:
+        inter = len(candidate & other)
+        if inter and inter / min(len(candidate), len(other)) >= threshold:
+            return True
+    return False
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """截取 text 开头不超过 max_tokens 的部分(按字符二分，token 数随长度单调)"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def assemble_context(docs: Sequence[Document], budget: int = CONTEXT_TOKEN_BUDGET,
+                     scores: Optional[Sequence[float]] = None,
+                     dup_threshold: float = CONTEXT_DUP_THRESHOLD) -> Tuple[str, Dict[str, int]]:
+    """
+    docs 按相关度从高到低排列；scores 给出时以它为准(越大越相关)，否则按名次打分。
+    返回 (上下文文本, 统计)
+    """
+    if scores is None:
+        scores = [1.0 / (rank + 1) for rank in range(len(docs))]
+    naive_tokens = count_tokens(SEPARATOR.join(d.page_content for d in docs[:NAIVE_K]))
+    passages = merge_adjacent([_Passage(d, s) for d, s in zip(docs, scores)])
+
+    selected: List[_Passage] = []
+    kept_shingles: List[Set[int]] = []
+    duplicates = over_budget = truncated = 0
+    remaining = budget
+    for p in sorted(passages, key=lambda p: p.score, reverse=True):
+        sh = shingles(p.text)
+        if _is_duplicate(sh, kept_shingles, dup_threshold):
+            duplicates += 1
+            continue
+        separator = count_tokens(SEPARATOR) if selected else 0
+        cost = count_tokens(p.text) + separator
+        if cost > remaining:
+            # 合并后的长段落(往往正是最相关的几块)超出预算时截断放入，而不是整段跳过
+            if remaining - separator < CONTEXT_MIN_TOKENS:
+                over_budget += 1
+                continue
+            p.text = truncate_tokens(p.text, remaining - separator)
+            cost = count_tokens(p.text) + separator
+            truncated += 1
+        remaining -= cost
+        selected.append(p)
+        kept_shingles.append(sh)
+
+    context = SEPARATOR.join(p.text for p in selected)
+    used = count_tokens(context)
+    return context, {
+        "chunks": len(docs),
+        "passages": len(selected),
+        "merged": len(docs) - len(passages),
+        "duplicates": duplicates,
+        "over_budget": over_budget,
+        "truncated": truncated,
+        "naive_tokens": naive_tokens,
+        "context_tokens": used,
+        "saved_tokens": naive_tokens - used,
+    }
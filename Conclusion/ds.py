@@ -22,6 +22,14 @@ from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_community.chat_message_histories import RedisChatMessageHistory
 from langchain_core.output_parsers import StrOutputParser
+from mmap_store import current_generation, load_vector_store
+from answer_cache import AnswerCache, doc_ids
+from token_stream import coalesce_tokens, replay_tokens
+from context_builder import CONTEXT_FETCH_K, assemble_context
+from history_store import history_getter
+from history_window import windowed_history_getter
+from sse import SSE_HEADERS, SSEStreamRegistry, StreamGone
+from executors import BoundedExecutor, ExecutorBusy
 load_dotenv()
 if not os.getenv("DEEPSEEK_API_KEY"):
     os.environ["DEEPSEEK_API_KEY"] = getpass.getpass("Enter your DeepSeek API key: ")
@@ -42,35 +50,68 @@ prompt = ChatPromptTemplate.from_messages([
     ("human", "{input}")
 ])
 runnable = prompt | llm | parser
-store = {}
 embedder = OllamaEmbeddings(model="nomic-embed-text")
-vector_db = FAISS.load_local("./vector_db", embedder, allow_dangerous_deserialization=True) # 仅仅加载自己的数据库，不然可能恶意代码植入
+vector_db = load_vector_store("./vector_db", embedder) # 新格式内存映射加载，不再反序列化 pickle；旧格式仍兼容(仅加载自己的数据库)
+# 问答缓存(精确 + 语义)，向量库重新保存(generation 变化)后失效
+answer_cache = AnswerCache(embedder, version=lambda: current_generation("./vector_db"))
+sse_streams = SSEStreamRegistry()  # SSE 输出缓冲，断线后按 Last-Event-ID 续传
+# faiss 检索放到有界线程池里执行，不阻塞事件循环；排队满了返回 503
+retrieval_executor = BoundedExecutor("retrieval", max_workers=8, max_queue=64)
 class RagRequest(BaseModel):
     question: str
 @app.post("/ask")
-async def rag_answer(request: RagRequest):
-    docs = vector_db.similarity_search(request.question, k=3)
-    context = "\n\n".join([doc.page_content for doc in docs])
-    async def generate_stream() -> AsyncGenerator[str, None]:  # 异步生成器
+async def rag_answer(request: RagRequest, last_event_id: Optional[str] = Header(None)):
+    try:
+        resumed = sse_streams.resume(last_event_id)  # 断线重连，直接从缓冲区续传
+    except StreamGone as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    if resumed is not None:
+        return StreamingResponse(resumed, media_type="text/event-stream", headers=SSE_HEADERS)
+    # 查询向量用原生异步接口获取，检索在线程池里做
+    embedding = await embedder.aembed_query(request.question)
+    try:
+        docs = await retrieval_executor.run(vector_db.similarity_search_by_vector, embedding, CONTEXT_FETCH_K)
+    except ExecutorBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    # 合并相邻块、去重，按相关度填满 token 预算
+    context, context_stats = assemble_context(docs)
+    chunk_ids = doc_ids(docs)
+    question_vector = answer_cache.normalize(embedding)
+    # /ask 的 prompt 只有上下文和问题，不带会话历史，缓存不用按会话区分(带历史的 /chat 见 rag_app.py)
+    cached = answer_cache.get(request.question, chunk_ids, question_vector)
+    usage = {}
+    async def generate_tokens() -> AsyncGenerator[str, None]:  # 异步生成器
         prompt = ChatPromptTemplate.from_template(
             "基于以下上下文回答问题：\n{context}\n\n问题: {question}"
         )
+        if cached is not None:  # 命中缓存，按原分片流式返回
+            async for piece in replay_tokens(cached):
+                yield piece
+            return
         chain = prompt | llm
+        pieces = []
 
         # 使用异步流式调用 (关键修改！)
         async for chunk in chain.astream({"context": context, "question": request.question}):
-            yield str(chunk.content)  # 确保返回字符串
-            await asyncio.sleep(0.02)  # 控制流速
+            if getattr(chunk, "usage_metadata", None):
+                usage.update(chunk.usage_metadata)
+            pieces.append(str(chunk.content))
+            yield pieces[-1]  # 确保返回字符串
+        answer_cache.put(request.question, chunk_ids, pieces, question_vector)
 
+    # 不再固定 sleep 控制流速: token 到达即转发，合并成帧，按 SSE 格式输出(带事件 id、done 统计和心跳)
+    stream_id = sse_streams.start(
+        coalesce_tokens(generate_tokens()),
+        stats=lambda: {"cached": cached is not None, "usage": usage, "context": context_stats}
+    )
     return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream"
+        sse_streams.subscribe(stream_id),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
     )
-# 根据session的id来得到历史记录
-def get_session_history(session_id:str) -> BaseChatMessageHistory:
-    if session_id not in store:
-        store[session_id] = ChatMessageHistory()
-    return store[session_id]
+# 根据session的id来得到历史记录(Redis 或 sqlite，按会话过期、限制条数)
+# 只把 token 预算内的最近几轮放进 prompt，更早的轮次在后台压缩成摘要
+get_session_history = windowed_history_getter(history_getter(), llm=llm)
 # 创建一个有历史记录的runnable
 with_message_history = RunnableWithMessageHistory(
         runnable,
@@ -0,0 +1,395 @@
+# embedding_cache.py
+# 持久化的向量缓存: key = (模型名, 文本 sha256)，向量存放在内存映射的 float32 矩阵里，
+# 行号索引和 LRU 时间戳存放在 sqlite 里。所有 VectorDBManager 共用同一份缓存。
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_DIR = "./embedding_cache"
+
+
+def text_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    磁盘向量缓存
+    - vectors.f32: (capacity, dim) 的 float32 内存映射矩阵，容量不够时按 2 倍扩容
+    - index.sqlite: key -> 行号 + 最近使用时间，超过 max_entries 时按 LRU 淘汰；空闲行号和容量也记在这里
+    同一个目录会被多个进程共用: 分配行号、扩容、写向量、读向量都在 sqlite 的写事务(BEGIN IMMEDIATE)里进行，
+    进程之间互斥，不会把同一行分给两个 key，也不会读到正被别的进程改写的行；
+    别的进程扩容后，行号超出本进程映射范围时重新映射文件
+    """
+
+    def __init__(self, cache_dir: str = EMBEDDING_CACHE_DIR, max_entries: int = 1_000_000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.matrix_path = os.path.join(cache_dir, "vectors.f32")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # 事务由 _transaction() 显式控制；别的进程持有写锁时最多等 timeout 秒
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=30,
+                                    check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON entries(last_used)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)")
+
+        self.dim: Optional[int] = None
+        self.matrix = None
+        with self.lock, self._transaction():
+            self.dim = self._meta("dim")
+            if self.dim is not None:
+                self._init_rows()
+
+    @contextmanager
+    def _transaction(self):
+        """跨进程互斥的写事务；出错时回滚(已经写进矩阵的行没有登记，仍然算空闲)"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _meta(self, name: str) -> Optional[int]:
+        row = self.conn.execute("SELECT value FROM meta WHERE name=?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name: str, value: int):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    # ---------- 矩阵文件 ----------
+    def _init_rows(self):
+        """
+        旧版本的缓存只有矩阵文件和 entries 表: 按文件大小记下容量，没被占用的行登记为空闲。
+        在写事务里调用，只会执行一次
+        """
+        if self._meta("capacity") is not None:
+            return
+        size = os.path.getsize(self.matrix_path) if os.path.exists(self.matrix_path) else 0
+        capacity = size // (self.dim * 4)
+        used = {r for (r,) in self.conn.execute("SELECT row FROM entries")}
+        self.conn.executemany("INSERT OR IGNORE INTO free_rows (row) VALUES (?)",
+                              ((r,) for r in range(capacity) if r not in used))
+        self._set_meta("capacity", capacity)
+
+    def _map(self, rows: int):
+        """保证本进程的内存映射至少覆盖 rows 行(别的进程可能已经把文件扩容了)"""
+        if self.matrix is not None and len(self.matrix) >= rows:
+            return
+        if self.matrix is not None:
+            self.matrix.flush()
+        capacity = os.path.getsize(self.matrix_path) // (self.dim * 4)
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def _grow(self, needed: int):
+        """空闲行不够时扩容到至少 needed 行(按 2 倍)，新增的行登记为空闲。在写事务里调用"""
+        capacity = self._meta("capacity") or 0
+        new_capacity = max(needed, 2 * capacity, 1024)
+        with open(self.matrix_path, "ab") as f:
+            f.truncate(new_capacity * self.dim * 4)
+        self.conn.executemany("INSERT INTO free_rows (row) VALUES (?)",
+                              ((r,) for r in range(capacity, new_capacity)))
+        self._set_meta("capacity", new_capacity)
+
+    def _allocate(self, n: int) -> List[int]:
+        """从空闲行里取 n 行，不够时扩容。在写事务里调用"""
+        if n == 0:
+            return []
+        rows = [r for (r,) in self.conn.execute("SELECT row FROM free_rows ORDER BY row LIMIT ?", (n,))]
+        if len(rows) < n:
+            self._grow((self._meta("capacity") or 0) + n - len(rows))
+            rows = [r for (r,) in self.conn.execute("SELECT row FROM free_rows ORDER BY row LIMIT ?", (n,))]
+        self.conn.executemany("DELETE FROM free_rows WHERE row=?", [(r,) for r in rows])
+        return rows
+
+    def _init_dim(self, dim: int):
+        # 别的进程可能已经先写入过
+        self.dim = self._meta("dim") or dim
+        self._set_meta("dim", self.dim)
+        self._init_rows()
+
+    def _rows_for(self, keys: List[str]) -> Dict[str, int]:
+        rows = {}
+        for start in range(0, len(keys), 500):
+            part = keys[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            for key, row in self.conn.execute(
+                f"SELECT key, row FROM entries WHERE key IN ({placeholders})", part
+            ):
+                rows[key] = row
+        return rows
+
+    # ---------- 读写 ----------
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """批量查询，未命中的位置返回 None"""
+        with self.lock:
+            if self.dim is None:
+                self.dim = self._meta("dim")
+            if self.dim is None:
+                self.misses += len(keys)
+                return [None] * len(keys)
+            result = []
+            # 读向量也在写事务里: 别的进程不会在查到行号之后、读出向量之前把这一行淘汰改写
+            with self._transaction():
+                rows = self._rows_for(list(set(keys)))
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE entries SET last_used=? WHERE key=?", [(now, key) for key in rows]
+                )
+                if rows:
+                    self._map(max(rows.values()) + 1)
+                for key in keys:
+                    row = rows.get(key)
+                    if row is None:
+                        self.misses += 1
+                        result.append(None)
+                    else:
+                        self.hits += 1
+                        result.append(np.array(self.matrix[row]))
+            return result
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]):
+        with self.lock:
+            if not keys:
+                return
+            # 同一批里重复的 key 只写一次
+            pending = dict(zip(keys, vectors))
+            with self._transaction():
+                if self._meta("dim") is None:
+                    self._init_dim(len(vectors[0]))
+                self.dim = self._meta("dim")
+                rows = self._rows_for(list(pending))
+                # 已经存在的 key 原地覆盖，只为新 key 腾地方、分配行
+                new_keys = [key for key in pending if key not in rows]
+                self._evict(len(new_keys), keep=pending)
+                rows.update(zip(new_keys, self._allocate(len(new_keys))))
+                self._map(max(rows.values()) + 1)
+                for key, vec in pending.items():
+                    self.matrix[rows[key]] = np.asarray(vec, dtype=np.float32)
+                self.matrix.flush()
+                now = time.time()
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO entries (key, row, last_used) VALUES (?, ?, ?)",
+                    [(key, rows[key], now) for key in pending]
+                )
+
+    def _evict(self, incoming: int, keep=()):
+        """按 LRU 腾出空间，保证写入后条目数不超过 max_entries；keep 里的 key(正在写的这一批)不淘汰"""
+        count = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        overflow = count + incoming - self.max_entries
+        if overflow <= 0:
+            return
+        victims = [
+            (key, row) for key, row in self.conn.execute(
+                "SELECT key, row FROM entries ORDER BY last_used LIMIT ?", (overflow + len(keep),)
+            ).fetchall() if key not in keep
+        ][:overflow]
+        self.conn.executemany("DELETE FROM entries WHERE key=?", [(k,) for k, _ in victims])
+        self.conn.executemany("INSERT INTO free_rows (row) VALUES (?)", [(row,) for _, row in victims])
+        self.evictions += len(victims)
+
+    def stats(self) -> dict:
+        with self.lock:
+            size = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": size}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class QueryEmbeddingLRU:
+    """
+    查询向量的进程内 LRU 缓存 + 单飞(single-flight):
+    同一个问题正在请求 embedding 时，其他线程的相同请求等待这一次的结果，不重复请求
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.in_flight: Dict[str, _Flight] = {}
+        self.async_in_flight: Dict[str, asyncio.Future] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_compute(self, key: str, compute: Callable[[], List[float]]) -> List[float]:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = compute()
+            with self.lock:
+                self.entries[key] = flight.result
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+
+    async def aget_or_compute(self, key: str, compute: Callable[[], Awaitable[List[float]]]) -> List[float]:
+        """异步版本: 同一事件循环里并发的相同查询共用一个 Future"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            future = self.async_in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.async_in_flight[key] = future
+        try:
+            vec = await compute()
+            self.put(key, vec)
+            future.set_result(vec)
+            return vec
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # 没有其他等待者时不报 "exception was never retrieved"
+            raise
+        finally:
+            self.async_in_flight.pop(key, None)
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self.lock:
+            vec = self.entries.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, key: str, vec: List[float]):
+        with self.lock:
+            self.entries[key] = vec
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    在任意 Embeddings 外面包一层缓存:
+    文档块走磁盘缓存，已经算过的不会再请求 embedding 服务；查询走进程内 LRU，并合并并发的相同查询
+    """
+
+    def __init__(self, embedder: Embeddings, model_name: Optional[str] = None,
+                 cache: Optional[EmbeddingCache] = None, query_cache_size: int = 1024):
+        self.embedder = embedder
+        self.model_name = model_name or getattr(embedder, "model", type(embedder).__name__)
+        self.cache = cache or get_default_cache()
+        self.query_cache = QueryEmbeddingLRU(query_cache_size)
+        self.embed_calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [text_key(self.model_name, t) for t in texts]
+        cached = self.cache.get_many(keys)
+        # 同一批里重复的文本只请求一次
+        missing = {}
+        for key, text, vec in zip(keys, texts, cached):
+            if vec is None and key not in missing:
+                missing[key] = text
+        if missing:
+            self.embed_calls += 1
+            new_vectors = self.embedder.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing.keys()), new_vectors)
+            fresh = dict(zip(missing.keys(), new_vectors))
+        else:
+            fresh = {}
+        return [
+            list(map(float, vec)) if vec is not None else list(fresh[key])
+            for key, vec in zip(keys, cached)
+        ]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.query_cache.get_or_compute(
+            text_key(self.model_name, text), lambda: self.embedder.embed_query(text)
+        )
+
+    async def aembed_query(self, text: str, client) -> List[float]:
+        """用异步 embedding 客户端(AsyncBatchEmbedder)算查询向量，共用同一个 LRU"""
+        return await self.query_cache.aget_or_compute(
+            text_key(self.model_name, text), lambda: client.embed_query(text)
+        )
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """批量查询: LRU 里没有的问题合并成一次 embedding 请求"""
+        keys = [text_key(self.model_name, t) for t in texts]
+        vectors = [self.query_cache.get(key) for key in keys]
+        missing = {}
+        for key, text, vec in zip(keys, texts, vectors):
+            if vec is None and key not in missing:
+                missing[key] = text
+        if missing:
+            self.embed_calls += 1
+            fresh = dict(zip(missing.keys(), self.embedder.embed_documents(list(missing.values()))))
+            for key, vec in fresh.items():
+                self.query_cache.put(key, vec)
+            vectors = [vec if vec is not None else fresh[key] for key, vec in zip(keys, vectors)]
+        return vectors
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache() -> EmbeddingCache:
+    """进程内共享同一个缓存实例(同一个 sqlite 连接和内存映射)"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+        return _default_cache
@@ -0,0 +1,98 @@
+# executors.py
+# FastAPI 处理函数里不直接做阻塞工作: 检索放到专用线程池，入库放到独立事件循环线程。
+# 两者的排队长度都有上限，队列满了直接拒绝(503)，不让积压把延迟拖垮
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Callable
+
+
+class ExecutorBusy(RuntimeError):
+    """执行器排队已满"""
+
+
+class BoundedExecutor:
+    """
+    有界线程池:
+        retrieval_executor = BoundedExecutor("retrieval", max_workers=8, max_queue=64)
+        docs = await retrieval_executor.run(vector_db_manager.retrieve, query)
+    在途任务(执行中 + 排队中)超过 max_workers + max_queue 时抛 ExecutorBusy
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.limit = max_workers + max_queue
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        with self.lock:
+            if self.pending >= self.limit:
+                raise ExecutorBusy(f"{self.name} 执行器繁忙，排队已满({self.limit})")
+            self.pending += 1
+
+    def _release(self, _=None):
+        with self.lock:
+            self.pending -= 1
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        self._reserve()
+        try:
+            future = self.pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class LoopThreadExecutor:
+    """
+    在独立线程里跑一个事件循环，专门执行入库这类长协程(异步 embedding、写索引)，
+    不占用处理请求的事件循环。同一时间只执行 concurrency 个协程，其余排队(有上限)
+    """
+
+    def __init__(self, name: str, max_queue: int, concurrency: int = 1):
+        self.name = name
+        self.limit = concurrency + max_queue
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+        self._slots = asyncio.run_coroutine_threadsafe(self._make_semaphore(concurrency), self.loop).result()
+
+    @staticmethod
+    async def _make_semaphore(n: int) -> asyncio.Semaphore:
+        return asyncio.Semaphore(n)
+
+    async def _guarded(self, coro_fn: Callable[..., Awaitable], args, kwargs):
+        async with self._slots:
+            return await coro_fn(*args, **kwargs)
+
+    def submit(self, coro_fn: Callable[..., Awaitable], *args, **kwargs) -> Future:
+        """提交后立即返回 concurrent.futures.Future，不等待执行完成(后台任务用)"""
+        with self.lock:
+            if self.pending >= self.limit:
+                raise ExecutorBusy(f"{self.name} 执行器繁忙，排队已满({self.limit})")
+            self.pending += 1
+        future = asyncio.run_coroutine_threadsafe(self._guarded(coro_fn, args, kwargs), self.loop)
+
+        def release(_):
+            with self.lock:
+                self.pending -= 1
+
+        future.add_done_callback(release)
+        return future
+
+    async def run(self, coro_fn: Callable[..., Awaitable], *args, **kwargs):
+        future = self.submit(coro_fn, *args, **kwargs)
+        # 调用方被取消(客户端断开)时入库照常完成，不中途打断写索引
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
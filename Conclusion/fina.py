@@ -1,7 +1,7 @@
 from dotenv import load_dotenv
 import os
 import asyncio
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import AsyncGenerator, List, Union
@@ -16,13 +16,18 @@ from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.output_parsers import StrOutputParser
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
+from embedding_cache import CachedEmbeddings
+from vector_wal import open_wal_store
+from executors import ExecutorBusy
+from ingest_jobs import IngestJob, IngestJobQueue
+from sse import SSE_HEADERS
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
 
 # Load environment variables
 load_dotenv()
 
 # Initialize embedding model
-embedder = OllamaEmbeddings(model="nomic-embed-text")
+embedder = CachedEmbeddings(OllamaEmbeddings(model="nomic-embed-text"))
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=500,
     chunk_overlap=50
@@ -37,31 +42,32 @@ class VectorDBManager:
 
     def load_db(self):
         """加载现有的向量数据库"""
-        if os.path.exists(self.db_path):
-            try:
-                self.vector_db = FAISS.load_local(
-                    self.db_path,
-                    embedder,
-                    allow_dangerous_deserialization=True
-                )
+        try:
+            # 加载主索引并回放 WAL 里还没合并的写入
+            self.store = open_wal_store(self.db_path, embedder)
+            self.vector_db = self.store.vector_db
+            if self.vector_db is not None:
                 print("✅ 已加载现有向量数据库")
-            except Exception as e:
-                print(f"⚠️ 加载向量数据库失败: {e}")
-                self.vector_db = None
-
-    def process_uploaded_file(self, file: UploadFile) -> List[str]:
-        """处理上传的文件并返回文档块"""
+        except Exception as e:
+            print(f"⚠️ 加载向量数据库失败: {e}")
+            self.vector_db = None
+
+    def save_uploaded_file(self, file: UploadFile) -> str:
+        """把上传内容写入临时目录(先写临时文件再改名)，返回保存路径"""
+        temp_dir = "./temp_uploads"
+        os.makedirs(temp_dir, exist_ok=True)
+        file_path = f"{temp_dir}/{uuid.uuid4().hex}_{os.path.basename(file.filename)}"
+        tmp_path = file_path + ".part"
+        with open(tmp_path, "wb") as f:
+            f.write(file.file.read())
+        os.replace(tmp_path, file_path)
+        return file_path
+
+    def process_saved_file(self, file_path: str) -> List[str]:
+        """解析并切分已保存的文件，处理完删除临时文件"""
         try:
-            # 创建临时文件
-            temp_dir = "./temp_uploads"
-            os.makedirs(temp_dir, exist_ok=True)
-            file_path = f"{temp_dir}/{file.filename}"
-
-            with open(file_path, "wb") as f:
-                f.write(file.file.read())
-
             # 根据文件类型选择加载器
-            ext = os.path.splitext(file.filename)[1].lower()
+            ext = os.path.splitext(file_path)[1].lower()
             loaders = {
                 '.pdf': PyPDFLoader,
                 '.docx': Docx2txtLoader,
@@ -73,38 +79,46 @@ class VectorDBManager:
 
             loader = loaders[ext](file_path)
             docs = loader.load()
-            splits = text_splitter.split_documents(docs)
-
-            # 清理临时文件
-            os.remove(file_path)
-
-            return splits
+            return text_splitter.split_documents(docs)
 
         except Exception as e:
             print(f"文件处理错误: {e}")
             raise
+        finally:
+            # 清理临时文件
+            if os.path.exists(file_path):
+                os.remove(file_path)
 
     def add_documents(self, documents: List[str]):
-        """向向量数据库添加新文档"""
-        if self.vector_db is None:
-            self.vector_db = FAISS.from_documents(
-                documents=documents,
-                embedding=embedder
-            )
-        else:
-            self.vector_db.add_documents(documents)
-
-        self.save_db()
+        """向向量数据库添加新文档(追加 WAL，后台线程负责合并进主索引)"""
+        self.store.add_documents(documents)
+        self.vector_db = self.store.vector_db
 
     def save_db(self):
-        """保存向量数据库"""
+        """立即把 WAL 合并进主索引并保存"""
         if self.vector_db:
-            self.vector_db.save_local(self.db_path)
+            self.store.compact()
             print("✅ 向量数据库已更新")
 
 # 初始化向量数据库管理器
 vector_db_manager = VectorDBManager()
 
+
+async def run_ingest_job(job: IngestJob) -> dict:
+    """后台入库任务: 解析、切分、写入向量库，并上报进度"""
+    document_count = 0
+    for file_path in job.files:
+        documents = await asyncio.to_thread(vector_db_manager.process_saved_file, file_path)
+        job.file_parsed(file_path, len(documents))
+        await asyncio.to_thread(vector_db_manager.add_documents, documents)
+        job.embedded(len(documents))
+        document_count += len(documents)
+    return {"document_count": document_count}
+
+
+# 入库任务按提交顺序逐个执行
+ingest_jobs = IngestJobQueue(run_ingest_job)
+
 app = FastAPI()
 
 class ChatRequest(BaseModel):
@@ -119,22 +133,38 @@ async def chat_endpoint(request: ChatRequest):
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
-    """处理文件上传并嵌入到向量数据库"""
+    """保存上传文件并提交后台入库任务，立即返回任务 id"""
     try:
-        documents = vector_db_manager.process_uploaded_file(file)
-        vector_db_manager.add_documents(documents)
-
+        file_path = await asyncio.to_thread(vector_db_manager.save_uploaded_file, file)
+        job = ingest_jobs.submit([file_path])
         return {
-            "status": "success",
-            "message": f"文件 '{file.filename}' 已成功处理并添加到 知识库",
-            "document_count": len(documents)
+            "status": "queued",
+            "job_id": job.id,
+            "message": f"文件 '{file.filename}' 已加入入库队列"
         }
+    except ExecutorBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         return {
             "status": "error",
             "message": str(e)
         }
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询入库任务进度"""
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """以 SSE 推送入库任务进度"""
+    if ingest_jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return StreamingResponse(ingest_jobs.events(job_id), media_type="text/event-stream", headers=SSE_HEADERS)
+
 def interactive_chat():
     """交互式聊天界面，支持@file命令"""
     session_id = str(uuid.uuid4())
@@ -154,14 +184,14 @@ def interactive_chat():
                 continue
 
             try:
-                # 模拟文件上传
+                # 命令行里直接同步入库，不走后台队列
                 with open(file_path, "rb") as f:
-                    fake_file = UploadFile(
-                        filename=os.path.basename(file_path),
-                        file=f
+                    saved = vector_db_manager.save_uploaded_file(
+                        UploadFile(filename=os.path.basename(file_path), file=f)
                     )
-                    result = asyncio.run(upload_file(fake_file))
-                    print(result["message"])
+                documents = vector_db_manager.process_saved_file(saved)
+                vector_db_manager.add_documents(documents)
+                print(f"文件 '{os.path.basename(file_path)}' 已成功处理并添加到 知识库 ({len(documents)} 块)")
             except Exception as e:
                 print(f"❌ 文件处理失败: {e}")
             continue
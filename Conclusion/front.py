@@ -1,6 +1,5 @@
 import os
 import uuid
-import time
 import asyncio
 import tempfile
 from typing import List
@@ -13,9 +12,15 @@ from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_ollama import OllamaEmbeddings
+from embedding_cache import CachedEmbeddings
+from token_stream import render_frames
+from context_builder import CONTEXT_FETCH_K, assemble_context
+from history_store import history_getter
+from history_window import windowed_history_getter
+from mmap_store import load_vector_store, save_vector_store
+from parallel_loader import iter_parallel_load
 from langchain_deepseek import ChatDeepSeek
 
 # --- 常量 ---
@@ -26,7 +31,7 @@ VECTOR_DB_PATH = "./vector_db"
 os.makedirs(DATA_DIR, exist_ok=True)
 
 # --- 初始化 Embedding 和 Text Splitter ---
-embedder = OllamaEmbeddings(model="nomic-embed-text")
+embedder = CachedEmbeddings(OllamaEmbeddings(model="nomic-embed-text"))
 text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
 
 # --- 初始化 LLM ---
@@ -49,13 +54,9 @@ prompt = ChatPromptTemplate.from_messages([
 
 base_chain = prompt | llm | parser
 
-# --- 会话上下文存储 ---
-session_store = {}
-
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in session_store:
-        session_store[session_id] = ChatMessageHistory()
-    return session_store[session_id]
+# --- 会话上下文存储(Redis 或 sqlite，按会话过期、限制条数) ---
+# 只把 token 预算内的最近几轮放进 prompt，更早的轮次在后台压缩成摘要
+get_session_history = windowed_history_getter(history_getter(), llm=llm)
 
 chat_chain = RunnableWithMessageHistory(
     base_chain,
@@ -72,36 +73,22 @@ class VectorDBManager:
 
     def load_db(self):
         if os.path.exists(VECTOR_DB_PATH):
-            self.vector_db = FAISS.load_local(
-                VECTOR_DB_PATH,
-                embedder,
-                allow_dangerous_deserialization=True
-            )
+            self.vector_db = load_vector_store(VECTOR_DB_PATH, embedder, mmap=False)
 
     def save_db(self):
         if self.vector_db:
-            self.vector_db.save_local(VECTOR_DB_PATH)
+            save_vector_store(self.vector_db, VECTOR_DB_PATH)
 
     def rebuild_from_data_dir(self):
         files = [os.path.join(DATA_DIR, f) for f in os.listdir(DATA_DIR)
                  if os.path.isfile(os.path.join(DATA_DIR, f)) and os.path.splitext(f)[1].lower() in ['.pdf', '.docx', '.txt']]
         all_docs = []
-        for file_path in files:
-            ext = os.path.splitext(file_path)[1].lower()
-            loaders = {
-                '.pdf': PyPDFLoader,
-                '.docx': Docx2txtLoader,
-                '.txt': TextLoader
-            }
-            loader = loaders.get(ext)
-            if not loader:
+        # 多进程并行解析，按完成顺序切分
+        for result in iter_parallel_load(files):
+            if result.docs is None:
+                st.warning(f"加载文件失败 {result.path}: {result.error}")
                 continue
-            try:
-                docs = loader(file_path).load()
-                splits = text_splitter.split_documents(docs)
-                all_docs.extend(splits)
-            except Exception as e:
-                st.warning(f"加载文件失败 {file_path}: {e}")
+            all_docs.extend(text_splitter.split_documents(result.docs))
 
         if all_docs:
             self.vector_db = FAISS.from_documents(all_docs, embedder)
@@ -156,8 +143,9 @@ if prompt := st.chat_input("请输入你的问题..."):
         st.markdown(prompt)
 
     # 从向量库搜索相关文档
-    docs = vector_db_manager.similarity_search(prompt, k=3)
-    context = "\n\n".join([doc.page_content for doc in docs])
+    docs = vector_db_manager.similarity_search(prompt, k=CONTEXT_FETCH_K)
+    # 合并相邻块、去重，按相关度填满 token 预算
+    context, context_stats = assemble_context(docs)
 
     # 生成回答
     response = chat_chain.stream({
@@ -169,10 +157,12 @@ if prompt := st.chat_input("请输入你的问题..."):
     with st.chat_message("assistant"):
         placeholder = st.empty()
         response_text = ""
-        for chunk in response:
-            response_text += chunk
+        # 分片一到就接收，只按 UI_RENDER_INTERVAL 限制重绘频率
+        for response_text in render_frames(response):
             placeholder.markdown(response_text + "▌")
-            time.sleep(0.02)
         placeholder.markdown(response_text)
+        st.caption(f"上下文 {context_stats['context_tokens']} tokens"
+                   f"(合并 {context_stats['merged']} 块，去重 {context_stats['duplicates']} 段，"
+                   f"节省 {context_stats['saved_tokens']} tokens)")
 
     st.session_state.messages.append({"role": "assistant", "content": response_text})
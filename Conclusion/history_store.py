@@ -0,0 +1,253 @@
+# history_store.py
+# 会话历史存储: 替代进程内的 {session_id: ChatMessageHistory} 字典。
+# 后端可选 Redis(或任何兼容 redis-py 接口的客户端，例如测试用的 fakeredis)和内置 sqlite；
+# 每个会话有过期时间(每次写入续期)和消息条数上限，超出的旧消息直接裁掉。
+# get_session_history 只返回一个句柄，真正读取发生在链第一次访问 messages 时
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+# auto: 配置了 REDIS_URL 且能连上就用 Redis，否则用 sqlite
+CHAT_HISTORY_BACKEND = os.getenv("CHAT_HISTORY_BACKEND", "auto")
+CHAT_HISTORY_TTL = float(os.getenv("CHAT_HISTORY_TTL", str(7 * 24 * 3600)))
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "50"))
+CHAT_HISTORY_DB = os.getenv("CHAT_HISTORY_DB", "./chat_history.sqlite")
+REDIS_URL = os.getenv("REDIS_URL")
+
+
+def _dumps(message: BaseMessage) -> str:
+    return json.dumps(message_to_dict(message), ensure_ascii=False)
+
+
+def _loads(raw) -> BaseMessage:
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    return messages_from_dict([json.loads(raw)])[0]
+
+
+class RedisHistoryBackend:
+    """
+    每个会话一个 list: RPUSH 追加、LTRIM 只保留最近 max_messages 条、EXPIRE 续期，三步在一个 pipeline 里提交。
+    client 是 redis.Redis 或接口兼容的对象
+    """
+
+    def __init__(self, client, ttl: float = CHAT_HISTORY_TTL, max_messages: int = CHAT_HISTORY_MAX_MESSAGES,
+                 prefix: str = "chat_history:"):
+        self.client = client
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.prefix = prefix
+
+    def _key(self, session_id: str) -> str:
+        return self.prefix + session_id
+
+    def load(self, session_id: str) -> List[BaseMessage]:
+        raw = self.client.lrange(self._key(session_id), -self.max_messages, -1)
+        return [_loads(r) for r in raw]
+
+    def append(self, session_id: str, messages: Sequence[BaseMessage]):
+        if not messages:
+            return
+        key = self._key(session_id)
+        pipe = self.client.pipeline()
+        pipe.rpush(key, *[_dumps(m) for m in messages])
+        pipe.ltrim(key, -self.max_messages, -1)
+        pipe.expire(key, int(self.ttl))
+        pipe.execute()
+
+    def clear(self, session_id: str):
+        self.client.delete(self._key(session_id))
+
+    def purge_expired(self) -> int:
+        return 0  # 由 Redis 自己按 EXPIRE 淘汰
+
+
+class SQLiteHistoryBackend:
+    """
+    内置后端: 一张消息表 + 一张会话表(过期时间)。读到已过期的会话按空处理并删除，
+    每写入 purge_every 次顺带清理一次所有过期会话
+    """
+
+    def __init__(self, path: str = CHAT_HISTORY_DB, ttl: float = CHAT_HISTORY_TTL,
+                 max_messages: int = CHAT_HISTORY_MAX_MESSAGES, purge_every: int = 500):
+        self.path = path
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.purge_every = purge_every
+        self._writes = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, message TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def _delete(self, session_id: str):
+        self.conn.execute("DELETE FROM messages WHERE session_id=?", (session_id,))
+        self.conn.execute("DELETE FROM sessions WHERE session_id=?", (session_id,))
+
+    def load(self, session_id: str) -> List[BaseMessage]:
+        with self.lock:
+            row = self.conn.execute("SELECT expires_at FROM sessions WHERE session_id=?", (session_id,)).fetchone()
+            if row is None:
+                return []
+            if row[0] < time.time():
+                self._delete(session_id)
+                self.conn.commit()
+                return []
+            rows = self.conn.execute(
+                "SELECT message FROM messages WHERE session_id=? ORDER BY id DESC LIMIT ?",
+                (session_id, self.max_messages)
+            ).fetchall()
+        return [_loads(r[0]) for r in reversed(rows)]
+
+    def append(self, session_id: str, messages: Sequence[BaseMessage]):
+        if not messages:
+            return
+        with self.lock:
+            row = self.conn.execute("SELECT expires_at FROM sessions WHERE session_id=?", (session_id,)).fetchone()
+            if row is not None and row[0] < time.time():
+                self._delete(session_id)
+            self.conn.executemany(
+                "INSERT INTO messages (session_id, message) VALUES (?, ?)",
+                [(session_id, _dumps(m)) for m in messages]
+            )
+            # 只保留最近 max_messages 条
+            self.conn.execute(
+                "DELETE FROM messages WHERE session_id=? AND id <= ("
+                "SELECT id FROM messages WHERE session_id=? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (session_id, session_id, self.max_messages)
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, expires_at) VALUES (?, ?)",
+                (session_id, time.time() + self.ttl)
+            )
+            self.conn.commit()
+            self._writes += 1
+            purge = self._writes % self.purge_every == 0
+        if purge:
+            self.purge_expired()
+
+    def clear(self, session_id: str):
+        with self.lock:
+            self._delete(session_id)
+            self.conn.commit()
+
+    def purge_expired(self) -> int:
+        """删除所有已过期的会话，返回删除的会话数"""
+        with self.lock:
+            now = time.time()
+            self.conn.execute(
+                "DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE expires_at < ?)", (now,)
+            )
+            removed = self.conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,)).rowcount
+            self.conn.commit()
+            return removed
+
+
+class StoredChatHistory(BaseChatMessageHistory):
+    """
+    RunnableWithMessageHistory 用的会话历史句柄。创建时不读存储，
+    第一次访问 messages 时才加载；add_messages 直接追加到存储
+    """
+
+    def __init__(self, session_id: str, backend):
+        self.session_id = session_id
+        self.backend = backend
+        self._messages: Optional[List[BaseMessage]] = None
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        if self._messages is None:
+            self._messages = self.backend.load(self.session_id)
+        return list(self._messages)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.backend.append(self.session_id, messages)
+        if self._messages is not None:
+            self._messages = (self._messages + list(messages))[-self.backend.max_messages:]
+
+    def clear(self) -> None:
+        self.backend.clear(self.session_id)
+        self._messages = []
+
+
+_backends: Dict[tuple, object] = {}
+
+
+def open_history_backend(backend: str = CHAT_HISTORY_BACKEND, redis_url: Optional[str] = REDIS_URL,
+                         path: str = CHAT_HISTORY_DB, ttl: float = CHAT_HISTORY_TTL,
+                         max_messages: int = CHAT_HISTORY_MAX_MESSAGES):
+    """
+    按配置打开历史存储，同样的配置在进程内只打开一次(Streamlit 每次重跑脚本也复用同一个连接)。
+    auto 模式下 Redis 不可用时退回 sqlite
+    """
+    key = (backend, redis_url, path, ttl, max_messages)
+    if key in _backends:
+        return _backends[key]
+    opened = None
+    if backend in ("auto", "redis") and (redis_url or backend == "redis"):
+        try:
+            import redis
+
+            client = redis.Redis.from_url(redis_url or "redis://localhost:6379/0")
+            client.ping()
+            opened = RedisHistoryBackend(client, ttl=ttl, max_messages=max_messages)
+            print(f"✅ 会话历史使用 Redis: {redis_url or 'redis://localhost:6379/0'}")
+        except Exception as e:
+            if backend == "redis":
+                raise
+            print(f"⚠️ Redis 不可用({e})，会话历史改用 sqlite")
+    if opened is None:
+        opened = SQLiteHistoryBackend(path, ttl=ttl, max_messages=max_messages)
+    _backends[key] = opened
+    return opened
+
+
+def history_getter(backend=None):
+    """返回给 RunnableWithMessageHistory 用的 get_session_history(session_id)"""
+    backend = backend or open_history_backend()
+
+    def get_session_history(session_id: str) -> BaseChatMessageHistory:
+        return StoredChatHistory(session_id, backend)
+
+    return get_session_history
+
+
+def _self_check(backend):
+    """追加/裁剪/加载/清空走一遍，用于验证 Redis(或替身服务)和 sqlite 后端"""
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    session_id = f"self-check-{time.time_ns()}"
+    history = StoredChatHistory(session_id, backend)
+    for i in range(backend.max_messages):
+        history.add_messages([HumanMessage(f"问题 {i}"), AIMessage(f"回答 {i}")])
+    loaded = StoredChatHistory(session_id, backend).messages
+    assert len(loaded) == backend.max_messages, len(loaded)
+    assert loaded[-1].content == f"回答 {backend.max_messages - 1}", loaded[-1].content
+    history.clear()
+    assert StoredChatHistory(session_id, backend).messages == []
+    print(f"✅ {type(backend).__name__} 自检通过(上限 {backend.max_messages} 条, TTL {backend.ttl:.0f}s)")
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python history_store.py check [redis_url]   不给 redis_url 时检查 sqlite 后端
+    if len(sys.argv) >= 2 and sys.argv[1] == "check":
+        url = sys.argv[2] if len(sys.argv) > 2 else None
+        _self_check(open_history_backend("redis" if url else "sqlite", redis_url=url, max_messages=10))
+    else:
+        print("用法: python history_store.py check [redis_url]")
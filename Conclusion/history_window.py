@@ -0,0 +1,158 @@
+# history_window.py
+# 按 token 预算截取会话历史: 只把最近、放得进预算的几轮原文放进 prompt，
+# 更早的轮次压缩成一段滚动摘要(一条 system 消息)。摘要在后台线程里增量更新:
+# 每次只把"新滑出窗口"的消息和上一版摘要一起交给模型，不在请求路径上等待。
+# 摘要和它覆盖到的最后一条消息 id 一起存在历史存储里(会话 id 加 ::summary 后缀)
+import os
+import re
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Set
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "300"))
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken 没装或没有编码文件时用估算
+    _encoding = None
+
+_CJK = re.compile(r"[㐀-鿿豈-﫿]")
+
+SUMMARY_PROMPT = (
+    "下面是一段对话的已有摘要和之后新增的对话。请把它们合并成一段新的摘要，"
+    "保留用户的目标、已确认的事实、数字和型号、尚未解决的问题，不超过 {max_tokens} 个 token。\n\n"
+    "已有摘要:\n{summary}\n\n新增对话:\n{dialogue}\n\n新的摘要:"
+)
+
+
+def count_tokens(text: str) -> int:
+    """有 tiktoken 时精确计数；否则按中文一字一 token、其余约 4 个字符一 token 估算"""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: BaseMessage) -> int:
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return count_tokens(content) + 4  # 每条消息的角色等固定开销
+
+
+def _summary_session(session_id: str) -> str:
+    return f"{session_id}::summary"
+
+
+class RollingSummarizer:
+    """
+    后台线程里更新摘要；同一个会话同时只有一个摘要任务，新的溢出消息下一轮再合并。
+    线程池和进行中的会话集合是进程级的(Streamlit 每次重跑脚本都会新建 summarizer)
+    """
+
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+    running: Set[str] = set()
+    lock = threading.Lock()
+
+    def __init__(self, llm, get_history: Callable[[str], BaseChatMessageHistory],
+                 max_tokens: int = HISTORY_SUMMARY_TOKENS):
+        self.llm = llm
+        self.get_history = get_history
+        self.max_tokens = max_tokens
+
+    def load(self, session_id: str):
+        """返回 (摘要文本, 覆盖到的最后一条消息 id)"""
+        stored = self.get_history(_summary_session(session_id)).messages
+        if not stored:
+            return "", None
+        return stored[-1].content, stored[-1].additional_kwargs.get("upto")
+
+    def schedule(self, session_id: str, summary: str, overflow: List[BaseMessage]):
+        with self.lock:
+            if session_id in self.running:
+                return
+            self.running.add(session_id)
+        self.pool.submit(self._run, session_id, summary, overflow)
+
+    def _run(self, session_id: str, summary: str, overflow: List[BaseMessage]):
+        try:
+            dialogue = "\n".join(
+                f"{'用户' if isinstance(m, HumanMessage) else '助手'}: {m.content}" for m in overflow
+            )
+            result = self.llm.invoke(SUMMARY_PROMPT.format(
+                max_tokens=self.max_tokens, summary=summary or "(无)", dialogue=dialogue
+            ))
+            text = getattr(result, "content", result)
+            store = self.get_history(_summary_session(session_id))
+            store.clear()
+            store.add_messages([SystemMessage(content=text, additional_kwargs={"upto": overflow[-1].id})])
+        except Exception as e:
+            print(f"⚠️ 会话摘要更新失败 {session_id}: {e}")
+        finally:
+            with self.lock:
+                self.running.discard(session_id)
+
+
+class WindowedChatHistory(BaseChatMessageHistory):
+    """
+    包装底层历史: messages 只返回 [摘要] + 预算内的最近消息；add_messages 原样写入底层。
+    窗口放不下、又还没进摘要的消息交给后台摘要任务
+    """
+
+    def __init__(self, session_id: str, history: BaseChatMessageHistory, summarizer: Optional[RollingSummarizer],
+                 budget: int = HISTORY_TOKEN_BUDGET):
+        self.session_id = session_id
+        self.history = history
+        self.summarizer = summarizer
+        self.budget = budget
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        messages = self.history.messages
+        summary, upto = self.summarizer.load(self.session_id) if self.summarizer else ("", None)
+        ids = [m.id for m in messages]
+        # 摘要覆盖的消息可能已经被历史条数上限裁掉，这时剩下的都是没进摘要的
+        pending = messages[ids.index(upto) + 1:] if upto is not None and upto in ids else messages
+
+        budget = self.budget - (count_tokens(summary) if summary else 0)
+        start = len(pending)
+        while start > 0 and message_tokens(pending[start - 1]) <= budget:
+            budget -= message_tokens(pending[start - 1])
+            start -= 1
+        window, overflow = pending[start:], pending[:start]
+        if overflow and self.summarizer is not None:
+            self.summarizer.schedule(self.session_id, summary, overflow)
+
+        head = [SystemMessage(content=f"之前对话的摘要:\n{summary}")] if summary else []
+        return head + list(window)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        # 摘要按消息 id 记录覆盖位置，写入前补上 id
+        for message in messages:
+            if message.id is None:
+                message.id = uuid.uuid4().hex
+        self.history.add_messages(messages)
+
+    def clear(self) -> None:
+        self.history.clear()
+        if self.summarizer is not None:
+            self.summarizer.get_history(_summary_session(self.session_id)).clear()
+
+
+def windowed_history_getter(get_history: Callable[[str], BaseChatMessageHistory], llm=None,
+                            budget: int = HISTORY_TOKEN_BUDGET, summary_tokens: int = HISTORY_SUMMARY_TOKENS):
+    """
+    包装 get_session_history: 返回的历史对象只给出预算内的窗口。
+    llm 为 None 时不做摘要，窗口外的消息直接丢弃
+    """
+    summarizer = RollingSummarizer(llm, get_history, max_tokens=summary_tokens) if llm is not None else None
+
+    def get_session_history(session_id: str) -> BaseChatMessageHistory:
+        return WindowedChatHistory(session_id, get_history(session_id), summarizer, budget=budget)
+
+    return get_session_history
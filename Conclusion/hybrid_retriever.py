@@ -0,0 +1,646 @@
+# hybrid_retriever.py
+# 混合检索: BM25 倒排索引(稀疏) + FAISS 向量检索(稠密)，用 RRF(倒数排名融合)合并两路结果。
+# 型号、编号这类精确字符串靠 BM25 命中，语义相近的问法靠向量命中。
+# 倒排索引和向量库用同一套文档块 id，入库/删除时同步增量更新。
+# 保存时倒排表写成 generation 里的 bm25.* 列(见 MmapBM25Index)，启动和重新映射时直接映射，不重新分词。
+# 分层索引(见 snapshots.IndexState)的 base 层和 delta 层各自检索，按距离/BM25 分数合并成一个结果
+import os
+import re
+import sys
+import json
+import math
+import hashlib
+import time
+import heapq
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+import faiss
+
+from ann_index import filtered_search
+from mmap_store import StringColumn
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:  # 没装 jieba 时退回按字二元切分
+    jieba = None
+
+# 连续的英文/数字(含 - _ .)算一个词，型号如 "XJ-2000" 不会被拆开；中文按字切
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[\-_.][a-z0-9]+)*|[一-鿿]+")
+_CJK_RE = re.compile(r"[一-鿿]")
+BM25_COLUMNS = "bm25.json"
+
+
+def _term_hash(term: str) -> int:
+    """词表按这个 64 位哈希排序，查词是对哈希列的一次二分查找"""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+def _cjk_bigrams(run: str) -> List[str]:
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text: str) -> List[str]:
+    """中英混合分词: 英文/数字按词，中文有 jieba 用 jieba 搜索模式，否则按字二元切分"""
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if not _CJK_RE.match(run):
+            tokens.append(run)
+        elif jieba is not None:
+            tokens.extend(w for w in jieba.lcut_for_search(run) if w.strip())
+        else:
+            tokens.extend(_cjk_bigrams(run))
+    return tokens
+
+
+class BM25Index:
+    """
+    增量维护的 BM25 倒排索引:
+        index.add(ids, texts) / index.delete(ids)
+        index.search(query, k) -> [(id, score), ...]
+    倒排表是 词 -> {文档号: 词频}，删除时按正排表只清理该文档出现过的词。
+    发布之后不再修改；要修改先 copy()，只改副本。save() 写成 MmapBM25Index 能映射的列
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, max_df_ratio: float = 0.5):
+        self.k1 = k1
+        self.b = b
+        # 出现在超过这个比例文档里的词(的、是、什么...)idf 接近 0，查询时跳过，避免遍历超长倒排表
+        self.max_df_ratio = max_df_ratio
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_terms: Dict[int, Tuple[str, ...]] = {}
+        self.doc_len: Dict[int, int] = {}
+        self.id_to_doc: Dict[str, int] = {}
+        self.doc_to_id: Dict[int, str] = {}
+        self.total_len = 0
+        self._next_doc = 0
+        # 本对象独占的倒排表；copy() 之后倒排表和原对象共享，第一次修改某个词时才复制那一张
+        self._owned: Set[str] = set()
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, ids: List[str], texts: List[str]):
+        for _id, text in zip(ids, texts):
+            if _id in self.id_to_doc:
+                self.delete([_id])
+            doc = self._next_doc
+            self._next_doc += 1
+            tf = Counter(tokenize(text))
+            for term, count in tf.items():
+                self._posting_for_write(term)[doc] = count
+            length = sum(tf.values())
+            self.doc_terms[doc] = tuple(tf)
+            self.doc_len[doc] = length
+            self.total_len += length
+            self.id_to_doc[_id] = doc
+            self.doc_to_id[doc] = _id
+
+    def delete(self, ids: Iterable[str]):
+        for _id in ids:
+            doc = self.id_to_doc.pop(_id, None)
+            if doc is None:
+                continue
+            for term in self.doc_terms.pop(doc):
+                posting = self._posting_for_write(term)
+                del posting[doc]
+                if not posting:
+                    del self.postings[term]
+                    self._owned.discard(term)
+            self.total_len -= self.doc_len.pop(doc)
+            del self.doc_to_id[doc]
+
+    def _posting_for_write(self, term: str) -> Dict[int, int]:
+        if term not in self._owned:
+            self.postings[term] = dict(self.postings.get(term, ()))
+            self._owned.add(term)
+        return self.postings[term]
+
+    def copy(self) -> "BM25Index":
+        """
+        写时复制: 只复制外层字典，各个词的倒排表共享，副本修改某个词时再复制那一张。
+        原对象不做任何改动(它可能已经发布、正被读者使用)，之后也不能再修改它
+        """
+        other = BM25Index(self.k1, self.b, self.max_df_ratio)
+        other.postings = dict(self.postings)
+        other.doc_terms = dict(self.doc_terms)
+        other.doc_len = dict(self.doc_len)
+        other.id_to_doc = dict(self.id_to_doc)
+        other.doc_to_id = dict(self.doc_to_id)
+        other.total_len = self.total_len
+        other._next_doc = self._next_doc
+        return other
+
+    def merge(self, other: "BM25Index"):
+        """把另一个索引的文档原样并进来，不重新分词(delta 层合并进 base 时用)"""
+        self.delete([_id for _id in other.id_to_doc if _id in self.id_to_doc])
+        for _id, other_doc in other.id_to_doc.items():
+            doc = self._next_doc
+            self._next_doc += 1
+            terms = other.doc_terms[other_doc]
+            for term in terms:
+                self._posting_for_write(term)[doc] = other.postings[term][other_doc]
+            self.doc_terms[doc] = terms
+            self.doc_len[doc] = other.doc_len[other_doc]
+            self.total_len += self.doc_len[doc]
+            self.id_to_doc[_id] = doc
+            self.doc_to_id[doc] = _id
+
+    def clear(self):
+        self.__init__(self.k1, self.b, self.max_df_ratio)
+
+    def save(self, path: str, ids: List[str]):
+        """
+        写成 path 下的 bm25.* 列(见 MmapBM25Index)，文档号换成 ids 里的位置，和同一目录的向量位置对齐；
+        不在 ids 里的文档不写，ids 里没有正文的位置长度记为 -1
+        """
+        position = {_id: i for i, _id in enumerate(ids)}
+        doc_len = np.full(len(position), -1, dtype=np.int32)
+        positions = {}
+        for _id, doc in self.id_to_doc.items():
+            p = position.get(_id)
+            if p is not None:
+                positions[doc] = p
+                doc_len[p] = self.doc_len[doc]
+        terms = sorted(self.postings, key=_term_hash)
+        bounds = np.zeros(len(terms) + 1, dtype=np.int64)
+        docs, tfs = [], []
+        for row, term in enumerate(terms):
+            posting = sorted((positions[doc], tf) for doc, tf in self.postings[term].items() if doc in positions)
+            docs.extend(p for p, _ in posting)
+            tfs.extend(tf for _, tf in posting)
+            bounds[row + 1] = len(docs)
+        _write_bm25(path, self, terms, bounds, np.array(docs, dtype=np.int32), np.array(tfs, dtype=np.int32),
+                    doc_len)
+
+    def memory_bytes(self) -> int:
+        """粗略估算占用的内存: 倒排表每项约 100 字节(字典项 + int 对象)，每个文档块的正排等约 300 字节"""
+        return sum(len(p) for p in self.postings.values()) * 100 + len(self.doc_len) * 300
+
+    def doc_freq(self, term: str) -> int:
+        return len(self.postings.get(term, ()))
+
+    def score(self, weights: Dict[str, float], avg_len: float, k: int,
+              selection=None) -> List[Tuple[str, float]]:
+        """
+        按给定的 idf(weights: 词 -> idf)和平均长度打分，返回前 k 条 (id, 分数)。
+        selection 给出时只保留它允许的文档块(元数据过滤、已删除的墓碑)
+        """
+        scores: Dict[int, float] = {}
+        for term, idf in weights.items():
+            for doc, tf in self.postings.get(term, {}).items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc] / avg_len)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        candidates = scores.items()
+        if selection is not None:
+            candidates = ((doc, score) for doc, score in candidates if selection.allows_id(self.doc_to_id[doc]))
+        top = heapq.nlargest(k, candidates, key=lambda item: item[1])
+        return [(self.doc_to_id[doc], score) for doc, score in top]
+
+    def search(self, query: str, k: int = 10, selection=None) -> List[Tuple[str, float]]:
+        """selection(见 metadata_index)给出时只在它选中的文档块里取前 k 条"""
+        return bm25_search([(self, selection)], query, k)
+
+    @classmethod
+    def from_vector_db(cls, vector_db, batch_size: int = 1000, **kwargs) -> "BM25Index":
+        """从现有向量库的文档块建立倒排索引(启动时调用一次，之后增量维护)"""
+        index = cls(**kwargs)
+        index.sync_with(vector_db, batch_size=batch_size)
+        return index
+
+    @classmethod
+    def from_docstore(cls, ids: List[str], docstore, batch_size: int = 1000, **kwargs) -> "BM25Index":
+        """读出这些文档块的正文建立倒排索引(例如加载 delta 层时)"""
+        index = cls(**kwargs)
+        index._add_from(ids, docstore, batch_size)
+        return index
+
+    def _add_from(self, ids: List[str], docstore, batch_size: int = 1000) -> int:
+        added = 0
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            if hasattr(docstore, "mget"):
+                docs = docstore.mget(batch)
+            else:
+                docs = [docstore.search(_id) for _id in batch]
+            pairs = [(_id, d.page_content) for _id, d in zip(batch, docs) if hasattr(d, "page_content")]
+            self.add([p[0] for p in pairs], [p[1] for p in pairs])
+            added += len(pairs)
+        return added
+
+    def sync_with(self, vector_db, batch_size: int = 1000) -> Tuple[int, int]:
+        """
+        和向量库的文档块对齐: 向量库里已经没有的删掉，新出现的读出正文加进来，
+        已有的不重新分词。返回 (新增数, 删除数)
+        """
+        if vector_db is None:
+            removed = len(self.id_to_doc)
+            self.delete(list(self.id_to_doc))
+            return 0, removed
+        ids = list(vector_db.index_to_docstore_id.values())
+        live = set(ids)
+        stale = [_id for _id in self.id_to_doc if _id not in live]
+        self.delete(stale)
+        added = self._add_from([_id for _id in ids if _id not in self.id_to_doc], vector_db.docstore, batch_size)
+        return added, len(stale)
+
+
+def _write_bm25(path: str, index, terms: List[str], bounds: np.ndarray, docs: np.ndarray, tfs: np.ndarray,
+                doc_len: np.ndarray):
+    StringColumn.write(path, "bm25.terms", terms)
+    hashes = np.array([_term_hash(t) for t in terms], dtype=np.int64)
+    # 每个词的最大词频、最短文档长度，查询时据此算这个词分数的上界(见 MmapBM25Index.score)
+    max_tf = np.zeros(len(terms), dtype=np.int32)
+    min_len = np.zeros(len(terms), dtype=np.int32)
+    nonempty = bounds[1:] > bounds[:-1]
+    if nonempty.any():
+        starts = bounds[:-1][nonempty]
+        max_tf[nonempty] = np.maximum.reduceat(tfs, starts)
+        min_len[nonempty] = np.minimum.reduceat(doc_len[docs], starts)
+    columns = {"hashes": hashes, "postings": bounds, "max_tf": max_tf, "min_len": min_len,
+               "docs": docs, "tfs": tfs, "doc_len": doc_len}
+    for name, column in columns.items():
+        np.save(os.path.join(path, f"bm25.{name}.npy"), column)
+    with open(os.path.join(path, BM25_COLUMNS), "w", encoding="utf-8") as f:
+        json.dump({
+            "k1": index.k1,
+            "b": index.b,
+            "max_df_ratio": index.max_df_ratio,
+            "docs": int((doc_len >= 0).sum()),
+            "total_len": int(doc_len[doc_len > 0].sum()),
+        }, f)
+
+
+class MmapBM25Index:
+    """
+    BM25Index.save() 写出的倒排表，内存映射打开、只读: 词表按哈希排好(bm25.hashes.npy，二分查找)，
+    每个词的 (位置, 词频) 连续存放(bm25.postings.npy 是各个词的起止偏移)，打分用 numpy 整段计算。
+    多个 worker 映射同一个 generation 时共享页缓存，启动不用读正文、不用重新分词。
+    ids 是位置 -> 文档块 id(和同一目录的向量位置一致)。要修改先 copy()，得到普通的 BM25Index
+    """
+
+    def __init__(self, path: str, ids, meta: dict):
+        self.ids = ids
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+        self.max_df_ratio = meta["max_df_ratio"]
+        self.total_len = meta["total_len"]
+        self._docs = meta["docs"]
+        self.terms = StringColumn(path, "bm25.terms")
+        # 映射的数组当普通 ndarray 用(仍然是映射)，省掉 np.memmap 每次切片的额外开销
+        columns = {
+            name: np.load(os.path.join(path, f"bm25.{name}.npy"), mmap_mode="r").view(np.ndarray)
+            for name in ("hashes", "postings", "max_tf", "min_len", "docs", "tfs", "doc_len")
+        }
+        self.hashes = columns["hashes"]
+        self.bounds = columns["postings"]
+        self.max_tf = columns["max_tf"]
+        self.min_len = columns["min_len"]
+        self.docs = columns["docs"]
+        self.tfs = columns["tfs"]
+        self.doc_len = columns["doc_len"]
+
+    @classmethod
+    def load(cls, path: str, ids) -> Optional["MmapBM25Index"]:
+        """目录里没有倒排列(旧版本保存的向量库)返回 None"""
+        meta_file = os.path.join(path, BM25_COLUMNS)
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file, "r", encoding="utf-8") as f:
+            return cls(path, ids, json.load(f))
+
+    def __len__(self):
+        return self._docs
+
+    @property
+    def size(self) -> int:
+        """位置数(和同一目录的向量条数一致)"""
+        return len(self.doc_len)
+
+    def _row(self, term: str) -> Optional[int]:
+        h = _term_hash(term)
+        row = int(np.searchsorted(self.hashes, h))
+        # 哈希相同的词(几乎不会有)挨在一起，逐个比对原词
+        while row < len(self.hashes) and self.hashes[row] == h:
+            if self.terms[row] == term:
+                return row
+            row += 1
+        return None
+
+    def doc_freq(self, term: str) -> int:
+        row = self._row(term)
+        return 0 if row is None else int(self.bounds[row + 1] - self.bounds[row])
+
+    def score(self, weights: Dict[str, float], avg_len: float, k: int,
+              selection=None) -> List[Tuple[str, float]]:
+        """
+        同 BM25Index.score，selection 的位图直接按位置判断。按 MaxScore 剪枝: 每个词的分数上界由它的
+        最大词频和最短文档长度算出，词按上界从高到低排，先只在上界高(一般是倒排表短)的几个词的文档里算完整分数；
+        剩下的词上界之和不超过当前第 k 名时，其余文档不可能进前 k，
+        常见词的长倒排表只在候选文档上二分查词频，不整段遍历
+        """
+        lists, upper = [], []
+        for term, idf in weights.items():
+            row = self._row(term)
+            if row is None or self.bounds[row + 1] == self.bounds[row]:
+                continue
+            lists.append((idf, int(self.bounds[row]), int(self.bounds[row + 1])))
+            max_tf = float(self.max_tf[row])
+            upper.append(idf * max_tf * (self.k1 + 1) /
+                         (max_tf + self.k1 * (1 - self.b + self.b * float(self.min_len[row]) / avg_len)))
+        if not lists:
+            return []
+        order = np.argsort(upper)[::-1]
+        lists = [lists[i] for i in order]
+        remaining = np.cumsum([upper[i] for i in order][::-1])[::-1].tolist() + [0.0]
+        lengths = np.cumsum([end - start for _, start, end in lists])
+        for e in range(1, len(lists) + 1):
+            # 候选已经很多(常见词)时剪枝省不了什么，直接整段累加
+            if e == len(lists) or lengths[e - 1] > self.size // 16:
+                docs, scores = self._accumulate(lists, avg_len)
+                docs, scores = self._allowed(docs, scores, selection)
+                break
+            if e == 1:
+                _, start, end = lists[0]
+                docs = self.docs[start:end]
+            else:
+                docs = np.unique(np.concatenate([self.docs[start:end] for _, start, end in lists[:e]]))
+            docs, _ = self._allowed(docs, None, selection)
+            if len(docs) < k:
+                continue
+            scores = self._score_docs(docs, lists, avg_len)
+            if np.partition(scores, len(scores) - k)[len(scores) - k] >= remaining[e]:
+                break
+        if len(docs) > k:
+            top = np.argpartition(-scores, k)[:k]
+            docs, scores = docs[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return [(self.ids[int(doc)], float(score)) for doc, score in zip(docs[order], scores[order])]
+
+    @staticmethod
+    def _allowed(docs: np.ndarray, scores: Optional[np.ndarray], selection):
+        if selection is None:
+            return docs, scores
+        keep = ((selection.bitmap[docs >> 3] >> (docs & 7).astype(np.uint8)) & 1).astype(bool)
+        return docs[keep], scores[keep] if scores is not None else None
+
+    def _term_scores(self, idf: float, tf: np.ndarray, docs: np.ndarray, avg_len: float) -> np.ndarray:
+        tf = tf.astype(np.float64)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / avg_len)
+        return idf * tf * (self.k1 + 1) / (tf + norm)
+
+    def _score_docs(self, docs: np.ndarray, lists, avg_len: float) -> np.ndarray:
+        """候选文档的完整分数: 每个词的倒排表按位置有序，二分查候选文档的词频"""
+        total = np.zeros(len(docs))
+        for idf, start, end in lists:
+            posting = self.docs[start:end]
+            at = np.minimum(np.searchsorted(posting, docs), len(posting) - 1)
+            tf = np.where(posting[at] == docs, self.tfs[start:end][at], 0)
+            total += self._term_scores(idf, tf, docs, avg_len)
+        return total
+
+    def _accumulate(self, lists, avg_len: float):
+        """不剪枝: 所有词的倒排表整段累加"""
+        parts = [(self.docs[start:end], self._term_scores(idf, self.tfs[start:end], self.docs[start:end], avg_len))
+                 for idf, start, end in lists]
+        if len(parts) == 1:
+            return parts[0]
+        if sum(len(d) for d, _ in parts) > self.size // 16:
+            # 倒排表很长(常见词)时累加到稠密数组，比排序去重快；同一个词的位置不重复，可以直接 +=
+            dense = np.zeros(self.size)
+            for d, sc in parts:
+                dense[d] += sc
+            docs = np.flatnonzero(dense)
+            return docs, dense[docs]
+        docs, inverse = np.unique(np.concatenate([d for d, _ in parts]), return_inverse=True)
+        return docs, np.bincount(inverse, weights=np.concatenate([sc for _, sc in parts]))
+
+    def search(self, query: str, k: int = 10, selection=None) -> List[Tuple[str, float]]:
+        return bm25_search([(self, selection)], query, k)
+
+    def save(self, path: str, ids=None):
+        """原样写到另一个目录(位置不变，ids 只为和 BM25Index.save 的参数一致)"""
+        _write_bm25(path, self, [self.terms[i] for i in range(len(self.terms))],
+                    np.asarray(self.bounds), np.asarray(self.docs), np.asarray(self.tfs), np.asarray(self.doc_len))
+
+    def copy(self) -> BM25Index:
+        """展开成可以修改的 BM25Index(文档号就是位置)；要遍历整个倒排表，只在写入、合并时用"""
+        index = BM25Index(self.k1, self.b, self.max_df_ratio)
+        docs, tfs, bounds = self.docs.tolist(), self.tfs.tolist(), self.bounds.tolist()
+        doc_terms: Dict[int, List[str]] = {}
+        for row in range(len(self.terms)):
+            start, end = bounds[row], bounds[row + 1]
+            if start == end:
+                continue
+            term = self.terms[row]
+            index.postings[term] = dict(zip(docs[start:end], tfs[start:end]))
+            index._owned.add(term)
+            for doc in docs[start:end]:
+                doc_terms.setdefault(doc, []).append(term)
+        for doc, length in enumerate(self.doc_len.tolist()):
+            if length < 0:
+                continue
+            _id = self.ids[doc]
+            index.doc_terms[doc] = tuple(doc_terms.get(doc, ()))
+            index.doc_len[doc] = length
+            index.id_to_doc[_id] = doc
+            index.doc_to_id[doc] = _id
+        index.total_len = self.total_len
+        index._next_doc = self.size
+        return index
+
+    def memory_bytes(self) -> int:
+        """映射的列按文件大小计(多个 worker 共享同一份页缓存)"""
+        return sum(column.nbytes for column in (self.hashes, self.bounds, self.max_tf, self.min_len,
+                                                self.docs, self.tfs, self.doc_len))
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60,
+                           weights: Optional[List[float]] = None) -> List[Tuple[str, float]]:
+    """RRF: score(d) = Σ w_i / (k + rank_i(d))，只看排名，不用对两路分数做归一化"""
+    weights = weights or [1.0] * len(rankings)
+    fused: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, _id in enumerate(ranking, start=1):
+            fused[_id] = fused.get(_id, 0.0) + weight / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def bm25_search(layers: List[Tuple[object, object]], query: str, k: int = 10) -> List[Tuple[str, float]]:
+    """
+    多层倒排索引一起检索，layers 是 [(倒排索引, selection 或 None), ...]。
+    文档数、平均长度和 df 按所有层合计，各层的分数可以直接比较；
+    base 层里已删除(墓碑)的文档在合并之前仍然计入这些统计，只是不会被返回
+    """
+    layers = [(index, selection) for index, selection in layers if len(index)]
+    n = sum(len(index) for index, _ in layers)
+    if n == 0:
+        return []
+    first = layers[0][0]
+    avg_len = sum(index.total_len for index, _ in layers) / n or 1.0
+    weights = {}
+    for term in set(tokenize(query)):
+        df = sum(index.doc_freq(term) for index, _ in layers)
+        # 出现在太多文档里的词 idf 接近 0，跳过，避免遍历超长倒排表
+        if not df or (n > 100 and df > first.max_df_ratio * n):
+            continue
+        weights[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+    if not weights:
+        return []
+    hits = []
+    for index, selection in layers:
+        if selection is None or selection.count:
+            hits.extend(index.score(weights, avg_len, k, selection))
+    return heapq.nlargest(k, hits, key=lambda item: item[1])
+
+
+class SearchLayer(NamedTuple):
+    """
+    分层索引里的一层(见 snapshots.IndexState.layers): 向量索引(faiss 索引或 delta 层的 DeltaVectors)、
+    位置 -> 文档块 id、BM25 倒排索引，以及这一层的过滤结果(None 表示整层都可以检索)
+    """
+    index: object
+    ids: object
+    bm25: object
+    selection: object = None
+
+
+def _search(index, matrix: np.ndarray, k: int, selection=None):
+    """
+    selection(见 metadata_index)给出时把位图作为 IDSelector 传进 faiss，在 ANN 搜索内部过滤；
+    选中的很少时改为精确检索，否则按选中比例放大 nprobe/efSearch(见 ann_index.filtered_search)。
+    delta 层(DeltaVectors)自己实现带位图的精确检索
+    """
+    if not isinstance(index, faiss.Index):
+        return index.search(matrix, k, selection)
+    if selection is None:
+        return index.search(matrix, k)
+    return filtered_search(index, matrix, k, selection.selector, selection.count)
+
+
+def _query_matrix(vector_db, embeddings: List[List[float]]) -> np.ndarray:
+    matrix = np.array(embeddings, dtype=np.float32)
+    if vector_db._normalize_L2:
+        faiss.normalize_L2(matrix)
+    return matrix
+
+
+def _layer_hits(layer: SearchLayer, matrix: np.ndarray, k: int) -> List[List[Tuple[str, float]]]:
+    if layer.selection is not None and layer.selection.count == 0:
+        return [[] for _ in matrix]
+    scores, indices = _search(layer.index, matrix, k, layer.selection)
+    return [
+        [(layer.ids[int(i)], float(score)) for i, score in zip(row_ids, row_scores) if i != -1]
+        for row_ids, row_scores in zip(indices, scores)
+    ]
+
+
+def batch_dense_search(vector_db, embeddings: List[List[float]], k: int,
+                       selection=None) -> List[List[Tuple[str, float]]]:
+    """多个查询向量拼成一个矩阵，一次 index.search 完成，返回每个查询的 [(文档块 id, 距离), ...]"""
+    if vector_db is None or vector_db.index.ntotal == 0 or not embeddings:
+        return [[] for _ in embeddings]
+    layer = SearchLayer(vector_db.index, vector_db.index_to_docstore_id, None, selection)
+    return _layer_hits(layer, _query_matrix(vector_db, embeddings), k)
+
+
+def layered_dense_search(vector_db, layers: List[SearchLayer], embeddings: List[List[float]],
+                         k: int) -> List[List[Tuple[str, float]]]:
+    """
+    各层分别取前 k 条再按距离合并(内积越大越近，L2 越小越近)，返回每个查询的 [(文档块 id, 距离), ...]。
+    vector_db 是 base 层的 FAISS 对象，提供距离类型和是否归一化
+    """
+    if vector_db is None or not embeddings:
+        return [[] for _ in embeddings]
+    matrix = _query_matrix(vector_db, embeddings)
+    per_layer = [_layer_hits(layer, matrix, k) for layer in layers if len(layer.ids)]
+    if len(per_layer) == 1:
+        return per_layer[0]
+    descending = vector_db.index.metric_type == faiss.METRIC_INNER_PRODUCT
+    return [
+        sorted((hit for hits in rows for hit in hits), key=lambda item: item[1], reverse=descending)[:k]
+        for rows in zip(*per_layer)
+    ] if per_layer else [[] for _ in embeddings]
+
+
+def hybrid_search(vector_db, layers: List[SearchLayer], query: str, k: int = 3, fetch_k: int = 20,
+                  rrf_k: int = 60, weights: Optional[List[float]] = None,
+                  embedding: Optional[List[float]] = None, timings: Optional[dict] = None):
+    """
+    两路各取 fetch_k 条，RRF 融合后返回前 k 个 Document；timings 不为 None 时记录各阶段耗时(ms)。
+    layers 是分层索引的各层(带各自的过滤结果)，两路都只在选中的文档块里检索
+    """
+    if vector_db is None:
+        return []
+    start = time.perf_counter()
+    if embedding is None:
+        embedding = vector_db.embedding_function.embed_query(query)
+    dense = [_id for _id, _ in layered_dense_search(vector_db, layers, [embedding], fetch_k)[0]]
+    dense_done = time.perf_counter()
+    sparse = [_id for _id, _ in bm25_search([(layer.bm25, layer.selection) for layer in layers], query, fetch_k)]
+    sparse_done = time.perf_counter()
+    fused = reciprocal_rank_fusion([dense, sparse], k=rrf_k, weights=weights)[:k]
+    ids = [_id for _id, _ in fused]
+    docstore = vector_db.docstore
+    fetched = docstore.mget(ids) if hasattr(docstore, "mget") else [docstore.search(_id) for _id in ids]
+    docs = [doc for doc in fetched if hasattr(doc, "page_content")]
+    if timings is not None:
+        timings["dense_ms"] = (dense_done - start) * 1000
+        timings["sparse_ms"] = (sparse_done - dense_done) * 1000
+        timings["fetch_ms"] = (time.perf_counter() - sparse_done) * 1000
+    return docs
+
+
+if __name__ == "__main__":
+    # python hybrid_retriever.py bench [文档块数]: 词频按 Zipf 分布(s≈1.1，接近真实语料)的中文词 + 型号，
+    # 查询也按同样的分布抽常见词，测内存里的 BM25Index 和映射打开的 MmapBM25Index 单次查询耗时
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        import tempfile
+
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+        rng = np.random.default_rng(0)
+        chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+        vocab = list(dict.fromkeys("".join(rng.choice(chars, 2)) for _ in range(60_000)))
+        freq = 1.0 / np.arange(1, len(vocab) + 1) ** 1.1
+        freq /= freq.sum()
+
+        sampled = iter(rng.choice(len(vocab), n * 64 + 1000, p=freq).tolist())
+
+        def words(count: int) -> str:
+            # 词之间用空格隔开，没有 jieba 时按字二元切分也是一个词一个 token
+            return " ".join(vocab[next(sampled)] for _ in range(count))
+
+        start = time.perf_counter()
+        index = BM25Index()
+        ids = []
+        for base in range(0, n, 10_000):
+            size = min(10_000, n - base)
+            batch = [str(base + i) for i in range(size)]
+            index.add(batch, [words(60) + f" 型号 XJ-{rng.integers(100000)}" for _ in range(size)])
+            ids.extend(batch)
+        print(f"建索引: {n} 条, {time.perf_counter() - start:.1f}s, 词表: {len(index.postings)}")
+        queries = [f"{words(3)} 型号 XJ-{q} 是什么" for q in rng.integers(100000, size=200)]
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            index.save(tmp, ids)
+            mapped = MmapBM25Index.load(tmp, ids)
+            print(f"保存 + 映射: {time.perf_counter() - start:.1f}s")
+            for name, idx in (("BM25Index", index), ("MmapBM25Index", mapped)):
+                latencies = []
+                for q in queries:
+                    start = time.perf_counter()
+                    idx.search(q, 20)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                # 常见词的倒排表很长，耗时分布偏斜，看 p50/p99
+                print(f"{name} 查询: 平均 {np.mean(latencies):.3f} ms, p50 {np.percentile(latencies, 50):.3f} ms, "
+                      f"p99 {np.percentile(latencies, 99):.3f} ms")
+            # 同分的文档先后顺序可能不同，按分数比较
+            agree = sum(np.allclose([sc for _, sc in index.search(q, 20)], [sc for _, sc in mapped.search(q, 20)])
+                        for q in queries)
+            print(f"两种索引前 20 条分数一致: {agree}/{len(queries)}")
+    else:
+        print("用法: python hybrid_retriever.py bench [文档块数]")
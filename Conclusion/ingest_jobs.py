@@ -0,0 +1,167 @@
+# ingest_jobs.py
+# 后台入库任务队列: /upload 只保存文件并返回任务 id，解析/切分/embedding/写索引在后台执行。
+# 任务在同一个执行器里串行运行，索引的修改不会互相踩；进度(已解析文件数、已向量化块数、预计剩余时间)
+# 通过 /jobs/{id} 查询，或者通过 /jobs/{id}/events 以 SSE 流的方式推送
+import json
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from executors import LoopThreadExecutor
+from sse import format_event
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+
+class IngestJob:
+    """一个入库任务的进度，入库代码通过 start/file_parsed/embedded 上报"""
+
+    def __init__(self, files: List[str], namespace: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.files = files
+        self.namespace = namespace
+        self.status = "queued"
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.files_total = len(files)
+        self.files_parsed = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.result = None
+        self.error: Optional[str] = None
+        self.revision = 0  # 每次进度变化加一，SSE 推送据此判断是否有更新
+        self.lock = threading.Lock()
+
+    def _touch(self):
+        self.revision += 1
+
+    def start(self, files_total: Optional[int] = None):
+        with self.lock:
+            if files_total is not None:
+                self.files_total = files_total
+            self._touch()
+
+    def file_parsed(self, path: str, chunks: int):
+        with self.lock:
+            self.files_parsed += 1
+            self.chunks_total += chunks
+            self._touch()
+
+    def embedded(self, chunks: int):
+        with self.lock:
+            self.chunks_embedded += chunks
+            # 流式重建时解析和 embedding 交织进行，块总数只能边做边累加
+            self.chunks_total = max(self.chunks_total, self.chunks_embedded)
+            self._touch()
+
+    def eta_seconds(self) -> Optional[float]:
+        """按目前的 embedding 速度估算剩余时间；还没有进度时返回 None"""
+        if self.status != "running" or not self.started or not self.chunks_embedded:
+            return None
+        elapsed = time.time() - self.started
+        remaining = max(0, self.chunks_total - self.chunks_embedded)
+        return round(remaining * elapsed / self.chunks_embedded, 1)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "namespace": self.namespace,
+                "files": self.files,
+                "files_total": self.files_total,
+                "files_parsed": self.files_parsed,
+                "chunks_total": self.chunks_total,
+                "chunks_embedded": self.chunks_embedded,
+                "eta_seconds": self.eta_seconds(),
+                "queued_seconds": round((self.started or time.time()) - self.created, 2),
+                "elapsed_seconds": round((self.finished or time.time()) - self.started, 2) if self.started else None,
+                "result": self.result,
+                "error": self.error,
+            }
+
+
+class IngestJobQueue:
+    """
+    用法:
+        jobs = IngestJobQueue(run_job)                # run_job(job) 是协程，真正做入库
+        job = jobs.submit(["a.pdf"], namespace="acme")  # 立即返回
+        jobs.get(job.id).to_dict()
+    任务按提交顺序在同一个后台事件循环线程里逐个执行
+    """
+
+    def __init__(self, run_job: Callable[[IngestJob], Awaitable], max_queue: int = 32,
+                 keep_finished: int = 200, executor: Optional[LoopThreadExecutor] = None):
+        self.run_job = run_job
+        self.executor = executor or LoopThreadExecutor("ingest-jobs", max_queue=max_queue)
+        self.keep_finished = keep_finished
+        self.jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, files: List[str], namespace: Optional[str] = None) -> IngestJob:
+        job = IngestJob(files, namespace)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._trim()
+        # 在后台执行器里排队；排队已满时抛 ExecutorBusy
+        try:
+            self.executor.submit(self._run, job)
+        except Exception:
+            with self.lock:
+                del self.jobs[job.id]
+            raise
+        return job
+
+    async def _run(self, job: IngestJob):
+        job.status = "running"
+        job.started = time.time()
+        job.start()
+        try:
+            job.result = await self.run_job(job)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+            print(f"⚠️ 入库任务失败 {job.id}: {e}")
+        finally:
+            job.finished = time.time()
+            job.start()
+
+    def _trim(self):
+        finished = [j for j in self.jobs.values() if j.status in ("done", "failed")]
+        for job in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job.id]
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    async def events(self, job_id: str, poll: float = 0.5, heartbeat: float = 15.0) -> AsyncIterator[str]:
+        """SSE: 进度有变化就推送一个 progress 事件，结束时推送 done/failed 事件"""
+        job = self.get(job_id)
+        if job is None:
+            yield format_event(json.dumps({"error": "任务不存在"}, ensure_ascii=False), event="error")
+            return
+        seen = -1
+        last_sent = time.monotonic()
+        while True:
+            revision = job.revision
+            finished = job.status in ("done", "failed")
+            if revision != seen or finished:
+                seen = revision
+                last_sent = time.monotonic()
+                yield format_event(
+                    json.dumps(job.to_dict(), ensure_ascii=False, default=str),
+                    event=job.status if finished else "progress",
+                    event_id=f"{job.id}-{revision}",
+                )
+                if finished:
+                    return
+            elif time.monotonic() - last_sent >= heartbeat:
+                last_sent = time.monotonic()
+                yield ": heartbeat\n\n"
+            await asyncio.sleep(poll)
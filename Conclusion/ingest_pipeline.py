@@ -0,0 +1,152 @@
+# ingest_pipeline.py
+# 流式入库管道: 加载 -> 切分 -> embedding -> 写索引
+# 每一级都是生成器，级与级之间用有界队列连接(各自跑在独立线程里)，
+# 任何时刻内存里只有正在解析的几个文件和队列容量那么多的文档/文档块，不会随语料大小增长。
+# 文档块的正文和元数据按批直接写进 chunk_store(sqlite)，不在内存里的 docstore 里攒到保存时
+import uuid
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import faiss
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from parallel_loader import DEFAULT_LOADERS, iter_parallel_load
+
+_DONE = object()
+
+
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def bounded_stage(iterable: Iterable, maxsize: int) -> Iterator:
+    """在后台线程里消费 iterable，通过容量为 maxsize 的队列交给下游；队列满时上游阻塞"""
+    q: queue.Queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_StageError(e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        # 下游提前退出时通知上游线程停止
+        stop.set()
+
+
+def iter_parallel_documents(paths: List[str], loaders=DEFAULT_LOADERS, **kwargs) -> Iterator[Tuple[str, Document]]:
+    """
+    多进程解析(见 parallel_loader)，同时在途的只有 max_workers 个文件。
+    build_rag.py 和 rag_app 的全量重建都从这里取文档，解析失败/超时的文件跳过
+    """
+    for result in iter_parallel_load(paths, loaders=loaders, **kwargs):
+        for doc in result.docs or []:
+            yield result.path, doc
+
+
+def iter_split(docs: Iterable[Tuple[str, Document]], splitter,
+               annotate: Optional[Callable[[str, Document], None]] = None) -> Iterator[Tuple[str, Document]]:
+    """annotate(path, doc) 在切分前补全元数据，切出的文档块都会带上"""
+    for path, doc in docs:
+        if annotate is not None:
+            annotate(path, doc)
+        for chunk in splitter.split_documents([doc]):
+            yield path, chunk
+
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_embedded(batches: Iterable[List[Tuple[str, Document]]], embedder) -> Iterator[Tuple[list, List[List[float]]]]:
+    for batch in batches:
+        vectors = embedder.embed_documents([chunk.page_content for _, chunk in batch])
+        yield batch, vectors
+
+
+def empty_vector_db(embedder, dim: int, docstore, **faiss_kwargs) -> FAISS:
+    """空的 Flat 索引 + 指定的 docstore(例如 chunk_store)，索引类型和 FAISS.from_embeddings 按距离类型选的一致"""
+    distance = faiss_kwargs.get("distance_strategy", DistanceStrategy.EUCLIDEAN_DISTANCE)
+    index = faiss.IndexFlatIP(dim) if distance == DistanceStrategy.MAX_INNER_PRODUCT else faiss.IndexFlatL2(dim)
+    return FAISS(embedder, index, docstore, {}, **faiss_kwargs)
+
+
+class StreamingIngestor:
+    """
+    用法:
+        ingestor = StreamingIngestor(embedder, text_splitter, docstore=get_chunk_store(path))
+        for vector_db, paths, ids, chunks in ingestor.run(docs):
+            ...  # 每写入一批就回调一次，paths/ids/chunks 是这一批文档块的来源文件、向量 id 和文档块本身
+    docstore 是文档块写入的地方(一般是向量库目录的 chunk_store)，每批写完正文就落盘，
+    不在内存里攒全部正文；不给时退回 langchain 的内存 docstore
+    """
+
+    def __init__(self, embedder, splitter, batch_size: int = 128, queue_size: int = 4,
+                 annotate: Optional[Callable[[str, Document], None]] = None, docstore=None, **faiss_kwargs):
+        self.embedder = embedder
+        self.annotate = annotate
+        self.docstore = docstore
+        self.faiss_kwargs = faiss_kwargs  # 新建索引时传给 FAISS，例如 normalize_L2=True
+        self.splitter = splitter
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.chunks = 0
+
+    def run(self, documents: Iterable[Tuple[str, Document]],
+            vector_db: Optional[FAISS] = None) -> Iterator[Tuple[FAISS, List[str], List[str], List[Document]]]:
+        docs = bounded_stage(documents, self.queue_size)
+        chunks = bounded_stage(iter_split(docs, self.splitter, self.annotate), self.queue_size * self.batch_size)
+        embedded = bounded_stage(
+            iter_embedded(iter_batches(chunks, self.batch_size), self.embedder), self.queue_size
+        )
+        self.chunks = 0
+        for batch, vectors in embedded:
+            ids = [str(uuid.uuid4()) for _ in batch]
+            text_embeddings = [(chunk.page_content, vec) for (_, chunk), vec in zip(batch, vectors)]
+            metadatas = [chunk.metadata for _, chunk in batch]
+            if vector_db is None:
+                if self.docstore is None:
+                    vector_db = FAISS.from_embeddings(
+                        text_embeddings, self.embedder, metadatas=metadatas, ids=ids, **self.faiss_kwargs
+                    )
+                else:
+                    vector_db = empty_vector_db(self.embedder, len(vectors[0]), self.docstore, **self.faiss_kwargs)
+                    vector_db.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+            else:
+                vector_db.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+            self.chunks += len(batch)
+            yield vector_db, [path for path, _ in batch], ids, [chunk for _, chunk in batch]
@@ -0,0 +1,107 @@
+# load_test.py
+# 压测: 先测空闲时并发 /chat 的延迟，再在上传(入库)进行中测一遍，对比两者的首字节时间。
+# 检索和入库不在事件循环上执行后，两次结果应该基本持平。
+# 用法(先启动 python rag_app.py api):
+#   python load_test.py [base_url] [并发数] [每轮请求数] [上传文件(可选)]
+# 不指定上传文件时会生成一份约 2MB 的随机文本作为上传内容
+import sys
+import time
+import random
+import asyncio
+import statistics
+from typing import List
+
+import httpx
+
+QUESTIONS = [
+    "产品型号是什么",
+    "这个产品的额定功率是多少",
+    "保修期多长时间",
+    "如何安装",
+    "有哪些注意事项",
+]
+
+
+def _percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _summary(name: str, ttfb: List[float], total: List[float], errors: int) -> str:
+    if not ttfb:
+        return f"{name}: 全部失败 ({errors} 个错误)"
+    return (
+        f"{name}: n={len(ttfb)} 错误={errors} | 首字节 p50={_percentile(ttfb, 0.5):.1f}ms "
+        f"p95={_percentile(ttfb, 0.95):.1f}ms max={max(ttfb):.1f}ms | "
+        f"完整回答 p50={statistics.median(total):.0f}ms"
+    )
+
+
+async def _chat(client: httpx.AsyncClient, question: str, ttfb: List[float], total: List[float]):
+    start = time.perf_counter()
+    async with client.stream("POST", "/chat", json={"question": question, "session_id": "load-test"}) as resp:
+        resp.raise_for_status()
+        first = None
+        async for _ in resp.aiter_bytes():
+            if first is None:
+                first = time.perf_counter()
+    ttfb.append((first - start) * 1000)
+    total.append((time.perf_counter() - start) * 1000)
+
+
+async def run_chat_round(client: httpx.AsyncClient, concurrency: int, requests: int):
+    ttfb, total = [], []
+    errors = 0
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        async with slots:
+            try:
+                await _chat(client, QUESTIONS[i % len(QUESTIONS)], ttfb, total)
+            except Exception:
+                errors += 1
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return ttfb, total, errors
+
+
+def _upload_payload(path: str = None):
+    if path:
+        with open(path, "rb") as f:
+            return path.replace("\\", "/").rsplit("/", 1)[-1], f.read()
+    # 内容每次都不同，保证服务端真的会重新解析和向量化
+    rng = random.Random(time.time())
+    lines = ["".join(chr(rng.randint(0x4e00, 0x9fa5)) for _ in range(80)) for _ in range(8000)]
+    return "load_test_corpus.txt", "\n".join(lines).encode("utf-8")
+
+
+async def main(base_url: str, concurrency: int, requests: int, upload_path: str = None):
+    async with httpx.AsyncClient(base_url=base_url, timeout=300) as client:
+        print(f"⚡ 空闲状态: 并发 {concurrency}, 请求 {requests}")
+        print(_summary("空闲", *await run_chat_round(client, concurrency, requests)))
+
+        name, payload = _upload_payload(upload_path)
+        print(f"⚡ 上传 {name} ({len(payload) / 1e6:.1f}MB) 的同时发起问答")
+        upload_start = time.perf_counter()
+        resp = await client.post("/upload", files={"file": (name, payload)})
+        job_id = resp.json()["job_id"]  # 上传立即返回，入库在后台任务里进行
+        await asyncio.sleep(0.5)  # 等入库真正开始
+        result = await run_chat_round(client, concurrency, requests)
+        print(_summary("入库中", *result))
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in ("done", "failed"):
+            print("⚠️ 问答结束前入库已经完成，可以加大上传文件或请求数再测")
+        while job["status"] not in ("done", "failed"):
+            await asyncio.sleep(0.5)
+            job = (await client.get(f"/jobs/{job_id}")).json()
+        print(f"✅ 入库耗时 {time.perf_counter() - upload_start:.1f}s: {job['status']}, "
+              f"文档块 {job['chunks_embedded']}, 错误: {job['error']}")
+
+
+if __name__ == "__main__":
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    upload_path = sys.argv[4] if len(sys.argv) > 4 else None
+    asyncio.run(main(base_url, concurrency, requests, upload_path))
@@ -0,0 +1,92 @@
+# manifest.py
+# 记录 data 目录下每个文件的内容哈希以及它对应的向量 id，用于增量入库
+import os
+import json
+import hashlib
+from typing import Dict, List, Tuple
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """计算文件内容的 sha256"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class IngestManifest:
+    """
+    文件清单: {相对路径: {"sha256", "size", "mtime", "ids"}}
+
+    size/mtime 没变的文件直接跳过，不再重新计算哈希；
+    变了的才计算哈希，哈希也没变就只更新 stat 信息。
+    """
+
+    def __init__(self, db_path: str, data_dir: str):
+        self.path = os.path.join(db_path, MANIFEST_NAME)
+        self.data_dir = data_dir
+        self.entries: Dict[str, dict] = {}
+        self.load()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        # 原子替换，避免写到一半进程退出导致清单损坏
+        os.replace(tmp_path, self.path)
+
+    def rel(self, path: str) -> str:
+        return os.path.relpath(path, self.data_dir).replace(os.sep, "/")
+
+    def is_changed(self, path: str) -> Tuple[bool, str]:
+        """判断文件是否新增或内容有变化，返回 (是否变化, sha256)"""
+        entry = self.entries.get(self.rel(path))
+        st = os.stat(path)
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            return False, entry["sha256"]
+        digest = file_sha256(path)
+        if entry and entry["sha256"] == digest:
+            # 内容没变，只是被 touch 过
+            entry["size"], entry["mtime"] = st.st_size, st.st_mtime
+            return False, digest
+        return True, digest
+
+    def ids_for(self, path: str) -> List[str]:
+        entry = self.entries.get(self.rel(path))
+        return list(entry["ids"]) if entry else []
+
+    def record(self, path: str, digest: str, ids: List[str]):
+        st = os.stat(path)
+        self.entries[self.rel(path)] = {
+            "sha256": digest,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "ids": list(ids),
+        }
+
+    def forget(self, rel_path: str) -> List[str]:
+        """从清单里移除文件，返回它之前对应的向量 id"""
+        entry = self.entries.pop(rel_path, None)
+        return list(entry["ids"]) if entry else []
+
+    def missing_files(self, present: List[str]) -> List[str]:
+        """清单里有但磁盘上已经删除的文件(相对路径)"""
+        present_rel = {self.rel(p) for p in present}
+        return [rel for rel in self.entries if rel not in present_rel]
+
+    def clear(self):
+        self.entries = {}
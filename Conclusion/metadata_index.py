@@ -0,0 +1,369 @@
+# metadata_index.py
+# 文档块元数据的列式旁路索引: 每个字段一列 numpy 数组，和 faiss 的向量位置一一对齐。
+#   - source / ext / tenant 取值有限，按字典编码存成整数列，每个取值的位图按需生成并缓存
+#   - page、ingested_at 存数值列，等值/范围条件直接在列上比较
+# 过滤条件合成一张位图，作为 faiss 的 IDSelectorBitmap 传进检索，ANN 搜索内部就跳过不符合的向量，
+# 不用多取一批再过滤。保存时随 generation 写成 .npy 列，只读 worker 以内存映射方式打开
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+import faiss
+
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "default")
+METADATA_BITMAP_CACHE = int(os.getenv("METADATA_BITMAP_CACHE", "256"))
+
+CATEGORICAL_FIELDS = ("source", "ext", "tenant")
+NUMERIC_FIELDS = {"page": np.int32, "ingested_at": np.float64}
+# 支持的过滤条件: 字典型字段给一个值或列表(任一命中)，page 给页码或列表，时间给 unix 秒的范围
+FILTER_KEYS = set(CATEGORICAL_FIELDS) | {"page", "ingested_after", "ingested_before"}
+METADATA_COLUMNS = "metadata.json"
+
+
+def ingest_metadata(path: str, metadata: dict, data_dir: Optional[str] = None,
+                    tenant: Optional[str] = None, ingested_at: Optional[float] = None) -> dict:
+    """
+    入库时补全元数据(原地修改并返回): source 记相对 data 目录的路径，ext 小写扩展名，
+    tenant 不指定时取 data 目录下的一级子目录(直接放在 data 下的文件属于 DEFAULT_TENANT)
+    """
+    rel = os.path.relpath(path, data_dir) if data_dir else path
+    rel = rel.replace(os.sep, "/")
+    if tenant is None:
+        tenant = rel.split("/", 1)[0] if data_dir and "/" in rel else DEFAULT_TENANT
+    metadata["source"] = rel
+    metadata["ext"] = os.path.splitext(path)[1].lower()
+    metadata["tenant"] = tenant
+    metadata.setdefault("page", None)
+    metadata["ingested_at"] = ingested_at if ingested_at is not None else time.time()
+    return metadata
+
+
+def _categorical_value(field: str, metadata: dict) -> str:
+    """旧数据没有 ext/tenant 时从 source 推出扩展名、归到默认租户"""
+    value = metadata.get(field)
+    if value is None:
+        if field == "ext":
+            return os.path.splitext(str(metadata.get("source", "")))[1].lower()
+        if field == "tenant":
+            return DEFAULT_TENANT
+        return ""
+    return str(value)
+
+
+def _page(metadata: dict) -> int:
+    try:
+        return int(metadata.get("page"))
+    except (TypeError, ValueError):
+        return -1
+
+
+def _ingested_at(metadata: dict) -> float:
+    try:
+        return float(metadata.get("ingested_at"))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _as_list(value) -> list:
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+
+class MetadataSelection:
+    """
+    一次过滤的结果: 打包位图(第 i 位对应向量位置 i)、命中条数和 faiss 的 IDSelector。
+    IDSelectorBitmap 直接引用位图的内存，两者必须一起保留
+    """
+
+    __slots__ = ("bitmap", "ntotal", "count", "selector", "_positions", "_position_of")
+
+    def __init__(self, bitmap: np.ndarray, ntotal: int, positions: Optional[Callable[[], Dict[str, int]]] = None):
+        self.bitmap = bitmap
+        self.ntotal = ntotal
+        self.count = int(np.unpackbits(bitmap).sum())
+        self.selector = faiss.IDSelectorBitmap(ntotal, faiss.swig_ptr(bitmap))
+        self._positions = positions
+        self._position_of = None
+
+    def __contains__(self, position: int) -> bool:
+        return 0 <= position < self.ntotal and bool((self.bitmap[position >> 3] >> (position & 7)) & 1)
+
+    def allows_id(self, _id: str) -> bool:
+        """按文档块 id 判断(BM25 那一路用)，id -> 向量位置的反查表第一次用到时才建"""
+        if self._position_of is None:
+            self._position_of = self._positions() if self._positions is not None else {}
+        position = self._position_of.get(_id)
+        return position is not None and position in self
+
+
+class MetadataIndex:
+    """
+    用法:
+        meta = MetadataIndex.from_vector_db(vector_db)       # 或 MetadataIndex.load(generation 目录)
+        meta.append([doc.metadata, ...])                     # 和向量同顺序追加
+        meta.delete(positions)                               # 和 FAISS.delete 一样压缩位置
+        selection = meta.select({"ext": ".pdf", "ingested_after": ts})
+        index.search(x, k, params=search_params(index, selection.selector))
+    发布之后不再修改，写入前先 copy()
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.columns: Dict[str, np.ndarray] = {f: np.zeros(0, dtype=np.int32) for f in CATEGORICAL_FIELDS}
+        self.columns.update({f: np.zeros(0, dtype=dtype) for f, dtype in NUMERIC_FIELDS.items()})
+        # 字典编码: 编码 -> 取值，取值 -> 编码
+        self.values: Dict[str, List[str]] = {f: [] for f in CATEGORICAL_FIELDS}
+        self.codes: Dict[str, Dict[str, int]] = {f: {} for f in CATEGORICAL_FIELDS}
+        self._bitmaps: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._position_of: Optional[Dict[str, int]] = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def column(self, field: str) -> np.ndarray:
+        return self.columns[field][:self.size]
+
+    def _code(self, field: str, value: str) -> int:
+        code = self.codes[field].get(value)
+        if code is None:
+            code = len(self.values[field])
+            self.values[field].append(value)
+            self.codes[field][value] = code
+        return code
+
+    def _reserve(self, extra: int):
+        """按倍数扩容，连续追加小批量时不用每次都复制整列"""
+        needed = self.size + extra
+        for field, col in self.columns.items():
+            if len(col) < needed or not col.flags.writeable:
+                grown = np.empty(max(needed, 2 * len(col), 1024), dtype=col.dtype)
+                grown[:self.size] = col[:self.size]
+                self.columns[field] = grown
+
+    def _changed(self):
+        self._bitmaps.clear()
+        self._position_of = None
+
+    def append(self, metadatas: Iterable[dict]):
+        metadatas = list(metadatas)
+        n = len(metadatas)
+        if not n:
+            return
+        self._reserve(n)
+        end = self.size + n
+        for field in CATEGORICAL_FIELDS:
+            self.columns[field][self.size:end] = [self._code(field, _categorical_value(field, m)) for m in metadatas]
+        self.columns["page"][self.size:end] = [_page(m) for m in metadatas]
+        self.columns["ingested_at"][self.size:end] = [_ingested_at(m) for m in metadatas]
+        self.size = end
+        self._changed()
+
+    def delete(self, positions: Iterable[int]):
+        """删除这些位置的行，后面的行依次前移(和 FAISS.delete 之后 index_to_docstore_id 的重新编号一致)"""
+        positions = np.fromiter(positions, dtype=np.int64)
+        if not len(positions):
+            return
+        keep = np.ones(self.size, dtype=bool)
+        keep[positions] = False
+        for field in self.columns:
+            self.columns[field] = self.column(field)[keep]
+        self.size = int(keep.sum())
+        self._changed()
+
+    def extend(self, other: "MetadataIndex", rows: Optional[np.ndarray] = None):
+        """追加另一个索引的行(rows 给出时只追加这些位置)，字典编码换成本索引的编码(合并 delta 层时用)"""
+        rows = np.arange(other.size) if rows is None else np.asarray(rows, dtype=np.int64)
+        n = len(rows)
+        if not n:
+            return
+        self._reserve(n)
+        end = self.size + n
+        for field in CATEGORICAL_FIELDS:
+            mapping = np.array([self._code(field, v) for v in other.values[field]] or [0], dtype=np.int32)
+            self.columns[field][self.size:end] = mapping[other.column(field)[rows]]
+        for field in NUMERIC_FIELDS:
+            self.columns[field][self.size:end] = other.column(field)[rows]
+        self.size = end
+        self._changed()
+
+    def copy(self) -> "MetadataIndex":
+        """写时复制用: 列复制一份(可写)，字典编码表复制一份，位图缓存不复制"""
+        other = MetadataIndex()
+        other.size = self.size
+        other.columns = {f: np.array(self.column(f)) for f in self.columns}
+        other.values = {f: list(v) for f, v in self.values.items()}
+        other.codes = {f: dict(c) for f, c in self.codes.items()}
+        return other
+
+    def _bitmap(self, field: str, code: int) -> np.ndarray:
+        """某个字段等于某个取值的打包位图，LRU 缓存(发布后的索引不再修改，缓存一直有效)"""
+        key = (field, code)
+        with self._lock:
+            bitmap = self._bitmaps.get(key)
+            if bitmap is not None:
+                self._bitmaps.move_to_end(key)
+                return bitmap
+        bitmap = np.packbits(self.column(field) == code, bitorder="little")
+        with self._lock:
+            self._bitmaps[key] = bitmap
+            while len(self._bitmaps) > METADATA_BITMAP_CACHE:
+                self._bitmaps.popitem(last=False)
+        return bitmap
+
+    def position_of(self, index_to_docstore_id) -> Dict[str, int]:
+        """文档块 id -> 位置的反查表，第一次用到时建(发布后不再修改，一直有效)"""
+        with self._lock:
+            if self._position_of is None:
+                self._position_of = {_id: int(i) for i, _id in index_to_docstore_id.items()}
+            return self._position_of
+
+    def select(self, filter: Optional[dict], index_to_docstore_id=None,
+               exclude: Optional[np.ndarray] = None) -> Optional[MetadataSelection]:
+        """
+        按过滤条件生成位图，不同字段之间是"且"，同一字段的多个取值是"或"。
+        没有条件返回 None(不过滤)；字段不认识时抛 ValueError。
+        index_to_docstore_id 给出时，结果还可以按文档块 id 判断(混合检索的 BM25 一路要用)。
+        exclude 是不参与检索的位置(已删除的墓碑，见 snapshots.IndexState)，没有条件但有 exclude 时也返回位图
+        """
+        excluded = exclude is not None and len(exclude) > 0
+        if not filter and not excluded:
+            return None
+        filter = filter or {}
+        unknown = set(filter) - FILTER_KEYS
+        if unknown:
+            raise ValueError(f"不支持的过滤字段: {sorted(unknown)}, 可选: {sorted(FILTER_KEYS)}")
+        bitmap = np.full((self.size + 7) // 8, 0xFF, dtype=np.uint8)
+        for field in CATEGORICAL_FIELDS:
+            if field not in filter:
+                continue
+            wanted = [str(v).lower() if field == "ext" else str(v) for v in _as_list(filter[field])]
+            if field == "ext":
+                wanted = [v if v.startswith(".") else f".{v}" for v in wanted]
+            part = np.zeros_like(bitmap)
+            for value in wanted:
+                code = self.codes[field].get(value)
+                if code is not None:
+                    part |= self._bitmap(field, code)
+            bitmap &= part
+        if "page" in filter:
+            pages = [int(p) for p in _as_list(filter["page"])]
+            bitmap &= np.packbits(np.isin(self.column("page"), pages), bitorder="little")
+        if "ingested_after" in filter or "ingested_before" in filter:
+            # 没有入库时间的旧数据是 NaN，比较结果为 False，不会被时间条件选中
+            times = self.column("ingested_at")
+            in_range = np.ones(self.size, dtype=bool)
+            if "ingested_after" in filter:
+                in_range &= times >= float(filter["ingested_after"])
+            if "ingested_before" in filter:
+                in_range &= times < float(filter["ingested_before"])
+            bitmap &= np.packbits(in_range, bitorder="little")
+        if self.size % 8:
+            bitmap[-1] &= (1 << (self.size % 8)) - 1
+        if excluded:
+            exclude = np.asarray(exclude, dtype=np.int64)
+            np.bitwise_and.at(bitmap, exclude >> 3, ~(np.uint8(1) << (exclude & 7).astype(np.uint8)))
+        positions = (lambda: self.position_of(index_to_docstore_id)) if index_to_docstore_id is not None else None
+        return MetadataSelection(bitmap, self.size, positions)
+
+    def save(self, path: str):
+        """写成 path 下的 meta.<字段>.npy 列 + metadata.json(行数和字典编码表)"""
+        for field in self.columns:
+            np.save(os.path.join(path, f"meta.{field}.npy"), self.column(field))
+        with open(os.path.join(path, METADATA_COLUMNS), "w", encoding="utf-8") as f:
+            json.dump({"size": self.size, "values": self.values}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["MetadataIndex"]:
+        """内存映射打开 save() 写的列；目录里没有(旧版本保存的向量库)返回 None"""
+        meta_file = os.path.join(path, METADATA_COLUMNS)
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls()
+        index.size = meta["size"]
+        for field in index.columns:
+            index.columns[field] = np.load(os.path.join(path, f"meta.{field}.npy"), mmap_mode="r")
+        index.values = {f: list(meta["values"].get(f, [])) for f in CATEGORICAL_FIELDS}
+        index.codes = {f: {v: i for i, v in enumerate(values)} for f, values in index.values.items()}
+        return index
+
+    @classmethod
+    def from_vector_db(cls, vector_db, batch_size: int = 1000) -> "MetadataIndex":
+        """按向量位置顺序读出所有文档块的元数据建索引(旧向量库没有保存元数据列时用)"""
+        index = cls()
+        if vector_db is None:
+            return index
+        ids = [vector_db.index_to_docstore_id[i] for i in range(vector_db.index.ntotal)]
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            if hasattr(vector_db.docstore, "mget"):
+                docs = vector_db.docstore.mget(batch)
+            else:
+                docs = [vector_db.docstore.search(_id) for _id in batch]
+            index.append([getattr(d, "metadata", None) or {} for d in docs])
+        return index
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            cached = sum(b.nbytes for b in self._bitmaps.values())
+        return sum(col.nbytes for col in self.columns.values()) + cached
+
+    def stats(self) -> dict:
+        return {
+            "rows": self.size,
+            "distinct": {f: len(v) for f, v in self.values.items()},
+            "cached_bitmaps": len(self._bitmaps),
+        }
+
+
+if __name__ == "__main__":
+    import sys
+
+    from ann_index import INDEX_TYPES, build_index, filtered_search, set_search_params
+
+    # python metadata_index.py bench [向量条数] [维度]: 对比不过滤、位图过滤(IDSelector)的单次查询耗时，
+    # 并检查每个查询都拿回了 k 条(符合条件的不足 k 条时拿回全部)
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+        d = int(sys.argv[3]) if len(sys.argv) > 3 else 128
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal((n, d)).astype(np.float32)
+        queries = data[rng.choice(n, 100, replace=False)]
+        meta = MetadataIndex()
+        meta.append({
+            "source": f"doc-{i % 1000}.pdf", "ext": (".pdf", ".docx", ".txt")[i % 3],
+            "tenant": f"t{i % 20}", "page": i % 50, "ingested_at": 1_700_000_000 + i,
+        } for i in range(n))
+        filters = {
+            "无过滤": None,
+            "ext(1/3)": {"ext": ".pdf"},
+            "tenant(1/20)": {"tenant": "t3"},
+            "source(1/1000)": {"source": "doc-7.pdf"},
+            "tenant+时间": {"tenant": "t3", "ingested_after": 1_700_000_000 + n // 2},
+        }
+        for index_type in INDEX_TYPES:
+            index = build_index(data, index_type)
+            set_search_params(index, nprobe=16, ef_search=64)
+            for name, flt in filters.items():
+                start = time.perf_counter()
+                selection = meta.select(flt)
+                select_ms = (time.perf_counter() - start) * 1000
+                start = time.perf_counter()
+                if selection is None:
+                    _, found = index.search(queries, 10)
+                else:
+                    _, found = filtered_search(index, queries, 10, selection.selector, selection.count)
+                ms = (time.perf_counter() - start) * 1000 / len(queries)
+                ok = selection is None or all(i in selection for i in found.ravel() if i >= 0)
+                expected = 10 if selection is None else min(10, selection.count)
+                hits = (found >= 0).sum(axis=1)
+                print(f"{index_type:9s} {name:14s} 位图 {select_ms:.2f}ms, 查询 {ms:.3f} ms/次, "
+                      f"结果都符合条件: {ok}, 平均命中 {hits.mean():.1f}/{expected}")
+                assert ok and (hits == expected).all(), f"{index_type} {name}: 有查询没有拿回 {expected} 条"
+    else:
+        print("用法: python metadata_index.py bench [向量条数] [维度]")
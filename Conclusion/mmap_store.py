@@ -0,0 +1,332 @@
+# mmap_store.py
+# 零拷贝向量库格式: 向量索引用 faiss 的 IO_FLAG_MMAP 打开，向量位置 -> 文档 id 存成 .npy 列，
+# 用 numpy 内存映射读取；正文和元数据放在只追加的 chunk_store(sqlite) 里，不再反序列化 pickle。
+# 多个进程打开同一个目录时共享操作系统的页缓存，启动只需要打开文件，不需要读入全部内容。
+# BM25 倒排表和元数据列也写成同一个 generation 里的列(见 hybrid_retriever.MmapBM25Index、metadata_index)。
+# 分层索引(见 snapshots.IndexState)的 delta 层和墓碑写在 generation 下的 delta/ 和 dead.npy；
+# base 层自上次保存以来没变时，新 generation 直接硬链接上一个 generation 的 base 文件，不重写
+import os
+import json
+import shutil
+from collections.abc import Mapping
+from typing import Iterator, List, NamedTuple, Optional
+
+import numpy as np
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from ann_index import remove_positions, writable_copy
+from chunk_store import CHUNK_STORE_NAME, ChunkStore
+
+STORE_META = "store.json"
+STORE_FORMAT = 2
+DELTA_DIR = "delta"
+DEAD_FILE = "dead.npy"
+
+
+def is_mmap_store(path: str) -> bool:
+    return os.path.exists(os.path.join(path, STORE_META))
+
+
+class StringColumn:
+    """变长字符串列: data.npy 是拼接后的 utf-8 字节，offsets.npy 是 n+1 个偏移量"""
+
+    def __init__(self, path: str, name: str):
+        self.data = np.load(os.path.join(path, f"{name}.data.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    @staticmethod
+    def write(path: str, name: str, values: List[str]):
+        encoded = [v.encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        np.save(os.path.join(path, f"{name}.data.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+
+
+class MmapIndexToDocstoreId(Mapping):
+    """向量位置 -> 文档 id，按需从内存映射的 id 列里解码"""
+
+    def __init__(self, ids: StringColumn):
+        self.ids = ids
+
+    def __getitem__(self, i) -> str:
+        i = int(i)
+        if i < 0 or i >= len(self.ids):
+            raise KeyError(i)
+        return self.ids[i]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(len(self.ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def read_store_meta(path: str) -> dict:
+    with open(os.path.join(path, STORE_META), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _store_format(path: str) -> Optional[int]:
+    return read_store_meta(path).get("format")
+
+
+def current_generation(path: str) -> Optional[str]:
+    """store.json 指向当前生效的数据目录(generation)"""
+    try:
+        with open(os.path.join(path, STORE_META), "r", encoding="utf-8") as f:
+            return json.load(f)["generation"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def generation_path(path: str, generation: Optional[str] = None) -> Optional[str]:
+    """某个 generation 的数据目录；不指定时取 store.json 当前指向的"""
+    generation = generation or current_generation(path)
+    return os.path.join(path, generation) if generation else None
+
+
+class DeltaLayer(NamedTuple):
+    """分层索引的 delta 层(向量、位置 -> id、元数据列、BM25)和墓碑(已删除的位置，base 和 delta 统一编号)"""
+    vectors: np.ndarray
+    ids: List[str]
+    meta: object
+    bm25: object
+    dead: np.ndarray
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def save_mmap_store(vector_db: FAISS, path: str, extra_meta: Optional[dict] = None, metadata_index=None,
+                    delta: Optional[DeltaLayer] = None, link_from: Optional[str] = None, bm25=None) -> str:
+    """
+    把 FAISS 对象写成 mmap 格式，返回新的 generation 名。每次保存写到一个新的 generation 子目录，
+    写完后原子替换 store.json 指针；正在读旧目录的进程不受影响。
+    extra_meta 会一起写进 store.json(例如 WAL 的回放起点)；
+    metadata_index(见 metadata_index.py)、bm25(见 hybrid_retriever.py)给出时元数据列、倒排表写进同一个 generation；
+    delta 给出时写进 delta/ 和 dead.npy。
+    link_from 是调用方确认 base 层(vector_db + metadata_index + bm25)自那以后没有变过的 generation:
+    它仍是当前 generation 时，base 文件从那里硬链接过来，这次保存只写 delta
+    """
+    os.makedirs(path, exist_ok=True)
+    old_generation = current_generation(path)
+    seq = int(old_generation.split("-")[1]) + 1 if old_generation else 1
+    generation = f"gen-{seq:06d}"
+    gen_path = os.path.join(path, generation)
+    shutil.rmtree(gen_path, ignore_errors=True)
+    os.makedirs(gen_path)
+
+    n = vector_db.index.ntotal
+    if link_from is not None and link_from == old_generation:
+        old_path = os.path.join(path, old_generation)
+        for name in os.listdir(old_path):
+            if name not in (DELTA_DIR, DEAD_FILE):
+                _link_or_copy(os.path.join(old_path, name), os.path.join(gen_path, name))
+        base = read_store_meta(path).get("base", old_generation)
+    else:
+        base = generation
+        ids = [vector_db.index_to_docstore_id[i] for i in range(n)]
+        # 正文/元数据只追加写入 chunk_store；不是 chunk_store 的(例如 FAISS.from_documents 建的)把缺的补进去，
+        # 调用方的对象不做改动
+        chunk_store = get_chunk_store(path)
+        if vector_db.docstore is not chunk_store:
+            chunk_store.add_missing(_documents(vector_db.docstore, ids))
+        faiss.write_index(vector_db.index, os.path.join(gen_path, "index.faiss"))
+        StringColumn.write(gen_path, "ids", ids)
+        if metadata_index is not None:
+            metadata_index.save(gen_path)
+        if bm25 is not None:
+            bm25.save(gen_path, ids)
+
+    if delta is not None:
+        delta_path = os.path.join(gen_path, DELTA_DIR)
+        os.makedirs(delta_path)
+        np.save(os.path.join(delta_path, "vectors.npy"), np.ascontiguousarray(delta.vectors, dtype=np.float32))
+        StringColumn.write(delta_path, "ids", list(delta.ids))
+        if delta.meta is not None:
+            delta.meta.save(delta_path)
+        if delta.bm25 is not None:
+            delta.bm25.save(delta_path, list(delta.ids))
+        np.save(os.path.join(gen_path, DEAD_FILE), np.asarray(delta.dead, dtype=np.int64))
+
+    tmp_meta = os.path.join(path, STORE_META + ".tmp")
+    with open(tmp_meta, "w", encoding="utf-8") as f:
+        json.dump({
+            "format": STORE_FORMAT,
+            "generation": generation,
+            # 写出 base 文件的 generation: 只读 worker 看到它没变就沿用已经映射的 base，只加载 delta
+            "base": base,
+            "ntotal": n,
+            "delta": len(delta.ids) if delta is not None else 0,
+            "dead": len(delta.dead) if delta is not None else 0,
+            "normalize_L2": vector_db._normalize_L2,
+            "distance_strategy": str(vector_db.distance_strategy.value),
+            **(extra_meta or {}),
+        }, f)
+    os.replace(tmp_meta, os.path.join(path, STORE_META))
+
+    # 旧 generation 直接删除: POSIX 下已经 mmap 的进程仍然持有旧文件，直到它们重新加载；
+    # 硬链接过去的 base 文件还在新 generation 里
+    if old_generation:
+        shutil.rmtree(os.path.join(path, old_generation), ignore_errors=True)
+    return generation
+
+
+def _documents(docstore, ids: List[str]) -> Iterator:
+    for _id in ids:
+        doc = docstore.search(_id)
+        doc.id = _id
+        yield doc
+
+
+def load_mmap_store(path: str, embedder, generation: Optional[str] = None) -> FAISS:
+    """
+    以内存映射方式打开向量库的 base 层，不读入全部数据。
+    generation 给出时打开这个目录(和同一 generation 的元数据列保持一致)，否则打开 store.json 当前指向的
+    """
+    meta = read_store_meta(path)
+    gen_path = os.path.join(path, generation or meta["generation"])
+    index_file = os.path.join(gen_path, "index.faiss")
+    try:
+        index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # 部分索引类型不支持 mmap，退回普通读取
+        index = faiss.read_index(index_file)
+    return FAISS(
+        embedder,
+        index,
+        get_chunk_store(path),
+        MmapIndexToDocstoreId(StringColumn(gen_path, "ids")),
+        normalize_L2=meta.get("normalize_L2", False),
+        distance_strategy=DistanceStrategy(meta.get("distance_strategy", DistanceStrategy.EUCLIDEAN_DISTANCE.value)),
+    )
+
+
+def load_delta(path: str, generation: Optional[str] = None) -> Optional[DeltaLayer]:
+    """读出 generation 里的 delta 层向量、id 和墓碑(读进内存，不映射)；没有 delta 返回 None。元数据列、BM25 由调用方加载"""
+    gen_path = generation_path(path, generation)
+    delta_path = os.path.join(gen_path, DELTA_DIR)
+    if not os.path.isdir(delta_path):
+        return None
+    ids = StringColumn(delta_path, "ids")
+    dead_file = os.path.join(gen_path, DEAD_FILE)
+    return DeltaLayer(
+        np.load(os.path.join(delta_path, "vectors.npy")),
+        [ids[i] for i in range(len(ids))],
+        None,
+        None,
+        np.load(dead_file) if os.path.exists(dead_file) else np.zeros(0, dtype=np.int64),
+    )
+
+
+def make_writable(vector_db: FAISS) -> FAISS:
+    """写入前把 mmap 打开的只读索引复制到内存(原地修改并返回)；正文仍留在 chunk_store 里"""
+    if isinstance(vector_db.index_to_docstore_id, MmapIndexToDocstoreId):
+        vector_db.index = writable_copy(vector_db.index)
+        vector_db.index_to_docstore_id = dict(vector_db.index_to_docstore_id.items())
+    return vector_db
+
+
+def fork_vector_db(vector_db: FAISS, index=None, index_to_docstore_id=None) -> FAISS:
+    """
+    写时复制: 返回可以独立修改的副本，原对象不变。向量索引复制一份(或直接用传入的新索引)，
+    id 映射复制一份(或直接用传入的)；chunk_store 只追加、删除只打标记，副本和原对象共用
+    """
+    docstore = vector_db.docstore
+    if not isinstance(docstore, ChunkStore):
+        docstore = InMemoryDocstore(dict(docstore._dict))
+    if index_to_docstore_id is None:
+        index_to_docstore_id = dict(vector_db.index_to_docstore_id.items())
+    return FAISS(
+        vector_db.embedding_function,
+        index if index is not None else writable_copy(vector_db.index),
+        docstore,
+        index_to_docstore_id,
+        relevance_score_fn=vector_db.override_relevance_score_fn,
+        normalize_L2=vector_db._normalize_L2,
+        distance_strategy=vector_db.distance_strategy,
+    )
+
+
+def merge_vector_dbs(vector_db: FAISS, removed: np.ndarray, vectors: np.ndarray, ids: List[str]) -> FAISS:
+    """
+    合并分层索引，返回新的 FAISS 对象(原对象不变): 复制 base 的向量索引，删掉 removed 这些位置
+    (见 ann_index.remove_positions，不重新训练)，再追加 delta 层的向量(已经按需归一化过)
+    """
+    removed = np.asarray(removed, dtype=np.int64)
+    index = remove_positions(writable_copy(vector_db.index), removed)
+    keep = np.ones(vector_db.index.ntotal, dtype=bool)
+    keep[removed] = False
+    mapping = vector_db.index_to_docstore_id
+    kept = [mapping[i] for i in np.flatnonzero(keep)]
+    if len(vectors):
+        index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    return fork_vector_db(vector_db, index=index, index_to_docstore_id=dict(enumerate(kept + list(ids))))
+
+
+_chunk_stores = {}
+
+
+def get_chunk_store(path: str) -> ChunkStore:
+    """同一个向量库目录在进程内共用一个 chunk_store 连接"""
+    key = os.path.abspath(path)
+    if key not in _chunk_stores:
+        os.makedirs(path, exist_ok=True)
+        _chunk_stores[key] = ChunkStore(os.path.join(path, CHUNK_STORE_NAME))
+    return _chunk_stores[key]
+
+
+def close_chunk_store(path: str):
+    """卸载向量库时关闭它的 chunk_store 连接(命名空间很多时不能一直占着文件句柄)"""
+    chunk_store = _chunk_stores.pop(os.path.abspath(path), None)
+    if chunk_store is not None:
+        chunk_store.close()
+
+
+def load_vector_store(path: str, embedder, mmap: bool = True, generation: Optional[str] = None,
+                      merge_delta: bool = True) -> FAISS:
+    """
+    统一的加载入口: 新格式走内存映射，旧的 index.faiss + index.pkl 格式继续兼容(正文在加载时搬进 chunk_store)。
+    mmap=False 时返回可写的内存对象。
+    generation 里有 delta 层时默认合并成一个内存里的 FAISS 对象(给只用单个 FAISS 的调用方)；
+    merge_delta=False 只返回 base 层，delta 层用 load_delta 单独读取
+    """
+    if is_mmap_store(path) and _store_format(path) == STORE_FORMAT:
+        vector_db = load_mmap_store(path, embedder, generation)
+        delta = load_delta(path, generation) if merge_delta else None
+        if delta is not None and (len(delta.ids) or len(delta.dead)):
+            n = vector_db.index.ntotal
+            live = np.setdiff1d(np.arange(len(delta.ids)), delta.dead[delta.dead >= n] - n)
+            return merge_vector_dbs(vector_db, delta.dead[delta.dead < n], delta.vectors[live],
+                                    [delta.ids[i] for i in live])
+        return vector_db if mmap else make_writable(vector_db)
+    return _with_chunk_store(FAISS.load_local(path, embedder, allow_dangerous_deserialization=True), path)
+
+
+def _with_chunk_store(vector_db: FAISS, path: str) -> FAISS:
+    """旧格式的正文在 pickle 的 InMemoryDocstore 里: 加载时补进 chunk_store，返回用 chunk_store 的对象"""
+    chunk_store = get_chunk_store(path)
+    ids = [vector_db.index_to_docstore_id[i] for i in range(vector_db.index.ntotal)]
+    chunk_store.add_missing(_documents(vector_db.docstore, ids))
+    vector_db.docstore = chunk_store
+    return vector_db
+
+
+def save_vector_store(vector_db: FAISS, path: str, extra_meta: Optional[dict] = None, metadata_index=None,
+                      delta: Optional[DeltaLayer] = None, link_from: Optional[str] = None, bm25=None) -> str:
+    return save_mmap_store(vector_db, path, extra_meta, metadata_index, delta, link_from, bm25)
@@ -0,0 +1,213 @@
+# namespaces.py
+# 多租户命名空间: 每个命名空间一套独立的向量库目录和 data 目录(一个索引)，检索结果互不污染。
+# 命名空间第一次被访问时才加载，按最近使用顺序排队；已加载的估算内存超过预算(或个数超过上限)时，
+# 从最久没用的开始卸载，正在被请求使用的不卸载。卸载只是丢掉内存里的对象，磁盘上的数据不动，
+# 下次访问再加载。只读 worker 在访问时顺带检查 store.json，写进程保存了新版本就重新映射，
+# 不用给几千个命名空间各开一个监视线程
+import os
+import re
+import time
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+NAMESPACE_ROOT = os.getenv("NAMESPACE_ROOT", "./namespaces")
+DEFAULT_NAMESPACE = "default"
+NAMESPACE_MEMORY_BUDGET = int(float(os.getenv("NAMESPACE_MEMORY_BUDGET_MB", "2048")) * 1024 * 1024)
+# 每个已加载的命名空间占一个 sqlite 连接(文件句柄)，个数也要有上限
+NAMESPACE_MAX_LOADED = int(os.getenv("NAMESPACE_MAX_LOADED", "500"))
+# 命名空间名用作目录名
+NAMESPACE_RE = re.compile(r"^[\w\-]{1,64}$")
+
+
+def check_namespace(namespace: str) -> str:
+    if not NAMESPACE_RE.match(namespace or ""):
+        raise ValueError(f"命名空间名不合法: {namespace!r}(只允许字母、数字、下划线和 -，最长 64)")
+    return namespace
+
+
+def check_filename(filename: Optional[str]) -> str:
+    """上传的文件名只取最后一段(去掉客户端带的目录，防止写到别的命名空间)；空名字和 . 开头的拒绝"""
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    if not name or name.startswith("."):
+        raise ValueError(f"文件名不合法: {filename!r}")
+    return name
+
+
+class _Loaded:
+    __slots__ = ("manager", "users", "bytes", "epoch", "checked")
+
+    def __init__(self, manager, epoch: int):
+        self.manager = manager
+        self.users = 0
+        self.bytes = 0
+        self.epoch = epoch
+        self.checked = time.monotonic()
+
+
+class NamespacePool:
+    """
+    用法:
+        pool = NamespacePool(lambda ns, db_path, data_dir: VectorDBManager(db_path, data_dir))
+        with pool.use("acme") as manager:   # 没加载就先加载；退出前不会被卸载
+            manager.retrieve(...)
+        pool.update("acme")                 # 写入后重新估算这个命名空间占用的内存
+    manager 需要提供 memory_bytes()，可选 refresh()(只读 worker 检查新版本)和 close()(卸载时释放连接)
+    """
+
+    def __init__(self, factory: Callable[[str, str, str], object], root: str = NAMESPACE_ROOT,
+                 default_paths: Optional[Tuple[str, str]] = None, memory_budget: int = NAMESPACE_MEMORY_BUDGET,
+                 max_loaded: int = NAMESPACE_MAX_LOADED, refresh_interval: Optional[float] = None,
+                 load_stripes: int = 64):
+        self.factory = factory
+        self.root = root
+        self.default_paths = default_paths
+        self.memory_budget = memory_budget
+        self.max_loaded = max_loaded
+        # 只读 worker 用: 距上次检查超过这个间隔(秒)时，访问前先看看写进程有没有保存新版本
+        self.refresh_interval = refresh_interval
+        self._loaded: "OrderedDict[str, _Loaded]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 同一个命名空间只加载一次；按名字哈希分段加锁，不用为每个命名空间建一把锁
+        self._load_locks = [threading.Lock() for _ in range(load_stripes)]
+        self._epochs = itertools.count(1)
+        self.loads = 0
+        self.evictions = 0
+
+    def paths(self, namespace: str) -> Tuple[str, str]:
+        """命名空间的 (向量库目录, data 目录)；默认命名空间沿用原来的 ./vector_db 和 ./data"""
+        if namespace == DEFAULT_NAMESPACE and self.default_paths is not None:
+            return self.default_paths
+        base = os.path.join(self.root, namespace)
+        return os.path.join(base, "vector_db"), os.path.join(base, "data")
+
+    def acquire(self, namespace: str):
+        """取出(必要时加载)命名空间的 manager 并登记一个使用者，用完必须 release"""
+        check_namespace(namespace)
+        entry = self._checkout(namespace)
+        if entry is None:
+            with self._load_lock(namespace):
+                entry = self._checkout(namespace)
+                if entry is None:
+                    entry = self._load(namespace)
+            self._evict()
+        elif self.refresh_interval is not None and time.monotonic() - entry.checked >= self.refresh_interval:
+            entry.checked = time.monotonic()
+            self._refresh(namespace, entry)
+        return entry.manager
+
+    def release(self, namespace: str):
+        with self._lock:
+            entry = self._loaded.get(namespace)
+            if entry is not None:
+                entry.users -= 1
+        # 之前因为正在使用而没能卸载的，现在可能可以卸载了
+        self._evict()
+
+    @contextmanager
+    def use(self, namespace: str) -> Iterator[object]:
+        manager = self.acquire(namespace)
+        try:
+            yield manager
+        finally:
+            self.release(namespace)
+
+    def epoch(self, namespace: str) -> Optional[int]:
+        """命名空间这一次加载的序号；卸载后重新加载会变，和 manager.version 一起区分缓存"""
+        with self._lock:
+            entry = self._loaded.get(namespace)
+            return entry.epoch if entry is not None else None
+
+    def _checkout(self, namespace: str) -> Optional[_Loaded]:
+        with self._lock:
+            entry = self._loaded.get(namespace)
+            if entry is not None:
+                entry.users += 1
+                self._loaded.move_to_end(namespace)
+            return entry
+
+    def _load(self, namespace: str) -> _Loaded:
+        start = time.perf_counter()
+        db_path, data_dir = self.paths(namespace)
+        manager = self.factory(namespace, db_path, data_dir)
+        entry = _Loaded(manager, next(self._epochs))
+        entry.bytes = manager.memory_bytes()
+        entry.users = 1
+        with self._lock:
+            self._loaded[namespace] = entry
+            self.loads += 1
+        print(f"📂 已加载命名空间 {namespace}: {entry.bytes / 1e6:.1f}MB, "
+              f"{(time.perf_counter() - start) * 1000:.0f}ms, 已加载 {len(self._loaded)} 个")
+        return entry
+
+    def _refresh(self, namespace: str, entry: _Loaded):
+        refresh = getattr(entry.manager, "refresh", None)
+        if refresh is None:
+            return
+        try:
+            if refresh():
+                self.update(namespace)
+        except Exception as e:
+            # 例如写进程正好又保存了一次、旧目录已被删除；下次访问再试
+            print(f"⚠️ 命名空间 {namespace} 重新映射失败，稍后重试: {e}")
+
+    def update(self, namespace: str):
+        """写入或重新映射之后重新估算内存，超出预算时卸载别的命名空间"""
+        with self._lock:
+            entry = self._loaded.get(namespace)
+        if entry is None:
+            return
+        entry.bytes = entry.manager.memory_bytes()
+        self._evict()
+
+    def _load_lock(self, namespace: str) -> threading.Lock:
+        return self._load_locks[hash(namespace) % len(self._load_locks)]
+
+    def _over_budget(self) -> bool:
+        return sum(e.bytes for e in self._loaded.values()) > self.memory_budget \
+            or len(self._loaded) > self.max_loaded
+
+    def _evict(self):
+        with self._lock:
+            if not self._over_budget():
+                return
+            candidates = [(ns, e) for ns, e in self._loaded.items() if e.users == 0]
+        for namespace, entry in candidates:
+            # 卸载和关闭连接都在这个命名空间的加载锁里完成: 否则移出之后、close 之前重新加载的
+            # manager 会拿到 get_chunk_store 里还没关的旧连接，随后被关掉
+            with self._load_lock(namespace):
+                with self._lock:
+                    if not self._over_budget():
+                        return
+                    if self._loaded.get(namespace) is not entry or entry.users > 0:
+                        continue
+                    del self._loaded[namespace]
+                    self.evictions += 1
+                close = getattr(entry.manager, "close", None)
+                if close is not None:
+                    close()
+            print(f"➖ 已卸载命名空间 {namespace}: {entry.bytes / 1e6:.1f}MB")
+
+    def stats(self, top: int = 10) -> dict:
+        with self._lock:
+            entries = list(self._loaded.items())
+        return {
+            "loaded": len(entries),
+            "bytes": sum(e.bytes for _, e in entries),
+            "memory_budget": self.memory_budget,
+            "max_loaded": self.max_loaded,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "largest": {ns: e.bytes for ns, e in sorted(entries, key=lambda item: item[1].bytes, reverse=True)[:top]},
+        }
+
+    def namespaces(self) -> Dict[str, bool]:
+        """磁盘上已有的命名空间 -> 是否已加载"""
+        with self._lock:
+            loaded = set(self._loaded)
+        found = set(os.listdir(self.root)) if os.path.isdir(self.root) else set()
+        if self.default_paths is not None:
+            found.add(DEFAULT_NAMESPACE)
+        return {ns: ns in loaded for ns in sorted(found) if NAMESPACE_RE.match(ns)}
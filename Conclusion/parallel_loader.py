@@ -0,0 +1,217 @@
+# parallel_loader.py
+# 多进程并行解析文档: 每个文件在独立的子进程里解析，
+# 单个文件超时或把解析器搞崩溃只影响它自己，结果按完成顺序流式返回。
+# 子进程是新启动的解释器，只运行本文件的 worker 入口: 不 fork 服务进程(里面已经有检索线程池、
+# sqlite 连接和 faiss/OpenMP 线程，fork 之后子进程可能死锁)，也不重新导入调用方的主模块
+# (Streamlit/uvicorn 脚本都有模块级副作用)。启动解释器、导入解析库要一两秒，
+# 所以子进程在一次 iter_parallel_load 里复用，超时或崩溃的才换新的
+import os
+import sys
+import pickle
+import subprocess
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from langchain_core.documents import Document
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
+
+
+class SimpleImageLoader:
+    """用 pytesseract 对图片做 OCR"""
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        from PIL import Image
+        import pytesseract
+        text = pytesseract.image_to_string(Image.open(self.path))
+        return [Document(page_content=text, metadata={"source": self.path})]
+
+
+DEFAULT_LOADERS = {
+    ".pdf": PyPDFLoader,
+    ".docx": Docx2txtLoader,
+    ".txt": TextLoader,
+}
+
+
+class LoadResult(NamedTuple):
+    path: str
+    docs: Optional[List[Document]]
+    error: Optional[str]
+
+
+def _worker_main():
+    """子进程入口: 循环从 stdin 读 (loader 类, 路径)，把 (状态, 结果) 写回 stdout，stdin 关闭时退出"""
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    # 解析器自己打印的内容改到 stderr，不混进结果
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    while True:
+        try:
+            loader_cls, path = pickle.load(sys.stdin.buffer)
+        except EOFError:
+            break
+        try:
+            result = ("ok", loader_cls(path).load())
+        except Exception as e:
+            result = ("error", f"{type(e).__name__}: {e}")
+        pickle.dump(result, out)
+        out.flush()
+
+
+class _Worker:
+    """
+    一个解析子进程；解析超时由计时器直接杀掉进程。
+    结果和计时器谁先拿到锁谁算数: 结果先到就不再算超时，超时先到就丢掉之后读到的结果，
+    一个文件只会有一种结局
+    """
+
+    def __init__(self):
+        self.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.timed_out = False
+        self._waiting = False
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def _expire(self):
+        with self._lock:
+            if not self._waiting:
+                return
+            self._waiting = False
+            self.timed_out = True
+        self.proc.kill()
+
+    def _finish(self) -> bool:
+        """结束这次等待，返回结果是否有效(计时器还没有判定超时)"""
+        with self._lock:
+            valid, self._waiting = self._waiting, False
+            return valid
+
+    def load(self, loader_cls, path: str, timeout: float):
+        """返回 (状态, 结果)；子进程崩溃、被杀掉或已判定超时时返回 None"""
+        self.timed_out = False
+        self._waiting = True
+        timer = threading.Timer(timeout, self._expire)
+        timer.start()
+        try:
+            pickle.dump((loader_cls, path), self.proc.stdin)
+            self.proc.stdin.flush()
+            result = pickle.load(self.proc.stdout)
+        except (EOFError, OSError, ValueError, pickle.UnpicklingError):
+            result = None
+        finally:
+            timer.cancel()
+        return result if self._finish() else None
+
+    def close(self, kill: bool = False):
+        if kill:
+            self.proc.kill()
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+class _WorkerPool:
+    """空闲的子进程排队复用；调用方提前停止迭代时全部杀掉，之后也不再启动新的"""
+
+    def __init__(self):
+        self.idle: List[_Worker] = []
+        self.workers: List[_Worker] = []
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def get(self) -> Optional[_Worker]:
+        with self.lock:
+            if self.stopped:
+                return None
+            if self.idle:
+                return self.idle.pop()
+            worker = _Worker()
+            self.workers.append(worker)
+            return worker
+
+    def put(self, worker: _Worker):
+        with self.lock:
+            if worker.alive and not self.stopped:
+                self.idle.append(worker)
+                return
+            if worker in self.workers:
+                self.workers.remove(worker)
+        worker.close()
+
+    def close(self, kill: bool = False):
+        with self.lock:
+            self.stopped = True
+            workers, self.workers, self.idle = self.workers, [], []
+        for worker in workers:
+            worker.close(kill=kill)
+
+
+def _load_in_child(loader_cls, path: str, timeout: float, workers: _WorkerPool) -> LoadResult:
+    worker = workers.get()
+    if worker is None:
+        return LoadResult(path, None, "cancelled")
+    try:
+        result = worker.load(loader_cls, path, timeout)
+    finally:
+        workers.put(worker)
+    if result is None and workers.stopped:
+        return LoadResult(path, None, "cancelled")
+    if worker.timed_out:
+        print(f"⚠️ 加载文件超时(>{timeout}s)，已终止: {path}")
+        return LoadResult(path, None, f"timeout after {timeout}s")
+    status, payload = result or ("error", None)
+    if status == "ok":
+        return LoadResult(path, payload, None)
+    error = payload or f"解析进程异常退出 (exitcode={worker.proc.poll()})"
+    print(f"⚠️ 加载文件失败: {path}, 错误: {error}")
+    return LoadResult(path, None, error)
+
+
+def iter_parallel_load(paths: List[str], loaders: Dict[str, type] = DEFAULT_LOADERS,
+                       max_workers: Optional[int] = None,
+                       timeout: float = 300.0) -> Iterator[LoadResult]:
+    """
+    并行解析文件，按完成顺序逐个 yield LoadResult
+    - max_workers: 同时运行的解析进程数，默认 CPU 核数
+    - timeout: 单个文件的解析时间上限(秒)，超时的子进程会被直接杀掉
+    不支持的扩展名会被跳过
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    queue = iter([p for p in paths if os.path.splitext(p)[1].lower() in loaders])
+    workers = _WorkerPool()
+    # 每个线程取一个空闲的子进程解析一个文件并等结果，同时在途的文件不超过 max_workers 个
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="parse")
+
+    def submit() -> bool:
+        path = next(queue, None)
+        if path is None:
+            return False
+        pending.add(pool.submit(_load_in_child, loaders[os.path.splitext(path)[1].lower()], path, timeout, workers))
+        return True
+
+    pending = set()
+    try:
+        while len(pending) < max_workers and submit():
+            pass
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                submit()
+                yield future.result()
+    finally:
+        # 正常结束时关闭 stdin 让子进程退出；调用方提前停止迭代时直接杀掉还在运行的
+        workers.close(kill=bool(pending))
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+if __name__ == "__main__" and sys.argv[1:] == ["worker"]:
+    _worker_main()
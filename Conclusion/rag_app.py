@@ -1,13 +1,16 @@
 # rag_app.py
 import os
+import re
+import json
 import asyncio
+import time
 import uuid
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 import uvicorn
 
@@ -15,9 +18,12 @@ import streamlit as st
 
 # langchain相关库
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
+from embedding_cache import CachedEmbeddings
+from mmap_store import (DELTA_DIR, close_chunk_store, current_generation, fork_vector_db, generation_path,
+                        get_chunk_store, load_delta, load_vector_store, read_store_meta, save_vector_store)
+from chunk_store import ChunkStore
+from vector_wal import WAL_DIR
 
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_community.chat_message_histories import ChatMessageHistory
@@ -25,10 +31,31 @@ from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import RunnableWithMessageHistory
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_deepseek import ChatDeepSeek
 
 from dotenv import load_dotenv
 
+from manifest import IngestManifest, file_sha256
+from async_embedder import AsyncBatchEmbedder
+from parallel_loader import DEFAULT_LOADERS, iter_parallel_load
+from ingest_pipeline import StreamingIngestor, empty_vector_db, iter_parallel_documents
+from ann_index import choose_index_type, convert_index, describe_index, evaluate, is_lossy, set_search_params
+from hybrid_retriever import BM25Index, MmapBM25Index, hybrid_search, layered_dense_search
+from answer_cache import AnswerCache, doc_ids, history_fingerprint
+from token_stream import coalesce_tokens, render_frames, replay_tokens
+from sse import SSE_HEADERS, SSEStreamRegistry, StreamGone, iter_sse
+from executors import BoundedExecutor, ExecutorBusy, LoopThreadExecutor
+from snapshots import IndexState, SnapshotManager
+from ingest_jobs import IngestJobQueue
+from history_store import history_getter
+from history_window import message_tokens, windowed_history_getter
+from context_builder import CONTEXT_FETCH_K, assemble_context
+from reranker import RERANK_FETCH_K, load_reranker
+from metadata_index import MetadataIndex, ingest_metadata
+from serving import REMAP_INTERVAL, SERVE_ROLE, WriterClient
+from namespaces import DEFAULT_NAMESPACE, NamespacePool, check_filename, check_namespace
+
 # Load .env if exists
 load_dotenv()
 
@@ -69,13 +96,9 @@ prompt = ChatPromptTemplate.from_messages([
 
 base_chain = prompt | llm | parser
 
-# 聊天历史存储（内存中）
-session_store = {}
-
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in session_store:
-        session_store[session_id] = ChatMessageHistory()
-    return session_store[session_id]
+# 聊天历史存储: Redis 或 sqlite，按会话过期、限制条数，多个 worker 进程共享
+# 只把 token 预算内的最近几轮放进 prompt，更早的轮次在后台压缩成摘要
+get_session_history = windowed_history_getter(history_getter(), llm=llm)
 
 chat_chain = RunnableWithMessageHistory(
     base_chain,
@@ -85,142 +108,897 @@ chat_chain = RunnableWithMessageHistory(
 )
 
 # Embeddings 和 向量库
-embedder = OllamaEmbeddings(model="nomic-embed-text")
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+embedder = CachedEmbeddings(OllamaEmbeddings(model="nomic-embed-text"))
+# 上传入库走异步批量 embedding，不阻塞事件循环；和 embedder 共用同一份磁盘缓存
+async_embedder = AsyncBatchEmbedder(
+    model="nomic-embed-text",
+    batch_size=int(os.getenv("EMBED_BATCH_SIZE", "32")),
+    concurrency=int(os.getenv("EMBED_CONCURRENCY", "4")),
+    cache=embedder.cache
+)
+# 问答时的查询向量走单独的异步客户端(独立连接池)，不和入库的批量请求抢连接
+query_embedder = AsyncBatchEmbedder(
+    model="nomic-embed-text",
+    batch_size=1,
+    concurrency=int(os.getenv("QUERY_EMBED_CONCURRENCY", "16"))
+)
+# 检索在专用线程池里执行(faiss 检索时释放 GIL)，入库在独立事件循环线程里串行执行；排队都有上限
+retrieval_executor = BoundedExecutor(
+    "retrieval",
+    max_workers=int(os.getenv("RETRIEVAL_WORKERS", "8")),
+    max_queue=int(os.getenv("RETRIEVAL_QUEUE", "64"))
+)
+ingestion_executor = LoopThreadExecutor("ingestion", max_queue=int(os.getenv("INGEST_QUEUE", "8")))
+# start_index 记录文档块在原文中的位置，拼上下文时据此合并相邻块
+text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50, add_start_index=True)
 VECTOR_DB_PATH = "./vector_db"
 DATA_DIR = "./data"
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "128"))
+# 索引类型: auto / flat / ivf_flat / hnsw / ivf_pq，auto 时按向量条数自动选择
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "auto")
+VECTOR_NPROBE = int(os.getenv("VECTOR_NPROBE", "16"))
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", "64"))
+# 检索方式: hybrid(BM25 + 向量, RRF 融合) / dense(只用向量)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "20"))
+# 已删除的文档块保留这么多秒再从 chunk_store 清掉，留给只读 worker 重新映射
+CHUNK_VACUUM_GRACE = float(os.getenv("CHUNK_VACUUM_GRACE", "300"))
+# 和其他脚本共用的向量库目录(多个用 os.pathsep 隔开): Agent.py/text.py/test.py/fina.py 通过 WAL 往 ./vector_db 里写，
+# api.py/ds.py 启动时映射一次、之后不再重新映射。这些目录的 chunk_store 不清理，清掉的记录它们可能还要读
+SHARED_VECTOR_DB_PATHS = {
+    os.path.abspath(p) for p in os.getenv("SHARED_VECTOR_DB_PATHS", VECTOR_DB_PATH).split(os.pathsep) if p
+}
+
+LOADERS = DEFAULT_LOADERS
 
 class VectorDBManager:
-    def __init__(self, db_path=VECTOR_DB_PATH):
+    def __init__(self, db_path=VECTOR_DB_PATH, data_dir=DATA_DIR, index_type=VECTOR_INDEX_TYPE,
+                 nprobe=VECTOR_NPROBE, ef_search=VECTOR_EF_SEARCH, readonly=False, reranker=None):
         self.db_path = db_path
-        self.vector_db = None
+        # 可选的 cross-encoder 精排(见 reranker.py)，None 时直接返回检索结果
+        self.reranker = reranker
+        # 多进程部署时的只读 worker: 只映射写进程保存的索引，不转换索引类型、不写入
+        self.readonly = readonly
+        self.data_dir = data_dir
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        # 索引版本(base + delta 两层，见 snapshots.IndexState): 检索固定一个版本后在锁外读，
+        # 写入在草稿上进行，完成后原子替换
+        self.snapshots = SnapshotManager(IndexState())
+        # 当前映射/最近保存的磁盘 generation(只读 worker 据此判断写进程是否保存了新版本)
+        self.generation = None
+        # base 文件所在的 generation(store.json 的 "base")，没变时只读 worker 重新映射只加载 delta 层
+        self.base_generation = None
+        # 最近一次保存(或加载)的 base 对象: 保存时 base 没换过就从上一个 generation 硬链接，只写 delta 层
+        self._saved_base = None
+        self.manifest = IngestManifest(db_path, data_dir)
         self.load_db()
 
+    @property
+    def vector_db(self):
+        return self.snapshots.current.vector_db
+
+    @property
+    def bm25(self) -> BM25Index:
+        return self.snapshots.current.bm25
+
+    @property
+    def version(self) -> int:
+        """向量库每变化一次加一，问答缓存据此失效"""
+        return self.snapshots.version
+
     def load_db(self):
+        vector_db = None
+        generation = current_generation(self.db_path)
         if os.path.exists(self.db_path):
             try:
-                self.vector_db = FAISS.load_local(
-                    self.db_path,
-                    embedder,
-                    allow_dangerous_deserialization=True
-                )
+                vector_db = load_vector_store(self.db_path, embedder, generation=generation, merge_delta=False)
                 print("✅ 已加载向量数据库")
             except Exception as e:
                 print(f"⚠️ 加载向量库失败: {e}")
-                self.vector_db = None
+        # 倒排索引和元数据列从同一个 generation 映射，之后的增删写进 delta 层
+        state = self._load_state(vector_db, generation)
+        self.snapshots.publish(state)
+        self.generation = generation if vector_db is not None else None
+        self.base_generation = read_store_meta(self.db_path).get("base", generation) if self.generation else None
+        self._saved_base = vector_db if self.generation else None
+        self.apply_index_type()
+        if state.vector_db is not None:
+            print(f"✅ BM25 倒排索引已建立，文档块数: {len(state.bm25) + len(state.delta_bm25)}")
+
+    def _load_state(self, vector_db, generation: Optional[str], bm25: Optional[BM25Index] = None,
+                    meta: Optional[MetadataIndex] = None) -> IndexState:
+        """
+        把磁盘上的一个 generation 组装成索引版本: base 层用映射的向量库、倒排表和元数据列(bm25/meta 给出时沿用)，
+        delta 层的向量和墓碑读进内存，倒排表和元数据列同样映射
+        """
+        if vector_db is None:
+            return IndexState()
+        state = IndexState(vector_db,
+                           bm25 if bm25 is not None else self._load_bm25(vector_db, generation),
+                           meta if meta is not None else self._load_metadata(vector_db, generation))
+        delta = load_delta(self.db_path, generation) if generation else None
+        if delta is not None:
+            delta_path = os.path.join(generation_path(self.db_path, generation), DELTA_DIR)
+            state.delta.append(delta.vectors, delta.ids)
+            delta_bm25 = MmapBM25Index.load(delta_path, delta.ids)
+            if delta_bm25 is None or delta_bm25.size != len(delta.ids):
+                delta_bm25 = BM25Index.from_docstore(delta.ids, vector_db.docstore)
+            state.delta_bm25 = delta_bm25
+            delta_meta = MetadataIndex.load(delta_path)
+            if delta_meta is None or len(delta_meta) != len(delta.ids):
+                delta_meta = MetadataIndex()
+                delta_meta.append(getattr(d, "metadata", None) or {} for d in vector_db.docstore.mget(delta.ids))
+            state.delta_meta = delta_meta
+            state.dead = delta.dead
+        return state
+
+    def _load_bm25(self, vector_db, generation: Optional[str] = None):
+        """倒排表和向量索引从同一个 generation 映射；旧版本保存的向量库没有倒排列，从文档块重建(要读正文、分词)"""
+        gen_path = generation_path(self.db_path, generation) if generation else None
+        bm25 = MmapBM25Index.load(gen_path, vector_db.index_to_docstore_id) if gen_path else None
+        if bm25 is None or bm25.size != vector_db.index.ntotal:
+            bm25 = BM25Index.from_vector_db(vector_db)
+            print(f"✅ BM25 倒排索引已从文档块重建，文档块数: {len(bm25)}")
+        return bm25
+
+    def _load_metadata(self, vector_db, generation: Optional[str] = None) -> MetadataIndex:
+        """元数据列和向量索引从同一个 generation 映射；旧格式的向量库没有保存这些列，从文档块重建"""
+        if vector_db is None:
+            return MetadataIndex()
+        gen_path = generation_path(self.db_path, generation) if generation else None
+        meta = MetadataIndex.load(gen_path) if gen_path else None
+        if meta is None or len(meta) != vector_db.index.ntotal:
+            meta = MetadataIndex.from_vector_db(vector_db)
+            print(f"✅ 元数据列已从文档块重建，行数: {len(meta)}")
+        return meta
+
+    def remap(self, generation: Optional[str] = None):
+        """
+        只读 worker: 写进程保存了新版本后重新映射磁盘上的索引。
+        base 没变(只写了 delta)时沿用已经映射的 base 层，只重新加载 delta 层；
+        base 变了(合并过)时映射新的 base，倒排表、元数据列都是映射，不重新分词
+        """
+        generation = generation or current_generation(self.db_path)
+        base_generation = read_store_meta(self.db_path).get("base", generation)
+        current = self.snapshots.current
+        if current.vector_db is not None and base_generation == self.base_generation:
+            state = self._load_state(current.vector_db, generation, current.bm25, current.meta)
         else:
-            self.vector_db = None
+            vector_db = load_vector_store(self.db_path, embedder, generation=generation, merge_delta=False)
+            set_search_params(vector_db.index, nprobe=self.nprobe, ef_search=self.ef_search)
+            state = self._load_state(vector_db, generation)
+        self.snapshots.publish(state)
+        self.generation, self.base_generation = generation, base_generation
+        print(f"🔁 已重新映射向量库 {generation}: base {state.base_size}, delta {len(state.delta)}, "
+              f"已删除 {len(state.dead)}")
+
+    def refresh(self) -> bool:
+        """只读 worker: store.json 指向了新的 generation 时重新映射，返回是否重新映射了"""
+        generation = current_generation(self.db_path)
+        if generation is None or generation == self.generation:
+            return False
+        self.remap(generation)
+        return True
+
+    def memory_bytes(self) -> int:
+        """当前版本估算占用的内存(向量索引 + BM25 + 元数据列)，命名空间按它做 LRU 卸载"""
+        with self.snapshots.pin() as state:
+            return state.memory_bytes()
+
+    def close(self):
+        """命名空间被卸载时调用: 释放 chunk_store 连接，内存里的索引随对象一起回收"""
+        close_chunk_store(self.db_path)
 
     def save_db(self):
+        if self.readonly:
+            return
         if self.vector_db:
-            self.vector_db.save_local(self.db_path)
-            print("✅ 向量库已保存")
+            self.apply_index_type()
+            with self.snapshots.pin() as state:
+                # base 自上次保存以来没换过(没有合并、没有转换类型)时只写 delta 层，base 文件硬链接过去
+                link_from = self.generation if state.vector_db is self._saved_base else None
+                self.generation = save_vector_store(state.vector_db, self.db_path, metadata_index=state.meta,
+                                                    delta=state.delta_layer(), link_from=link_from, bm25=state.bm25)
+                self._saved_base = base = state.vector_db
+                mapped = None if link_from or isinstance(state.bm25, MmapBM25Index) else \
+                    MmapBM25Index.load(generation_path(self.db_path, self.generation), base.index_to_docstore_id)
+            if mapped is not None:
+                # 合并、重建出的 base 倒排表是内存里的字典，换成刚保存的映射版本: 查询更快，也不占进程内存
+                with self.snapshots.write(lambda s: s.with_bm25(mapped if s.vector_db is base else s.bm25)):
+                    pass
+            print(f"✅ 向量库已保存({'只写 delta 层' if link_from else '完整写入'})")
+            self.vacuum_chunks()
 
-    def rebuild_from_data_dir(self):
-        """从 data 目录扫描所有支持文档，重建向量库"""
-        print("📂 从 data 目录重建向量库...")
-        docs = []
-        for root, _, files in os.walk(DATA_DIR):
+    def vacuum_chunks(self):
+        """
+        清理 chunk_store: 重新入库的文件每次写入新 id，旧记录只打删除标记，丢弃的草稿也会留下孤儿记录，
+        不清理的话数据库只增不减。
+        - 还有读者固定着旧版本时，只清理在最早那个旧版本发布之前就删除的(旧版本里也没有它们)；
+        - 最近 CHUNK_VACUUM_GRACE 秒内删除或写入的先保留，只读 worker 可能还映射着引用它们的旧 generation；
+        - 和别的进程共用的目录(SHARED_VECTOR_DB_PATHS，或者有 WAL 的目录)不清理
+        """
+        shared = os.path.abspath(self.db_path) in SHARED_VECTOR_DB_PATHS
+        if shared or os.path.isdir(os.path.join(self.db_path, WAL_DIR)):
+            return
+        with self.snapshots.exclusive() as (state, pinned_since):
+            if state.vector_db is None or not isinstance(state.vector_db.docstore, ChunkStore):
+                return
+            cutoff = time.time() - CHUNK_VACUUM_GRACE
+            removed = state.vector_db.docstore.vacuum(
+                state.ids(),
+                deleted_before=cutoff if pinned_since is None else min(cutoff, pinned_since),
+                created_before=cutoff,
+            )
+        if removed:
+            print(f"🧹 chunk_store 已清理 {removed} 条过期文档块")
+
+    def apply_index_type(self, index_type=None):
+        """
+        按配置切换 ANN 索引类型并设置 nprobe/efSearch。
+        auto 模式按 index.ntotal 选择: 小库 Flat，中等 HNSW，百万级以上 IVF-PQ
+        """
+        state = self.snapshots.current
+        if state.vector_db is None:
+            return
+        if self.readonly:
+            # 索引类型由写进程在保存时转换好，只读 worker 转换会在每个进程里各复制一份
+            set_search_params(state.vector_db.index, nprobe=self.nprobe, ef_search=self.ef_search)
+            return
+        index_type = index_type or self.index_type
+        if index_type == "auto":
+            index_type = choose_index_type(state.vector_db.index.ntotal)
+        current = describe_index(state.vector_db.index)
+        if current != index_type and is_lossy(state.vector_db.index):
+            # IVF-PQ 只存量化编码，拿近似值去建别的索引召回率会永久下降；要换类型请从 data 目录重建
+            print(f"⚠️ 索引是 {current}，不自动转换成 {index_type}(会损失精度)，需要时请从 data 目录重建")
+            index_type = current
+        if current != index_type:
+            # 新索引直接作为下一个版本的索引构建(不用先复制旧索引)，期间检索继续用当前版本
+            def rebuild_index(s: IndexState) -> IndexState:
+                # 只转换 base 层，不改变向量顺序: id 映射、BM25、元数据列和 delta 层原样沿用
+                return s.with_base(fork_vector_db(s.vector_db, index=convert_index(s.vector_db.index, index_type),
+                                                  index_to_docstore_id=s.vector_db.index_to_docstore_id))
+
+            with self.snapshots.write(rebuild_index) as draft:
+                if describe_index(draft.vector_db.index) != index_type:
+                    draft.vector_db.index = convert_index(draft.vector_db.index, index_type)
+                set_search_params(draft.vector_db.index, nprobe=self.nprobe, ef_search=self.ef_search)
+            print(f"🔁 索引类型 {current} -> {index_type}, base 向量数: {self.vector_db.index.ntotal}")
+            return
+        set_search_params(state.vector_db.index, nprobe=self.nprobe, ef_search=self.ef_search)
+
+    def index_report(self, k: int = 10, num_queries: int = 100) -> dict:
+        """当前索引相对 Flat 精确检索的 recall@k 和单次查询耗时"""
+        with self.snapshots.pin() as state:
+            if state.vector_db is None:
+                return {}
+            report = evaluate(state.vector_db.index, k=k, num_queries=num_queries)
+        # 当前版本号、仍被读者固定的旧版本、已回收的版本数
+        report["snapshots"] = self.snapshots.stats()
+        report["metadata"] = self.snapshots.current.meta.stats()
+        if self.reranker is not None:
+            report["rerank"] = self.reranker.stats()
+        return report
+
+    def _data_files(self) -> List[str]:
+        """data 目录下所有支持的文件"""
+        paths = []
+        for root, _, files in os.walk(self.data_dir):
             for file in files:
-                ext = os.path.splitext(file)[1].lower()
-                path = os.path.join(root, file)
-                loader = None
-                try:
-                    if ext == ".pdf":
-                        loader = PyPDFLoader(path)
-                    elif ext == ".docx":
-                        loader = Docx2txtLoader(path)
-                    elif ext == ".txt":
-                        loader = TextLoader(path)
-                    else:
-                        continue  # 忽略不支持的类型
-                    loaded_docs = loader.load()
-                    docs.extend(loaded_docs)
-                except Exception as e:
-                    print(f"⚠️ 加载文件失败: {path}, 错误: {e}")
-
-        if not docs:
+                if os.path.splitext(file)[1].lower() in LOADERS:
+                    paths.append(os.path.join(root, file))
+        return paths
+
+    def _annotate(self, path: str, doc):
+        """入库时补全元数据: 来源、扩展名、页码、入库时间、租户(data 下的一级子目录)"""
+        ingest_metadata(path, doc.metadata, self.data_dir)
+
+    def _load_and_split(self, path: str):
+        """加载并切分单个文件，失败返回 None。解析在子进程里进行，解析器崩溃或超时不会影响服务进程"""
+        result = next(iter_parallel_load([path], loaders=LOADERS, max_workers=1), None)
+        if result is None or result.docs is None:
+            return None
+        for doc in result.docs:
+            self._annotate(path, doc)
+        return text_splitter.split_documents(result.docs)
+
+    def _append_embeddings(self, docs, ids: List[str], vectors):
+        """把已经算好向量的一批文档块追加到下一个索引版本的 delta 层(向量 + 倒排索引 + 元数据列)"""
+        with self.snapshots.write(IndexState.fork) as draft:
+            if draft.vector_db is None:
+                # 空的 base，正文直接写进这个向量库目录的 chunk_store
+                draft.vector_db = empty_vector_db(embedder, len(vectors[0]), get_chunk_store(self.db_path))
+            draft.add(docs, ids, vectors)
+
+    async def _aembed_split_docs(self, split_docs, progress=None):
+        """异步批量 embedding，只算向量不写索引，返回 (ids, vectors)"""
+        ids = [str(uuid.uuid4()) for _ in split_docs]
+        vectors = [None] * len(split_docs)
+        async for start, batch in async_embedder.embed_batches([d.page_content for d in split_docs]):
+            vectors[start:start + len(batch)] = batch
+            if progress is not None:
+                progress.embedded(len(batch))
+        print(f"⚡ 异步 embedding 完成: {async_embedder.last_stats}")
+        return ids, vectors
+
+    def _commit(self, staged, removed_ids: List[str]):
+        """
+        把一次同步里所有文件的变更一次性提交: 删除旧向量、追加新向量、更新清单，
+        都在同一个写事务里完成(只复制一次 delta 层)，检索要么看到提交前的版本，要么看到提交后的。
+        delta 层和墓碑积累够多时顺带合并成新的 base
+        """
+        with self.snapshots.write(IndexState.fork) as draft:
+            old_ids = list(removed_ids)
+            for path, _, _, _, _ in staged:
+                old_ids.extend(self.manifest.ids_for(path))
+            self._delete_ids(old_ids)
+            for path, digest, docs, ids, vectors in staged:
+                if docs:
+                    self._append_embeddings(docs, ids, vectors)
+                self.manifest.record(path, digest, ids)
+            if draft.needs_compaction():
+                draft.compact()
+
+    def _delete_ids(self, ids: List[str]):
+        if not ids or self.vector_db is None:
+            return
+        # 只记墓碑，不移动任何位置，也不复制 base(见 IndexState.delete)
+        with self.snapshots.write(IndexState.fork) as draft:
+            draft.delete(ids)
+
+    def rebuild_from_data_dir(self, progress=None):
+        """从 data 目录扫描所有支持文档，重建向量库；progress 是入库任务(见 ingest_jobs)，用于上报进度"""
+        print("📂 从 data 目录重建向量库...")
+        # 新索引在旁边构建，期间检索仍然使用旧索引，构建完成后一次性替换
+        new_db, new_bm25, new_meta = None, BM25Index(), MetadataIndex()
+        self.manifest.clear()
+        # 流式管道: 多进程解析 -> 切分 -> embedding -> 按批写入索引，各级之间是有界队列；
+        # 正文每批直接写进 chunk_store，内存里只有向量索引、BM25 和元数据列
+        ingestor = StreamingIngestor(embedder, text_splitter, batch_size=INGEST_BATCH_SIZE, annotate=self._annotate,
+                                     docstore=get_chunk_store(self.db_path))
+        file_ids = {}
+        data_files = self._data_files()
+        if progress is not None:
+            progress.start(files_total=len(data_files))
+        documents = iter_parallel_documents(data_files, loaders=LOADERS)
+        for vector_db, paths, ids, chunks in ingestor.run(documents):
+            new_db = vector_db
+            for path, _id in zip(paths, ids):
+                if progress is not None and path not in file_ids:
+                    progress.file_parsed(path, 0)
+                file_ids.setdefault(path, []).append(_id)
+            new_bm25.add(ids, [d.page_content for d in chunks])
+            new_meta.append([d.metadata for d in chunks])
+            if progress is not None:
+                progress.embedded(len(ids))
+        for path, ids in file_ids.items():
+            self.manifest.record(path, file_sha256(path), ids)
+        total = ingestor.chunks
+
+        if total == 0:
+            self.manifest.load()
             print("⚠️ 没有有效文档，向量库未更新")
             return False
 
-        split_docs = text_splitter.split_documents(docs)
-
-        if self.vector_db is None:
-            self.vector_db = FAISS.from_documents(
-                documents=split_docs,
-                embedding=embedder
-            )
-        else:
-            self.vector_db = FAISS.from_documents(
-                documents=split_docs,
-                embedding=embedder
-            )
+        # 新版本整体替换旧版本；还在用旧版本检索的请求读完后旧版本才回收
+        old = self.snapshots.current
+        self.snapshots.publish(IndexState(new_db, new_bm25, new_meta))
+        if old.vector_db is not None:
+            # 旧版本的文档块打上删除标记(而不是变成孤儿记录)，固定着旧版本的读者用完之前不会被清理
+            old.vector_db.docstore.delete(list(old.ids()))
 
         self.save_db()
-        print(f"✅ 向量库重建完成，文档块数: {len(split_docs)}")
+        self.manifest.save()
+        print(f"✅ 向量库重建完成，文档块数: {total}, 向量缓存: {embedder.cache.stats()}")
         return True
 
-    def similarity_search(self, query: str, k=3):
+    async def async_sync_data_dir(self, progress=None):
+        """
+        增量同步 data 目录，供后台入库任务使用: 只对新增/修改的文件做解析(子进程)和向量化(异步批量管道)，
+        已删除的文件移除对应向量。所有变更先在索引之外准备好，最后一次性提交，提交前检索一直使用上一次提交的索引
+        """
+        if self.vector_db is not None and not self.manifest.exists():
+            return await asyncio.to_thread(self.rebuild_from_data_dir, progress)
+
+        present = await asyncio.to_thread(self._data_files)
+        changed = []
+        for path in present:
+            is_changed, digest = await asyncio.to_thread(self.manifest.is_changed, path)
+            if is_changed:
+                changed.append((path, digest))
+        if progress is not None:
+            progress.start(files_total=len(changed))
+
+        staged = []
+        try:
+            for path, digest in changed:
+                split_docs = await asyncio.to_thread(self._load_and_split, path)
+                if progress is not None:
+                    progress.file_parsed(path, len(split_docs or []))
+                if split_docs is None:
+                    continue
+                ids, vectors = await self._aembed_split_docs(split_docs, progress)
+                staged.append((path, digest, split_docs, ids, vectors))
+                print(f"➕ 增量入库: {path}, 文档块数: {len(split_docs)}")
+
+            removed_ids = []
+            for rel_path in self.manifest.missing_files(present):
+                removed_ids.extend(self.manifest.forget(rel_path))
+                print(f"➖ 文件已删除，移除向量: {rel_path}")
+
+            if staged or removed_ids:
+                await asyncio.to_thread(self._commit, staged, removed_ids)
+                await asyncio.to_thread(self.save_db)
+        except Exception:
+            # 未提交的清单改动全部撤销，下次同步会重新处理这些文件
+            self.manifest.load()
+            raise
+        self.manifest.save()
+        return True
+
+    def _embed_query(self, query: str, timings: Optional[dict]):
+        """查询向量走进程内 LRU，并发的相同查询只请求一次 Ollama"""
+        start = time.perf_counter()
+        embedding = embedder.embed_query(query)
+        if timings is not None:
+            timings["embed_ms"] = (time.perf_counter() - start) * 1000
+        return embedding
+
+    @staticmethod
+    def _layers(state: IndexState, filter: Optional[dict], timings: Optional[dict]):
+        """各层按元数据过滤条件和墓碑生成位图(见 metadata_index)；条件不合法抛 ValueError"""
+        start = time.perf_counter()
+        layers = state.layers(filter)
+        if filter and timings is not None:
+            timings["filter_ms"] = (time.perf_counter() - start) * 1000
+        return layers
+
+    def similarity_search(self, query: str, k=3, timings: Optional[dict] = None, embedding=None,
+                          filter: Optional[dict] = None):
+        """
+        timings 不为 None 时写入 embedding 和检索各自的耗时(ms)；embedding 已算好时直接用。
+        filter 是元数据过滤条件，例如 {"source": "a.pdf"}、{"ext": [".pdf", ".docx"], "ingested_after": 1700000000}
+        """
         if self.vector_db is None:
             return []
-        return self.vector_db.similarity_search(query, k=k)
+        if embedding is None:
+            embedding = self._embed_query(query, timings)
+        with self.snapshots.pin() as state:
+            if state.vector_db is None:
+                return []
+            layers = self._layers(state, filter, timings)
+            start = time.perf_counter()
+            # 位图作为 IDSelector 传进 faiss，在 ANN 搜索内部过滤
+            hits = layered_dense_search(state.vector_db, layers, [embedding], k)[0]
+            docs = [state.vector_db.docstore.search(_id) for _id, _ in hits]
+            docs = [d for d in docs if hasattr(d, "page_content")]
+        if timings is not None:
+            timings["search_ms"] = (time.perf_counter() - start) * 1000
+        return docs
 
+    def batch_search(self, queries: List[str], k=3, timings: Optional[dict] = None,
+                     filter: Optional[dict] = None) -> List[list]:
+        """
+        多个问题一起检索: 一次批量 embedding + 一次矩阵检索，
+        返回每个问题的 [(Document, 距离), ...]，顺序和 queries 一致；filter 对所有问题生效
+        """
+        if self.vector_db is None or not queries:
+            return [[] for _ in queries]
+        start = time.perf_counter()
+        embeddings = embedder.embed_queries(queries)
+        embed_done = time.perf_counter()
+        with self.snapshots.pin() as state:
+            if state.vector_db is None:
+                return [[] for _ in queries]
+            hits = layered_dense_search(state.vector_db, self._layers(state, filter, timings), embeddings, k)
+            search_done = time.perf_counter()
+            # 不同问题命中的文档块去重后一次取回
+            unique_ids = list(dict.fromkeys(_id for row in hits for _id, _ in row))
+            docstore = state.vector_db.docstore
+            if hasattr(docstore, "mget"):
+                docs = dict(zip(unique_ids, docstore.mget(unique_ids)))
+            else:
+                docs = {_id: docstore.search(_id) for _id in unique_ids}
+        results = [
+            [(docs[_id], score) for _id, score in row if hasattr(docs[_id], "page_content")]
+            for row in hits
+        ]
+        if timings is not None:
+            timings["embed_ms"] = (embed_done - start) * 1000
+            timings["search_ms"] = (search_done - embed_done) * 1000
+            timings["fetch_ms"] = (time.perf_counter() - search_done) * 1000
+        return results
 
-vector_db_manager = VectorDBManager()
+    def retrieve(self, query: str, k=3, mode=None, timings: Optional[dict] = None, embedding=None,
+                 filter: Optional[dict] = None):
+        """
+        问答用的检索入口: 默认 BM25 + 向量混合检索，型号等精确字符串不会被漏掉。
+        配置了精排模型时先多取 RERANK_FETCH_K 条，再用 cross-encoder 选出前 k 条。
+        filter 是元数据过滤条件，两路检索都只在符合条件的文档块里进行
+        """
+        fetch = max(k, RERANK_FETCH_K) if self.reranker is not None else k
+        if (mode or RETRIEVAL_MODE) == "dense":
+            docs = self.similarity_search(query, k=fetch, timings=timings, embedding=embedding, filter=filter)
+        else:
+            if self.vector_db is None:
+                return []
+            if embedding is None:
+                embedding = self._embed_query(query, timings)
+            with self.snapshots.pin() as state:
+                if state.vector_db is None:
+                    return []
+                docs = hybrid_search(state.vector_db, self._layers(state, filter, timings), query, k=fetch,
+                                     fetch_k=max(fetch, RETRIEVAL_FETCH_K), embedding=embedding, timings=timings)
+        if self.reranker is not None:
+            docs = self.reranker.rerank(query, docs, k, timings=timings)
+        return docs
+
+    async def aretrieve(self, query: str, k=3, mode=None, timings: Optional[dict] = None,
+                        filter: Optional[dict] = None):
+        """
+        FastAPI 处理函数用: 查询向量走异步 HTTP 客户端(不占线程)，
+        faiss/BM25 检索放到检索线程池，事件循环不被阻塞
+        """
+        if self.vector_db is None:
+            return []
+        start = time.perf_counter()
+        embedding = await embedder.aembed_query(query, query_embedder)
+        if timings is not None:
+            timings["embed_ms"] = (time.perf_counter() - start) * 1000
+        return await retrieval_executor.run(self.retrieve, query, k, mode, timings, embedding, filter)
+
+
+reranker = load_reranker()
+
+
+def open_namespace(namespace: str, db_path: str, data_dir: str) -> VectorDBManager:
+    manager = VectorDBManager(db_path, data_dir, readonly=SERVE_ROLE == "reader", reranker=reranker)
+    # 索引每发布一个新版本(入库提交、只读 worker 重新映射)，这个命名空间按旧版本缓存的问答就不会再命中了
+    manager.snapshots.on_publish = lambda version: answer_cache.invalidate(f"{namespace}#")
+    return manager
+
+
+# 多租户: 每个命名空间一个索引，第一次访问时加载，超出内存预算按 LRU 卸载(见 namespaces.py)；
+# 默认命名空间沿用 ./vector_db 和 ./data。
+# 多进程部署(python serving.py)时只读 worker 访问命名空间时检查写进程保存的新版本并重新映射，入库请求转发给写进程
+namespaces = NamespacePool(
+    open_namespace,
+    default_paths=(VECTOR_DB_PATH, DATA_DIR),
+    refresh_interval=REMAP_INTERVAL if SERVE_ROLE == "reader" else None
+)
+if SERVE_ROLE == "reader":
+    writer_client = WriterClient()
+
+# 问答缓存: 精确(问题+检索结果) + 语义(问题向量相似度)。
+# scope 里带命名空间、这次加载的序号和索引版本，向量库变化后旧条目不会再命中，发布新版本时按命名空间清掉
+answer_cache = AnswerCache(
+    embedder,
+    max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+)
+
+# 后台入库任务: 和入库执行器共用同一个事件循环线程，任务逐个执行，索引修改不会并发
+async def run_ingest_job(job):
+    namespace = job.namespace or DEFAULT_NAMESPACE
+    # 入库期间这个命名空间不会被卸载；加载(映射索引、重建 BM25)和卸载都是同步的，放到线程里，不阻塞入库事件循环
+    manager = await asyncio.to_thread(namespaces.acquire, namespace)
+    try:
+        success = await manager.async_sync_data_dir(progress=job)
+        if not success:
+            raise RuntimeError("没有有效文档，向量库未更新")
+        ntotal = manager.snapshots.current.ntotal
+        generation = current_generation(manager.db_path)
+    finally:
+        await asyncio.to_thread(namespaces.release, namespace)
+    await asyncio.to_thread(namespaces.update, namespace)
+    return {
+        "namespace": namespace,
+        "ntotal": ntotal,
+        # 只读 worker 映射到这个 generation 之后才能检索到新内容
+        "generation": generation
+    }
+
+ingest_jobs = IngestJobQueue(run_ingest_job, executor=ingestion_executor)
+
+# SSE 流缓冲: 断线重连时按 Last-Event-ID 续传，不重新生成
+sse_streams = SSEStreamRegistry(
+    ttl=float(os.getenv("SSE_BUFFER_TTL", "60")),
+    heartbeat=float(os.getenv("SSE_HEARTBEAT", "15"))
+)
+
+# 批量检索一次请求的上限
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "64"))
+BATCH_MAX_K = int(os.getenv("BATCH_MAX_K", "50"))
 
 # FastAPI 请求模型
 class RagRequest(BaseModel):
     question: str
     session_id: str = "default"
+    namespace: str = DEFAULT_NAMESPACE
+    # 元数据过滤: source / ext / tenant / page / ingested_after / ingested_before，见 metadata_index.py
+    filter: Optional[dict] = None
+
+class BatchRetrieveRequest(BaseModel):
+    # 一次请求的问题数和每个问题的条数都有上限，超出返回 422
+    queries: List[str] = Field(..., max_length=BATCH_MAX_QUERIES)
+    k: int = Field(3, ge=1, le=BATCH_MAX_K)
+    namespace: str = DEFAULT_NAMESPACE
+    filter: Optional[dict] = None
+
+# 租户名用作 data 下的子目录名
+TENANT_RE = re.compile(r"^[\w\-]{1,64}$")
+# 入库队列满时让客户端过这么多秒再重试(503 的 Retry-After)
+INGEST_RETRY_AFTER = int(os.getenv("INGEST_RETRY_AFTER", "5"))
 
 # FastAPI 路由 - 上传文件接口
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), tenant: Optional[str] = Form(None),
+                      namespace: str = Form(DEFAULT_NAMESPACE)):
+    if tenant is not None and not TENANT_RE.match(tenant):
+        raise HTTPException(status_code=400, detail=f"租户名不合法: {tenant}")
     try:
-        # 保存文件到 data 目录
-        Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
-        file_path = os.path.join(DATA_DIR, file.filename)
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-
-        # 重新构建向量库
-        success = vector_db_manager.rebuild_from_data_dir()
-        if not success:
-            return {"status": "error", "message": "没有有效文档，向量库未更新"}
+        check_namespace(namespace)
+        # 客户端给的文件名可能带路径(../other/x.pdf)，只取最后一段
+        filename = check_filename(file.filename)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if SERVE_ROLE == "reader":
+        # 多进程部署时只有写进程修改 data 目录和索引
+        status, body = await writer_client.upload(filename, await file.read(), tenant=tenant,
+                                                  namespace=namespace)
+        if status != 200:
+            headers = {"Retry-After": str(INGEST_RETRY_AFTER)} if status == 503 else None
+            raise HTTPException(status_code=status, detail=body.get("detail"), headers=headers)
+        return body
+    try:
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in LOADERS:
+            return {"status": "error", "message": f"不支持的文件类型: {ext}"}
+
+        # 保存文件到命名空间的 data 目录(指定租户时放在 data/<租户>/ 下，入库时记进元数据):
+        # 先写临时文件再原子替换，正在运行的入库任务不会读到写了一半的文件
+        _, data_dir = namespaces.paths(namespace)
+        target_dir = os.path.join(data_dir, tenant) if tenant else data_dir
+        Path(target_dir).mkdir(parents=True, exist_ok=True)
+        file_path = os.path.join(target_dir, filename)
+        tmp_path = os.path.join(target_dir, f".{filename}.{uuid.uuid4().hex}.tmp")
+        await asyncio.to_thread(Path(tmp_path).write_bytes, await file.read())
+        os.replace(tmp_path, file_path)
 
-        return {"status": "success", "message": f"文件 {file.filename} 上传成功，向量库已更新"}
+        # 增量更新向量库放到后台任务里，立即返回任务 id，进度通过 /jobs/{id} 查询
+        job = ingest_jobs.submit([os.path.relpath(file_path, data_dir)], namespace=namespace)
+        return {
+            "status": "queued",
+            "job_id": job.id,
+            "message": f"文件 {filename} 上传成功，正在后台更新向量库"
+        }
 
+    except ExecutorBusy as e:
+        # 入库队列已满: 文件已经保存，下次入库任务会一起处理；告诉客户端稍后重试
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(INGEST_RETRY_AFTER)})
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+# FastAPI 路由 - 入库任务进度: 已解析文件数、已向量化文档块数、预计剩余时间
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    if SERVE_ROLE == "reader":
+        status, body = await writer_client.get_json(f"/jobs/{job_id}")
+        if status != 200:
+            raise HTTPException(status_code=status, detail=body.get("detail"))
+        return body
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
+
+# FastAPI 路由 - 入库任务进度的 SSE 推送，任务结束时发送 done/failed 事件
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    if SERVE_ROLE == "reader":
+        return StreamingResponse(writer_client.stream(f"/jobs/{job_id}/events"),
+                                 media_type="text/event-stream", headers=SSE_HEADERS)
+    if ingest_jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return StreamingResponse(ingest_jobs.events(job_id), media_type="text/event-stream", headers=SSE_HEADERS)
+
+def _in_namespace(namespace: str, method: str, *args):
+    """在检索线程里执行: 取出(必要时加载)命名空间，调用它的 manager 方法，用完释放"""
+    with namespaces.use(namespace) as manager:
+        return getattr(manager, method)(*args)
+
+# FastAPI 路由 - 已加载的命名空间、估算内存和加载/卸载次数
+@app.get("/namespaces")
+async def namespace_stats():
+    return {"pool": namespaces.stats(), "namespaces": await asyncio.to_thread(namespaces.namespaces)}
+
+# FastAPI 路由 - 索引类型、召回率(相对 Flat)和查询耗时
+@app.get("/index/report")
+async def index_report(k: int = 10, namespace: str = DEFAULT_NAMESPACE):
+    try:
+        return await retrieval_executor.run(_in_namespace, namespace, "index_report", k)
+    except ExecutorBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# FastAPI 路由 - 批量检索，多个问题一次 embedding、一次向量检索
+@app.post("/retrieve/batch")
+async def retrieve_batch(request: BatchRetrieveRequest):
+    timings = {}
+    try:
+        results = await retrieval_executor.run(_in_namespace, request.namespace, "batch_search",
+                                               request.queries, request.k, timings, request.filter)
+    except ExecutorBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "results": [
+            [
+                {"id": doc.id, "content": doc.page_content, "metadata": doc.metadata, "score": score}
+                for doc, score in hits
+            ]
+            for hits in results
+        ],
+        "timings": timings
+    }
+
 # FastAPI 路由 - 问答接口，流式返回
 @app.post("/chat")
-async def rag_answer(request: RagRequest):
-    # 检索相关文档
-    docs = vector_db_manager.similarity_search(request.question, k=3)
-    context = "\n\n".join([doc.page_content for doc in docs])
-
-    async def generate_stream():
-        rag_prompt = ChatPromptTemplate.from_template(
-            "Context:\n{context}\n\nConversation History:\n{history}\n\nQuestion: {question}"
-        )
-        history = get_session_history(request.session_id)
-        rag_chain = rag_prompt | llm
+async def rag_answer(request: RagRequest, last_event_id: Optional[str] = Header(None)):
+    # 客户端断线重连: 缓冲区里还有这个流就从断点继续；续不上返回 410，不另外生成一个回答
+    try:
+        resumed = sse_streams.resume(last_event_id)
+    except StreamGone as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    if resumed is not None:
+        return StreamingResponse(resumed, media_type="text/event-stream", headers=SSE_HEADERS)
 
-        async for chunk in rag_chain.astream({
-            "context": context,
-            "history": history.messages,
-            "question": request.question
-        }):
-            yield str(chunk.content)
-            await asyncio.sleep(0.02)
+    # 检索相关文档(只在请求的命名空间里检索，第一次访问时加载)
+    timings = {}
+    try:
+        manager = await asyncio.to_thread(namespaces.acquire, request.namespace)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        docs = await manager.aretrieve(request.question, k=CONTEXT_FETCH_K, timings=timings, filter=request.filter)
+        # 问答缓存按命名空间 + 这次加载的序号 + 索引版本区分，加上过滤条件
+        cache_scope = f"{request.namespace}#{namespaces.epoch(request.namespace)}.{manager.version}"
+    except ExecutorBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        namespaces.release(request.namespace)
+    # 合并相邻块、去重，按相关度填满 token 预算
+    context, context_stats = assemble_context(docs)
+    chunk_ids = doc_ids(docs)
+    question_vector = await asyncio.to_thread(answer_cache.embed, request.question)
+    # 不同过滤条件的问答分开缓存，语义缓存不会拿别的范围的回答
+    if request.filter:
+        cache_scope += "|" + json.dumps(request.filter, sort_keys=True, ensure_ascii=False)
+    # 不同命名空间的同名会话互不相干
+    history_key = request.session_id if request.namespace == DEFAULT_NAMESPACE \
+        else f"{request.namespace}:{request.session_id}"
+    history = get_session_history(history_key)
+    # 历史只取 token 预算内的窗口(加摘要)，读存储放到线程里
+    history_messages = await asyncio.to_thread(lambda: history.messages)
+    # 有上文时回答依赖上文("它的价格呢?")，按历史窗口的指纹分开缓存，别的会话不会拿到这个回答
+    if history_messages:
+        cache_scope += "|history:" + history_fingerprint(history_messages)
+    cached = answer_cache.get(request.question, chunk_ids, question_vector, scope=cache_scope)
+    usage = {}
+
+    async def generate_tokens():
+        if cached is not None:
+            # 命中缓存: 按原来的分片重新流式返回
+            async for piece in replay_tokens(cached):
+                yield piece
+            pieces = list(cached)
+        else:
+            rag_prompt = ChatPromptTemplate.from_template(
+                "Context:\n{context}\n\nConversation History:\n{history}\n\nQuestion: {question}"
+            )
+            rag_chain = rag_prompt | llm
+            pieces = []
+            usage["history_tokens"] = sum(message_tokens(m) for m in history_messages)
 
-    return StreamingResponse(generate_stream(), media_type="text/event-stream")
+            async for chunk in rag_chain.astream({
+                "context": context,
+                "history": history_messages,
+                "question": request.question
+            }):
+                if getattr(chunk, "usage_metadata", None):
+                    usage.update(chunk.usage_metadata)
+                pieces.append(str(chunk.content))
+                yield pieces[-1]
+            # 完整生成结束才写缓存，中途断开的回答不缓存
+            answer_cache.put(request.question, chunk_ids, pieces, question_vector, scope=cache_scope)
+        # 这一轮问答写入会话历史，下一轮才能看到
+        await asyncio.to_thread(
+            history.add_messages, [HumanMessage(content=request.question), AIMessage(content="".join(pieces))]
+        )
+
+    # 检索各阶段耗时通过标准的 Server-Timing 响应头返回
+    server_timing = ", ".join(f"{name[:-3]};dur={ms:.2f}" for name, ms in timings.items())
+    # token 一到就转发，按字数/时间窗口合并成帧，写入 SSE 缓冲区；结束时发 done 事件带统计
+    stream_id = sse_streams.start(
+        coalesce_tokens(generate_tokens()),
+        stats=lambda: {"cached": cached is not None, "usage": usage, "retrieval_ms": timings,
+                       "context": context_stats}
+    )
+    return StreamingResponse(sse_streams.subscribe(stream_id), media_type="text/event-stream",
+                             headers={**SSE_HEADERS, "Server-Timing": server_timing})
 
 
 
 # ==== Streamlit 前端 ====
 
+def _stream_chat(question: str, session_id: str, stats: dict, max_retries: int = 3,
+                 namespace: str = DEFAULT_NAMESPACE):
+    """
+    读取 /chat 的 SSE 流，逐帧返回文本；连接中断时带 Last-Event-ID 重连，
+    服务端从缓冲区续传，不会重新生成。done 事件里的统计写进 stats。
+    服务端已经续不上(410)时报错，不重新提问: 已经显示的半截回答后面不会接上另一个回答
+    """
+    import requests
+    last_event_id = None
+    for attempt in range(max_retries + 1):
+        headers = {"Last-Event-ID": last_event_id} if last_event_id else {}
+        try:
+            with requests.post(
+                "http://localhost:8000/chat",
+                json={"question": question, "session_id": session_id, "namespace": namespace},
+                headers=headers,
+                stream=True,
+                timeout=(5, 60),
+            ) as response:
+                if response.status_code == 410:
+                    raise RuntimeError(f"连接中断后无法续传，回答不完整: {response.json().get('detail')}")
+                if response.status_code != 200:
+                    raise RuntimeError(f"接口调用失败: {response.text}")
+                for event_id, event, data in iter_sse(response.iter_lines(decode_unicode=True)):
+                    if event_id:
+                        last_event_id = event_id
+                    if event == "message":
+                        yield data
+                    elif event == "done":
+                        stats.update(json.loads(data))
+                        return
+                    elif event == "error":
+                        raise RuntimeError(data)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == max_retries:
+                raise
+            print(f"⚠️ 流式连接中断，第 {attempt + 1} 次重连: {last_event_id}")
+    raise RuntimeError("流式连接提前结束")
+
+
+def _wait_for_job(job_id: str, poll: float = 0.5):
+    """轮询入库任务进度并显示进度条，直到任务结束"""
+    import requests
+    bar = st.progress(0.0)
+    while True:
+        job = requests.get(f"http://localhost:8000/jobs/{job_id}", timeout=10).json()
+        total = job.get("chunks_total") or 0
+        done = job.get("chunks_embedded") or 0
+        eta = job.get("eta_seconds")
+        bar.progress(min(1.0, done / total) if total else 0.0,
+                     text=f"文件 {job['files_parsed']}/{job['files_total']}, 文档块 {done}/{total}"
+                          + (f", 预计剩余 {eta}s" if eta is not None else ""))
+        if job["status"] == "done":
+            bar.progress(1.0, text="向量库已更新")
+            return
+        if job["status"] == "failed":
+            st.error(f"入库失败: {job.get('error')}")
+            return
+        time.sleep(poll)
+
+
 def streamlit_app():
     st.title("RAG问答系统（FastAPI + Streamlit 集成示例）")
 
@@ -230,6 +1008,8 @@ def streamlit_app():
         st.session_state.messages = []
 
     with st.sidebar:
+        # 每个命名空间一个独立的知识库，上传和问答都只作用于当前命名空间
+        namespace = st.text_input("命名空间", value=DEFAULT_NAMESPACE)
         st.header("📂 上传文档 (PDF, DOCX, TXT)")
         uploaded_files = st.file_uploader("选择文件上传", type=["pdf", "docx", "txt"], accept_multiple_files=True)
         if st.button("上传并更新向量库"):
@@ -239,9 +1019,15 @@ def streamlit_app():
                     # 调用 FastAPI 上传接口
                     import requests
                     try:
-                        response = requests.post("http://localhost:8000/upload", files=files)
+                        response = requests.post("http://localhost:8000/upload", files=files,
+                                                 data={"namespace": namespace})
                         if response.status_code == 200:
-                            st.success(response.json().get("message"))
+                            result = response.json()
+                            if result.get("status") != "queued":
+                                st.error(result.get("message"))
+                                continue
+                            st.info(result.get("message"))
+                            _wait_for_job(result["job_id"])
                         else:
                             st.error(f"上传失败: {response.text}")
                     except Exception as e:
@@ -264,26 +1050,20 @@ def streamlit_app():
     if st.button("发送") and user_input.strip():
         st.session_state.messages.append({"role": "user", "content": user_input})
 
-        # 调用后端 /chat 接口获取回答（同步版简化）
-        import requests
+        # 调用后端 /chat 接口，按 SSE 事件逐帧显示，不再每行重跑整个页面
+        placeholder = st.empty()
+        stats = {}
+        answer = ""
         try:
-            response = requests.post(
-                "http://localhost:8000/chat",
-                json={"question": user_input, "session_id": st.session_state.session_id},
-                stream=True,
-            )
-            answer = ""
-            if response.status_code == 200:
-                for chunk in response.iter_lines(decode_unicode=True):
-                    if chunk:
-                        answer += chunk
-                        # 实时显示（简单刷新）
-                        st.session_state.messages[-1]["content"] = user_input
-                        st.experimental_rerun()
-                # 完整答案存入消息
-                st.session_state.messages.append({"role": "assistant", "content": answer})
-            else:
-                st.error(f"接口调用失败: {response.text}")
+            for answer in render_frames(_stream_chat(user_input, st.session_state.session_id, stats,
+                                                     namespace=namespace)):
+                placeholder.markdown(f"**助手:** {answer}▌")
+            placeholder.markdown(f"**助手:** {answer}")
+            # 完整答案存入消息
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+            if stats:
+                st.caption(f"首帧 {stats.get('first_frame_ms')} ms, 总耗时 {stats.get('total_ms')} ms"
+                           + (", 命中缓存" if stats.get("cached") else ""))
         except Exception as e:
             st.error(f"调用后端接口失败: {e}")
 
@@ -306,4 +1086,5 @@ if __name__ == "__main__":
     else:
         print("用法示例：")
         print("启动 API: python rag_app.py api")
+        print("多进程部署: python serving.py [worker 数]")
         print("启动 UI: python rag_app.py ui")
@@ -0,0 +1,183 @@
+# reranker.py
+# 可选的精排: 检索先多取(RERANK_FETCH_K 条)，再用本地小型 cross-encoder 给 (问题, 文档块) 打分，取前 k。
+# 两种 CPU 推理后端:
+#   - RERANK_ONNX 指向导出好的(可以是 int8 量化的) ONNX 模型文件时，用 onnxruntime + transformers 分词器
+#   - 否则用 sentence-transformers 的 CrossEncoder
+# 候选按长度排序后分批推理，减少 padding；分数按 (问题哈希, 文档块 id) 缓存
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+# 为空时不启用精排
+RERANK_MODEL = os.getenv("RERANK_MODEL", "")
+RERANK_ONNX = os.getenv("RERANK_ONNX", "")
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", "50"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "256"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "20000"))
+
+
+class _OnnxScorer:
+    def __init__(self, model_name: str, onnx_path: str, max_length: int):
+        import numpy as np
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.np = np
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.max_length = max_length
+
+    def __call__(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        encoded = self.tokenizer(
+            [q for q, _ in pairs], [p for _, p in pairs],
+            padding=True, truncation="only_second", max_length=self.max_length, return_tensors="np"
+        )
+        feed = {k: v.astype(self.np.int64) for k, v in encoded.items() if k in self.input_names}
+        logits = self.session.run(None, feed)[0]
+        return logits.reshape(len(pairs), -1)[:, 0].tolist()
+
+
+class _SentenceTransformersScorer:
+    def __init__(self, model_name: str, max_length: int):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+
+    def __call__(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        return [float(s) for s in self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)]
+
+
+class CrossEncoderReranker:
+    """
+    用法:
+        reranker = CrossEncoderReranker("BAAI/bge-reranker-base")
+        docs = reranker.rerank(question, candidates, k=3, timings=timings)
+    timings 里写入 rerank_ms(总耗时)和 rerank_batch_ms(平均每批推理耗时)
+    """
+
+    def __init__(self, model_name: str, onnx_path: str = "", batch_size: int = RERANK_BATCH_SIZE,
+                 max_length: int = RERANK_MAX_LENGTH, cache_size: int = RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        if onnx_path:
+            self.scorer = _OnnxScorer(model_name, onnx_path, max_length)
+        else:
+            self.scorer = _SentenceTransformersScorer(model_name, max_length)
+        self.cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.last_batch_ms: List[float] = []
+
+    @staticmethod
+    def _query_key(query: str) -> str:
+        return hashlib.sha1(query.strip().encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _doc_key(doc: Document) -> str:
+        # 没有 id 的文档块(旧格式)用正文哈希代替
+        return doc.id or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+    def score(self, query: str, docs: Sequence[Document]) -> List[float]:
+        return self._score(query, docs)[0]
+
+    def _score(self, query: str, docs: Sequence[Document]) -> Tuple[List[float], List[float]]:
+        """返回 (分数, 每批推理耗时 ms)"""
+        qkey = self._query_key(query)
+        keys = [(qkey, self._doc_key(d)) for d in docs]
+        scores: List[Optional[float]] = [None] * len(docs)
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    scores[i] = self.cache[key]
+            missing = [i for i, s in enumerate(scores) if s is None]
+            self.hits += len(docs) - len(missing)
+            self.misses += len(missing)
+
+        # 长度相近的放在同一批，padding 少
+        missing.sort(key=lambda i: len(docs[i].page_content))
+        batch_ms = []
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            t0 = time.perf_counter()
+            batch_scores = self.scorer([(query, docs[i].page_content) for i in batch])
+            batch_ms.append((time.perf_counter() - t0) * 1000)
+            for i, s in zip(batch, batch_scores):
+                scores[i] = s
+
+        with self.lock:
+            self.last_batch_ms = batch_ms
+            for i in missing:
+                self.cache[keys[i]] = scores[i]
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return scores, batch_ms
+
+    def rerank(self, query: str, docs: Sequence[Document], k: int, timings: Optional[dict] = None) -> List[Document]:
+        if not docs:
+            return []
+        start = time.perf_counter()
+        scores, batch_ms = self._score(query, docs)
+        ranked = sorted(zip(docs, scores), key=lambda item: item[1], reverse=True)[:k]
+        if timings is not None:
+            timings["rerank_ms"] = (time.perf_counter() - start) * 1000
+            if batch_ms:
+                timings["rerank_batch_ms"] = sum(batch_ms) / len(batch_ms)
+        return [doc for doc, _ in ranked]
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model_name,
+            "cache_entries": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "last_batch_ms": [round(ms, 2) for ms in self.last_batch_ms],
+        }
+
+
+def load_reranker(model_name: str = RERANK_MODEL, onnx_path: str = RERANK_ONNX) -> Optional[CrossEncoderReranker]:
+    """按配置加载精排模型；没有配置或依赖没装时返回 None(不精排)"""
+    if not model_name:
+        return None
+    try:
+        reranker = CrossEncoderReranker(model_name, onnx_path=onnx_path)
+        print(f"✅ 已加载精排模型: {model_name}{' (ONNX)' if onnx_path else ''}")
+        return reranker
+    except Exception as e:
+        print(f"⚠️ 精排模型加载失败，不启用精排: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    import sys
+    import random
+
+    # python reranker.py bench [模型名] [候选数]: 测一次精排的分批耗时(需要 RERANK_ONNX 时一并设置)
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        model = sys.argv[2] if len(sys.argv) > 2 else (RERANK_MODEL or "BAAI/bge-reranker-base")
+        n = int(sys.argv[3]) if len(sys.argv) > 3 else RERANK_FETCH_K
+        reranker = CrossEncoderReranker(model, onnx_path=RERANK_ONNX)
+        rng = random.Random(0)
+        docs = [
+            Document(id=str(i), page_content="".join(chr(rng.randint(0x4e00, 0x9fa5)) for _ in range(rng.randint(100, 400))))
+            for i in range(n)
+        ]
+        timings = {}
+        reranker.rerank("这个产品的保修期是多久", docs, k=3, timings=timings)
+        print(f"⚡ 首次 {n} 条: 总耗时 {timings['rerank_ms']:.1f}ms, 每批 {reranker.stats()['last_batch_ms']}")
+        timings = {}
+        reranker.rerank("这个产品的保修期是多久", docs, k=3, timings=timings)
+        print(f"⚡ 缓存命中: 总耗时 {timings['rerank_ms']:.2f}ms")
+    else:
+        print("用法: python reranker.py bench [模型名] [候选数]")
@@ -0,0 +1,91 @@
+# serving.py
+# 多进程部署: 一个写进程负责入库(只监听本机端口)，N 个只读 worker 对外提供问答和检索。
+# 只读 worker 以内存映射方式打开同一份向量库，faiss 索引和 chunk_store 走操作系统页缓存，
+# N 个进程只占一份内存；写进程每次保存会生成新的 generation 并原子替换 store.json，
+# 只读 worker 访问某个命名空间时发现指针变化就重新映射(见 namespaces.py)。上传和任务进度请求由只读 worker 转发给写进程
+# 用法(supervisor 本身不加载索引):
+#   python serving.py [worker 数] [端口]
+import os
+import sys
+import time
+import subprocess
+from typing import AsyncIterator, Optional, Tuple
+
+import httpx
+
+from namespaces import check_filename
+
+# single: 单进程(开发模式)，自己读写；writer: 只负责入库；reader: 只读，入库请求转发给 writer
+SERVE_ROLE = os.getenv("RAG_ROLE", "single")
+SERVE_WORKERS = int(os.getenv("RAG_WORKERS", str(os.cpu_count() or 2)))
+WRITER_HOST = os.getenv("RAG_WRITER_HOST", "127.0.0.1")
+WRITER_PORT = int(os.getenv("RAG_WRITER_PORT", "8001"))
+WRITER_URL = os.getenv("RAG_WRITER_URL", f"http://{WRITER_HOST}:{WRITER_PORT}")
+# 只读 worker 访问命名空间时，距上次检查 store.json 超过这个间隔(秒)才再检查一次
+REMAP_INTERVAL = float(os.getenv("RAG_REMAP_INTERVAL", "1.0"))
+
+
+class WriterClient:
+    """只读 worker 用: 把上传和任务查询转发给写进程"""
+
+    def __init__(self, base_url: str = WRITER_URL, timeout: float = 300):
+        self.client = httpx.AsyncClient(base_url=base_url, timeout=timeout)
+
+    async def upload(self, filename: str, data: bytes, tenant: Optional[str] = None,
+                     namespace: Optional[str] = None) -> Tuple[int, dict]:
+        form = {k: v for k, v in (("tenant", tenant), ("namespace", namespace)) if v}
+        files = {"file": (check_filename(filename), data)}
+        resp = await self.client.post("/upload", files=files, data=form or None)
+        return resp.status_code, resp.json()
+
+    async def get_json(self, path: str) -> Tuple[int, dict]:
+        resp = await self.client.get(path)
+        return resp.status_code, resp.json()
+
+    async def stream(self, path: str) -> AsyncIterator[bytes]:
+        async with self.client.stream("GET", path) as resp:
+            async for chunk in resp.aiter_raw():
+                yield chunk
+
+
+def _wait_for_writer(url: str, process: subprocess.Popen, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"写进程启动失败，退出码 {process.returncode}")
+        try:
+            httpx.get(f"{url}/docs", timeout=2)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    raise RuntimeError("等待写进程启动超时")
+
+
+def run_server(app: str, workers: Optional[int] = None, host: str = "0.0.0.0", port: int = 8000):
+    """先启动写进程并等它加载完索引，再以 workers 个只读进程对外服务(不开 reload)"""
+    import uvicorn
+
+    workers = workers or SERVE_WORKERS
+    writer = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", WRITER_HOST, "--port", str(WRITER_PORT)],
+        env={**os.environ, "RAG_ROLE": "writer"},
+    )
+    try:
+        _wait_for_writer(WRITER_URL, writer)
+        print(f"✅ 写进程已启动: {WRITER_URL}")
+        # worker 进程继承环境变量，据此以只读方式加载
+        os.environ["RAG_ROLE"] = "reader"
+        os.environ["RAG_WRITER_URL"] = WRITER_URL
+        print(f"⚡ 启动 {workers} 个只读 worker: http://{host}:{port}")
+        uvicorn.run(app, host=host, port=port, workers=workers)
+    finally:
+        writer.terminate()
+        writer.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    run_server(
+        "rag_app:app",
+        workers=int(sys.argv[1]) if len(sys.argv) > 1 else None,
+        port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000,
+    )
@@ -0,0 +1,428 @@
+# snapshots.py
+# 索引的写时复制版本: 读者固定(pin)当前版本后在锁外检索，写者复制出下一个版本修改，
+# 改完后原子替换"当前版本"指针。旧版本在最后一个读者用完后回收，
+# 读者永远不会看到改了一半的索引，入库期间检索也不用等写锁。
+# 版本之间共享不变的 base 层，写入只复制小的 delta 层(见 IndexState)
+import os
+import time
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+
+from ann_index import index_bytes
+from hybrid_retriever import BM25Index, SearchLayer
+from metadata_index import MetadataIndex
+from mmap_store import DeltaLayer, merge_vector_dbs
+
+# delta 层和墓碑合计超过 max(INDEX_DELTA_MIN_ROWS, INDEX_DELTA_RATIO × base 条数) 时合并成新的 base。
+# 合并要复制整个 base，按比例触发时每条写入平均只摊到常数次复制
+INDEX_DELTA_MIN_ROWS = int(os.getenv("INDEX_DELTA_MIN_ROWS", "10000"))
+INDEX_DELTA_RATIO = float(os.getenv("INDEX_DELTA_RATIO", "0.1"))
+
+
+class _DeltaStore:
+    """DeltaVectors 共享的存储: 只在末尾追加，写进去的行之后不再改动"""
+
+    __slots__ = ("vectors", "ids", "position_of", "size")
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.ids: List[str] = []
+        self.position_of: Dict[str, int] = {}
+        self.size = 0
+
+
+class _PrefixIds(Mapping):
+    """delta 层的位置 -> 文档块 id，只包含这个版本能看到的前 n 行"""
+
+    def __init__(self, ids: List[str], n: int):
+        self.ids = ids
+        self.n = n
+
+    def __getitem__(self, i) -> str:
+        i = int(i)
+        if i < 0 or i >= self.n:
+            raise KeyError(i)
+        return self.ids[i]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self.n))
+
+    def __len__(self):
+        return self.n
+
+
+class DeltaVectors:
+    """
+    delta 层的向量: 只追加的 float32 矩阵(按 2 倍预留容量) + 位置 -> 文档块 id。
+    各个版本共享同一份存储，每个版本只看前 n 行: 写者在末尾追加，已发布版本看到的行不会变，
+    写一次不用复制已有的向量。扩容时换成新数组(前面的行原样复制)，正在读旧数组的读者不受影响。
+    fork/append 只在持有写锁的草稿上调用
+    """
+
+    __slots__ = ("_store", "n", "metric", "normalize")
+
+    def __init__(self, dim: int, metric: int = faiss.METRIC_L2, normalize: bool = False,
+                 store: Optional[_DeltaStore] = None, n: int = 0):
+        self._store = store if store is not None else _DeltaStore(dim)
+        self.n = n
+        self.metric = metric
+        self.normalize = normalize
+
+    @classmethod
+    def like(cls, vector_db) -> "DeltaVectors":
+        """和 base 层维度、距离类型、归一化方式一致的空 delta 层"""
+        return cls(vector_db.index.d, vector_db.index.metric_type, vector_db._normalize_L2)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def index_to_docstore_id(self) -> _PrefixIds:
+        return _PrefixIds(self._store.ids, self.n)
+
+    def vectors(self) -> np.ndarray:
+        return self._store.vectors[:self.n]
+
+    def ids(self) -> List[str]:
+        return self._store.ids[:self.n]
+
+    def position(self, _id: str) -> Optional[int]:
+        position = self._store.position_of.get(_id)
+        return position if position is not None and position < self.n else None
+
+    def fork(self) -> "DeltaVectors":
+        """草稿用: 共用存储；之前丢弃的草稿追加过、没有发布的行先截掉"""
+        store = self._store
+        if store.size > self.n:
+            for _id in store.ids[self.n:]:
+                store.position_of.pop(_id, None)
+            del store.ids[self.n:]
+            store.size = self.n
+        return DeltaVectors(store.vectors.shape[1], self.metric, self.normalize, store, self.n)
+
+    def append(self, vectors, ids: List[str]):
+        vectors = np.array(vectors, dtype=np.float32)
+        if self.normalize:
+            faiss.normalize_L2(vectors)
+        store = self._store
+        end = self.n + len(ids)
+        if end > len(store.vectors):
+            grown = np.empty((max(end, 2 * len(store.vectors), 1024), store.vectors.shape[1]), dtype=np.float32)
+            grown[:self.n] = store.vectors[:self.n]
+            store.vectors = grown
+        store.vectors[self.n:end] = vectors
+        for position, _id in enumerate(ids, start=self.n):
+            store.position_of[_id] = position
+        store.ids.extend(ids)
+        store.size = self.n = end
+
+    def search(self, matrix: np.ndarray, k: int, selection=None):
+        """精确检索这个版本的行(selection 给出时只在选中的行里)，返回和 index.search 一样的 (距离, 位置)"""
+        vectors = self._store.vectors[:self.n]
+        rows = None
+        if selection is not None:
+            rows = np.flatnonzero(np.unpackbits(selection.bitmap, count=self.n, bitorder="little"))
+            vectors = vectors[rows]
+        k = min(k, len(vectors))
+        if k == 0:
+            return np.zeros((len(matrix), 0), dtype=np.float32), np.zeros((len(matrix), 0), dtype=np.int64)
+        distances, positions = faiss.knn(matrix, vectors, k, metric=self.metric)
+        if rows is not None:
+            positions = np.where(positions >= 0, rows[np.maximum(positions, 0)], -1)
+        return distances, positions
+
+    def memory_bytes(self) -> int:
+        return self._store.vectors.nbytes + len(self._store.ids) * 100
+
+
+class IndexState:
+    """
+    一个索引版本，分两层，发布之后不再修改:
+      - base: vector_db + bm25 + meta，上次合并时建好，各个版本共享同一份(只读 worker 直接映射磁盘文件)
+      - delta: 之后写入的文档块，delta(DeltaVectors) + delta_bm25 + delta_meta
+    两层共用 base 的 chunk_store。删除只记墓碑 dead(已删除的位置: base 是 0..nb-1，delta 接着编号)，
+    检索时跳过。写入一次只复制 delta 层的 BM25 和元数据列(向量只追加，见 DeltaVectors)，
+    和 base 的大小无关；delta 和墓碑积累到一定规模后由 compact() 合并成新的 base
+    """
+
+    __slots__ = ("vector_db", "bm25", "meta", "delta", "delta_bm25", "delta_meta", "dead", "_live")
+
+    def __init__(self, vector_db=None, bm25: Optional[BM25Index] = None, meta: Optional[MetadataIndex] = None,
+                 delta: Optional[DeltaVectors] = None, delta_bm25: Optional[BM25Index] = None,
+                 delta_meta: Optional[MetadataIndex] = None, dead: Optional[np.ndarray] = None):
+        self.vector_db = vector_db
+        self.bm25 = bm25 if bm25 is not None else BM25Index()
+        self.meta = meta if meta is not None else MetadataIndex()
+        if delta is None and vector_db is not None:
+            delta = DeltaVectors.like(vector_db)
+        self.delta = delta
+        self.delta_bm25 = delta_bm25 if delta_bm25 is not None else \
+            BM25Index(self.bm25.k1, self.bm25.b, self.bm25.max_df_ratio)
+        self.delta_meta = delta_meta if delta_meta is not None else MetadataIndex()
+        self.dead = dead if dead is not None else np.zeros(0, dtype=np.int64)
+        # 没有过滤条件时的检索层，第一次检索时生成
+        self._live: Optional[List[SearchLayer]] = None
+
+    @property
+    def base_size(self) -> int:
+        return self.vector_db.index.ntotal if self.vector_db is not None else 0
+
+    @property
+    def ntotal(self) -> int:
+        """能检索到的文档块数"""
+        return self.base_size + (len(self.delta) if self.delta is not None else 0) - len(self.dead)
+
+    def fork(self) -> "IndexState":
+        """复制出一个可以修改的草稿: base 原样共享，只复制 delta 层的 BM25 和元数据列，当前版本保持不变"""
+        return IndexState(self.vector_db, self.bm25, self.meta,
+                          self.delta.fork() if self.delta is not None else None,
+                          self.delta_bm25.copy(), self.delta_meta.copy(), self.dead)
+
+    def with_base(self, vector_db) -> "IndexState":
+        """换掉 base 的向量索引(例如转换索引类型，位置不变)，其余原样沿用"""
+        return IndexState(vector_db, self.bm25, self.meta, self.delta, self.delta_bm25, self.delta_meta, self.dead)
+
+    def with_bm25(self, bm25) -> "IndexState":
+        """换掉 base 的倒排表(内容相同，例如换成刚保存的映射版本)，其余原样沿用"""
+        return IndexState(self.vector_db, bm25, self.meta, self.delta, self.delta_bm25, self.delta_meta, self.dead)
+
+    def add(self, docs: List[Document], ids: List[str], vectors):
+        """草稿上追加一批文档块(ids 是新生成的): 正文写进 chunk_store，向量、BM25、元数据列追加到 delta 层"""
+        if self.delta is None:
+            self.delta = DeltaVectors.like(self.vector_db)
+        self.vector_db.docstore.add({
+            _id: Document(id=_id, page_content=doc.page_content, metadata=doc.metadata) for _id, doc in zip(ids, docs)
+        })
+        self.delta.append(vectors, ids)
+        self.delta_bm25.add(ids, [doc.page_content for doc in docs])
+        self.delta_meta.append([doc.metadata for doc in docs])
+        self._live = None
+
+    def delete(self, ids: Iterable[str]) -> List[str]:
+        """草稿上删除: 只记墓碑，不移动任何位置；delta 层的 BM25 直接删掉。返回确实存在的 id"""
+        if self.vector_db is None:
+            return []
+        nb = self.base_size
+        base_positions = self.meta.position_of(self.vector_db.index_to_docstore_id) if nb else {}
+        found, positions = [], []
+        for _id in ids:
+            position = self.delta.position(_id)
+            position = nb + position if position is not None else base_positions.get(_id)
+            if position is not None:
+                found.append(_id)
+                positions.append(position)
+        if not found:
+            return []
+        self.dead = np.union1d(self.dead, np.array(positions, dtype=np.int64))
+        self.delta_bm25.delete(found)
+        self.vector_db.docstore.delete(found)
+        self._live = None
+        return found
+
+    def needs_compaction(self) -> bool:
+        pending = (len(self.delta) if self.delta is not None else 0) + len(self.dead)
+        return pending > max(INDEX_DELTA_MIN_ROWS, INDEX_DELTA_RATIO * self.base_size)
+
+    def compact(self):
+        """
+        在草稿上原地合并: base 删掉墓碑、接上 delta 里没删的行，得到新的 base(都是新对象，旧 base 不动，
+        还在用旧版本的读者不受影响)，delta 和墓碑清空。要复制整个 base，由 needs_compaction() 控制频率
+        """
+        if self.vector_db is None:
+            return
+        nb = self.base_size
+        dead_base = self.dead[self.dead < nb]
+        live = np.setdiff1d(np.arange(len(self.delta)), self.dead[self.dead >= nb] - nb)
+        delta_ids = self.delta.ids()
+        vector_db = merge_vector_dbs(self.vector_db, dead_base, self.delta.vectors()[live],
+                                     [delta_ids[i] for i in live])
+        bm25 = self.bm25.copy()
+        bm25.delete([self.vector_db.index_to_docstore_id[int(p)] for p in dead_base])
+        bm25.merge(self.delta_bm25)
+        meta = self.meta.copy()
+        meta.delete(dead_base)
+        meta.extend(self.delta_meta, live)
+        self.vector_db, self.bm25, self.meta = vector_db, bm25, meta
+        self.delta = DeltaVectors.like(vector_db)
+        self.delta_bm25 = BM25Index(bm25.k1, bm25.b, bm25.max_df_ratio)
+        self.delta_meta = MetadataIndex()
+        self.dead = np.zeros(0, dtype=np.int64)
+        self._live = None
+
+    def layers(self, filter: Optional[dict] = None) -> List[SearchLayer]:
+        """
+        检索用的各层(见 hybrid_retriever.SearchLayer)，每层带上按 filter 过滤、去掉墓碑之后的位图；
+        过滤条件不合法时抛 ValueError。没有 filter 时的结果在这个版本上缓存
+        """
+        if self.vector_db is None:
+            return []
+        if not filter and self._live is not None:
+            return self._live
+        nb = self.base_size
+        base_ids = self.vector_db.index_to_docstore_id
+        layers = [SearchLayer(self.vector_db.index, base_ids, self.bm25,
+                              self.meta.select(filter, base_ids, exclude=self.dead[self.dead < nb]))]
+        if len(self.delta):
+            delta_ids = self.delta.index_to_docstore_id
+            delta_dead = self.dead[self.dead >= nb] - nb
+            layers.append(SearchLayer(self.delta, delta_ids, self.delta_bm25,
+                                      self.delta_meta.select(filter, delta_ids, exclude=delta_dead)))
+        if not filter:
+            self._live = layers
+        return layers
+
+    def ids(self) -> Iterator[str]:
+        """各层的文档块 id(含已经记了墓碑的)"""
+        if self.vector_db is not None:
+            yield from self.vector_db.index_to_docstore_id.values()
+            yield from self.delta.ids()
+
+    def delta_layer(self) -> DeltaLayer:
+        """保存用: delta 层和墓碑(见 mmap_store.save_mmap_store)"""
+        return DeltaLayer(self.delta.vectors(), self.delta.ids(), self.delta_meta, self.delta_bm25, self.dead)
+
+    def memory_bytes(self) -> int:
+        """估算占用的内存(向量索引 + BM25 + 元数据列，两层合计)"""
+        if self.vector_db is None:
+            return 0
+        return (index_bytes(self.vector_db.index) + self.delta.memory_bytes()
+                + self.bm25.memory_bytes() + self.delta_bm25.memory_bytes()
+                + self.meta.memory_bytes() + self.delta_meta.memory_bytes())
+
+
+class Snapshot:
+    __slots__ = ("version", "value", "readers", "retired", "published_at")
+
+    def __init__(self, version: int, value: Any):
+        self.version = version
+        self.value = value
+        self.readers = 0
+        self.retired = False
+        # 发布时间: 在这之前就删除的数据这个版本里不会有(写事务串行，删除总在发布它的那个版本之前)
+        self.published_at = time.time()
+
+
+class SnapshotManager:
+    """
+    用法:
+        snapshots = SnapshotManager(IndexState())
+        with snapshots.pin() as state:                  # 读: 固定当前版本
+            state.vector_db.similarity_search_by_vector(...)
+        with snapshots.write(IndexState.fork) as draft:  # 写: 在草稿上修改，退出时发布
+            draft.add(docs, ids, vectors)
+    写事务可以嵌套(同一线程里内层直接复用外层的草稿)，只在最外层退出时发布一次；
+    写事务里抛异常则丢弃草稿，当前版本不变
+    """
+
+    def __init__(self, value: Any = None, on_reclaim: Optional[Callable[[Any], None]] = None,
+                 on_publish: Optional[Callable[[int], None]] = None):
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._current = Snapshot(0, value)
+        self._retired: Dict[int, Snapshot] = {}
+        self.on_reclaim = on_reclaim
+        # 发布新版本后调用(参数是新版本号)，例如清掉按旧版本缓存的问答
+        self.on_publish = on_publish
+        self.reclaimed = 0
+
+    @property
+    def version(self) -> int:
+        return self._current.version
+
+    @property
+    def current(self) -> Any:
+        """当前版本的内容(不固定版本，只适合做 is None 之类的快速判断)"""
+        return self._current.value
+
+    def acquire(self) -> Snapshot:
+        with self._lock:
+            snapshot = self._current
+            snapshot.readers += 1
+            return snapshot
+
+    def release(self, snapshot: Snapshot):
+        with self._lock:
+            snapshot.readers -= 1
+            reclaim = snapshot.retired and snapshot.readers == 0
+            if reclaim:
+                self._retired.pop(snapshot.version, None)
+        if reclaim:
+            self._reclaim(snapshot)
+
+    @contextmanager
+    def pin(self) -> Iterator[Any]:
+        """固定当前版本直到退出；期间发布的新版本不影响这次读取"""
+        snapshot = self.acquire()
+        try:
+            yield snapshot.value
+        finally:
+            self.release(snapshot)
+
+    def publish(self, value: Any) -> int:
+        """原子替换当前版本，返回新版本号；旧版本没有读者时立即回收。和写事务互斥"""
+        with self._write_lock, self._lock:
+            old = self._current
+            self._current = Snapshot(old.version + 1, value)
+            version = self._current.version
+            old.retired = True
+            reclaim = old.readers == 0
+            if not reclaim:
+                self._retired[old.version] = old
+        if reclaim:
+            self._reclaim(old)
+        if self.on_publish is not None:
+            self.on_publish(version)
+        return version
+
+    @contextmanager
+    def write(self, fork: Callable[[Any], Any]) -> Iterator[Any]:
+        """写事务: 写者之间串行；草稿由 fork(当前版本) 得到，正常退出时发布"""
+        draft = getattr(self._local, "draft", None)
+        if draft is not None:
+            yield draft
+            return
+        with self._write_lock:
+            draft = fork(self._current.value)
+            self._local.draft = draft
+            try:
+                yield draft
+            finally:
+                self._local.draft = None
+            self.publish(draft)
+
+    @contextmanager
+    def exclusive(self) -> Iterator[Tuple[Any, Optional[float]]]:
+        """
+        挡住写事务直到退出(期间没有草稿在修改)，给出 (当前版本, 仍被读者固定的最早旧版本的发布时间)，
+        没有旧版本被固定时时间是 None。用于回收当前版本已经不用的数据，例如 chunk_store 里已删除的文档块:
+        在那个时间之前删除的，固定着的旧版本里也没有，可以回收
+        """
+        with self._write_lock:
+            with self._lock:
+                pinned_since = min((s.published_at for s in self._retired.values()), default=None)
+            yield self._current.value, pinned_since
+
+    def _reclaim(self, snapshot: Snapshot):
+        value, snapshot.value = snapshot.value, None
+        with self._lock:
+            self.reclaimed += 1
+        if self.on_reclaim is not None and value is not None:
+            self.on_reclaim(value)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "version": self._current.version,
+                "readers": self._current.readers,
+                "retired_pinned": {v: s.readers for v, s in self._retired.items()},
+                "oldest_pinned_age": round(time.time() - min(s.published_at for s in self._retired.values()), 1)
+                if self._retired else None,
+                "reclaimed": self.reclaimed,
+            }
@@ -0,0 +1,168 @@
+# sse.py
+# Server-Sent Events 协议: 每帧带 id 的 data 事件、结束时的 done 事件(用量和耗时统计)、定时心跳。
+# 生成过程在后台任务里跑，输出先写进服务端缓冲区，客户端断线后带 Last-Event-ID 重连，
+# 从断点继续读缓冲区，不会重新调用一次大模型。缓冲区在流结束 ttl 秒后释放；
+# 找不到 Last-Event-ID 对应的流(已过期，或多进程部署时重连到了别的 worker)时明确报错，
+# 不重新生成一个新回答接在客户端已经显示的半截回答后面(那样同一轮问答也会写两次历史)
+import re
+import json
+import time
+import uuid
+import asyncio
+from typing import AsyncIterable, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",  # 禁止 nginx 缓冲
+}
+# SSE 规范里 \r\n、单独的 \r 和 \n 都算换行
+_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+
+def format_event(data: str, event: Optional[str] = None, event_id: Optional[str] = None,
+                 retry_ms: Optional[int] = None) -> str:
+    """按 SSE 规范编码一个事件；data 里的换行(包括模型输出里单独的回车)拆成多行 data:，不会破坏分帧"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    if retry_ms is not None:
+        lines.append(f"retry: {retry_ms}")
+    lines.extend(f"data: {line}" for line in _LINE_BREAK.split(data))
+    return "\n".join(lines) + "\n\n"
+
+
+def parse_event_id(last_event_id: Optional[str]) -> Tuple[Optional[str], int]:
+    """事件 id 形如 "<stream_id>-<序号>"，返回 (stream_id, 序号)"""
+    if not last_event_id or "-" not in last_event_id:
+        return None, -1
+    stream_id, seq = last_event_id.rsplit("-", 1)
+    try:
+        return stream_id, int(seq)
+    except ValueError:
+        return None, -1
+
+
+class StreamGone(LookupError):
+    """带了 Last-Event-ID，但对应的流已经不在缓冲区里，无法续传"""
+
+
+class _Stream:
+    def __init__(self, stream_id: str):
+        self.stream_id = stream_id
+        self.events: List[Tuple[str, str]] = []  # (event, data)，下标即序号
+        self.done = False
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+
+class SSEStreamRegistry:
+    """
+    用法:
+        stream_id = sse_streams.start(frames, stats=lambda: {...})   # 后台开始生成
+        return StreamingResponse(sse_streams.subscribe(stream_id), ...)
+        # 断线重连: sse_streams.resume(request.headers.get("last-event-id"))，续不上时抛 StreamGone
+    """
+
+    def __init__(self, ttl: float = 60.0, heartbeat: float = 15.0, retry_ms: int = 1000):
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.retry_ms = retry_ms
+        self.streams: Dict[str, _Stream] = {}
+
+    def start(self, frames: AsyncIterable[str], stats: Optional[Callable[[], dict]] = None) -> str:
+        stream_id = uuid.uuid4().hex
+        stream = _Stream(stream_id)
+        self.streams[stream_id] = stream
+        stream.task = asyncio.create_task(self._produce(stream, frames, stats))
+        return stream_id
+
+    async def _append(self, stream: _Stream, event: str, data: str, done: bool = False):
+        async with stream.changed:
+            stream.events.append((event, data))
+            stream.done = done
+            stream.changed.notify_all()
+
+    async def _produce(self, stream: _Stream, frames: AsyncIterable[str], stats: Optional[Callable[[], dict]]):
+        start = time.perf_counter()
+        first_frame = None
+        chars = 0
+        try:
+            async for frame in frames:
+                if first_frame is None:
+                    first_frame = time.perf_counter()
+                chars += len(frame)
+                await self._append(stream, "message", frame)
+            summary = {
+                "frames": len(stream.events),
+                "chars": chars,
+                "first_frame_ms": round((first_frame - start) * 1000, 2) if first_frame else None,
+                "total_ms": round((time.perf_counter() - start) * 1000, 2),
+                **(stats() if stats else {}),
+            }
+            await self._append(stream, "done", json.dumps(summary, ensure_ascii=False, default=str), done=True)
+        except Exception as e:
+            await self._append(stream, "error", str(e), done=True)
+        finally:
+            asyncio.get_running_loop().call_later(self.ttl, self.streams.pop, stream.stream_id, None)
+
+    def resume(self, last_event_id: Optional[str]) -> Optional[AsyncIterator[str]]:
+        """
+        没带 Last-Event-ID 返回 None(新的请求)；对应的流还在缓冲区里就从断点续传；
+        带了但找不到(过期、格式不对、不在这个进程里)抛 StreamGone
+        """
+        if not last_event_id:
+            return None
+        stream_id, seq = parse_event_id(last_event_id)
+        if stream_id is None or stream_id not in self.streams:
+            raise StreamGone(f"流 {last_event_id} 已过期或不在这个服务进程上，无法续传")
+        return self.subscribe(stream_id, after=seq)
+
+    async def subscribe(self, stream_id: str, after: int = -1) -> AsyncIterator[str]:
+        """从序号 after 之后开始输出事件；没有新事件时每 heartbeat 秒发一次注释行保活"""
+        stream = self.streams[stream_id]
+        yield format_event("", event="open", retry_ms=self.retry_ms)
+        pos = after + 1
+        while True:
+            async with stream.changed:
+                if pos >= len(stream.events) and not stream.done:
+                    try:
+                        await asyncio.wait_for(stream.changed.wait(), timeout=self.heartbeat)
+                    except asyncio.TimeoutError:
+                        pass
+                events = stream.events[pos:]
+                done = stream.done
+            if not events and not done:
+                yield ": heartbeat\n\n"
+                continue
+            for event, data in events:
+                yield format_event(data, event=event, event_id=f"{stream_id}-{pos}")
+                pos += 1
+            if done and pos >= len(stream.events):
+                return
+
+
+def iter_sse(lines: Iterable[str]) -> Iterator[Tuple[Optional[str], str, str]]:
+    """客户端解析: 输入逐行文本(如 requests 的 iter_lines)，输出 (事件 id, 事件类型, data)"""
+    event_id, event, data = None, "message", []
+    for line in lines:
+        if line is None:
+            continue
+        if line == "":
+            if data:
+                yield event_id, event, "\n".join(data)
+            event, data = "message", []
+            continue
+        if line.startswith(":"):
+            continue  # 心跳/注释
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            data.append(value)
+        elif field == "event":
+            event = value
+        elif field == "id":
+            event_id = value
@@ -1,7 +1,6 @@
 # 完整示例：基于Streamlit + LangChain + DeepSeek实现多格式文档RAG聊天
 
 import os
-import time
 import uuid
 import getpass
 import streamlit as st
@@ -18,6 +17,10 @@ from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
 from langchain_deepseek import ChatDeepSeek
 from langchain_ollama import OllamaEmbeddings
+from embedding_cache import CachedEmbeddings
+from token_stream import render_frames
+from context_builder import CONTEXT_FETCH_K, assemble_context
+from vector_wal import open_wal_store
 
 # 导入不同格式文档加载器
 from langchain_community.document_loaders import (
@@ -44,7 +47,7 @@ if not os.getenv("DEEPSEEK_API_KEY"):
     os.environ["DEEPSEEK_API_KEY"] = getpass.getpass("请输入你的 DeepSeek API Key: ")
 
 # ========== 全局组件初始化 ==========
-embedder = OllamaEmbeddings(model="nomic-embed-text")
+embedder = CachedEmbeddings(OllamaEmbeddings(model="nomic-embed-text"))
 text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
 
 llm = ChatDeepSeek(
@@ -97,19 +100,16 @@ class VectorDBManager:
         self.load_db()
 
     def load_db(self):
-        if os.path.exists(self.db_path):
-            try:
-                self.vector_db = FAISS.load_local(
-                    self.db_path,
-                    embedder,
-                    allow_dangerous_deserialization=True
-                )
+        try:
+            self.store = open_wal_store(self.db_path, embedder)
+            self.vector_db = self.store.vector_db
+            if self.vector_db is not None:
                 st.info("✅ 已加载现有向量数据库")
                 print("✅ 已加载现有向量数据库")
-            except Exception as e:
-                st.warning(f"⚠️ 向量数据库加载失败: {e}")
-                print(f"⚠️ 向量数据库加载失败: {e}")
-                self.vector_db = None
+        except Exception as e:
+            st.warning(f"⚠️ 向量数据库加载失败: {e}")
+            print(f"⚠️ 向量数据库加载失败: {e}")
+            self.vector_db = None
 
     def process_uploaded_file(self, file: UploadFile) -> List[Document]:
         try:
@@ -153,18 +153,16 @@ class VectorDBManager:
             st.warning("⚠️ 没有可添加的文档")
             return
         try:
-            if self.vector_db is None:
-                self.vector_db = FAISS.from_documents(documents, embedder)
-            else:
-                self.vector_db.add_documents(documents)
-            self.save_db()
+            # 只追加 WAL，后台线程负责合并进主索引
+            self.store.add_documents(documents)
+            self.vector_db = self.store.vector_db
         except Exception as e:
             st.error(f"添加文档到向量数据库出错: {e}")
             print(f"添加文档出错: {e}")
 
     def save_db(self):
         if self.vector_db:
-            self.vector_db.save_local(self.db_path)
+            self.store.compact()
             st.info(f"✅ 向量数据库已保存到 {self.db_path}")
             print(f"✅ 向量数据库已保存到 {self.db_path}")
 
@@ -232,8 +230,9 @@ if prompt := st.chat_input("请输入你的问题..."):
         st.markdown(prompt)
 
     # 搜索相关文档上下文
-    docs = vector_db_manager.similarity_search(prompt, k=3)
-    context = "\n\n".join([doc.page_content for doc in docs])
+    docs = vector_db_manager.similarity_search(prompt, k=CONTEXT_FETCH_K)
+    # 合并相邻块、去重，按相关度填满 token 预算
+    context, context_stats = assemble_context(docs)
 
     # 构建输入给模型
     inputs = {
@@ -250,10 +249,12 @@ if prompt := st.chat_input("请输入你的问题..."):
     with st.chat_message("assistant"):
         placeholder = st.empty()
         response_text = ""
-        for chunk in response:
-            response_text += chunk
+        # 分片一到就接收，只按 UI_RENDER_INTERVAL 限制重绘频率
+        for response_text in render_frames(response):
             placeholder.markdown(response_text + "▌")
-            time.sleep(0.02)
         placeholder.markdown(response_text)
+        st.caption(f"上下文 {context_stats['context_tokens']} tokens"
+                   f"(合并 {context_stats['merged']} 块，去重 {context_stats['duplicates']} 段，"
+                   f"节省 {context_stats['saved_tokens']} tokens)")
 
     st.session_state.messages.append({"role": "assistant", "content": response_text})
@@ -4,7 +4,6 @@ from dotenv import load_dotenv
 import os
 from pathlib import Path
 import getpass
-import time
 import uuid
 
 import streamlit as st
@@ -12,6 +11,12 @@ from fastapi import UploadFile
 
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
+from embedding_cache import CachedEmbeddings
+from token_stream import render_frames
+from context_builder import CONTEXT_FETCH_K, assemble_context
+from history_store import history_getter
+from history_window import windowed_history_getter
+from vector_wal import open_wal_store
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.chat_history import BaseChatMessageHistory
@@ -21,8 +26,7 @@ from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_deepseek import ChatDeepSeek
 from langchain_core.documents import Document
 
-from PIL import Image
-import pytesseract
+from parallel_loader import SimpleImageLoader, iter_parallel_load
 
 from langchain_community.document_loaders import (
     PyPDFLoader,
@@ -42,8 +46,6 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
-if "session_store" not in st.session_state:
-    st.session_state.session_store = {}
 
 load_dotenv()
 if not os.getenv("DEEPSEEK_API_KEY"):
@@ -53,7 +55,7 @@ DATA_DIR = "./data"
 VECTOR_DB_PATH = "./vector_db"
 os.makedirs(DATA_DIR, exist_ok=True)
 
-embedder = OllamaEmbeddings(model="nomic-embed-text")
+embedder = CachedEmbeddings(OllamaEmbeddings(model="nomic-embed-text"))
 text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
 
 llm = ChatDeepSeek(model="deepseek-chat", temperature=0, streaming=True)
@@ -75,10 +77,9 @@ prompt = ChatPromptTemplate.from_messages([
 
 base_chain = prompt | llm | parser
 
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in st.session_state.session_store:
-        st.session_state.session_store[session_id] = ChatMessageHistory()
-    return st.session_state.session_store[session_id]
+# 会话历史: Redis 或 sqlite，按会话过期、限制条数
+# 只把 token 预算内的最近几轮放进 prompt，更早的轮次在后台压缩成摘要
+get_session_history = windowed_history_getter(history_getter(), llm=llm)
 
 chat_chain = RunnableWithMessageHistory(
     base_chain,
@@ -87,13 +88,21 @@ chat_chain = RunnableWithMessageHistory(
     history_messages_key="history"
 )
 
-class SimpleImageLoader:
-    def __init__(self, path):
-        self.path = path
-
-    def load(self):
-        text = pytesseract.image_to_string(Image.open(self.path))
-        return [Document(page_content=text)]
+LOADERS = {
+    '.pdf': PyPDFLoader,
+    '.docx': Docx2txtLoader,
+    '.doc': Docx2txtLoader,
+    '.txt': TextLoader,
+    '.pptx': UnstructuredPowerPointLoader,
+    '.ppt': UnstructuredPowerPointLoader,
+    '.html': UnstructuredHTMLLoader,
+    '.htm': UnstructuredHTMLLoader,
+    '.csv': UnstructuredCSVLoader,
+    '.md': UnstructuredMarkdownLoader,
+    '.jpg': SimpleImageLoader,
+    '.jpeg': SimpleImageLoader,
+    '.png': SimpleImageLoader
+}
 
 class VectorDBManager:
     def __init__(self, db_path=VECTOR_DB_PATH):
@@ -102,69 +111,33 @@ class VectorDBManager:
         self.load_db()
 
     def load_db(self):
-        if os.path.exists(self.db_path):
-            try:
-                self.vector_db = FAISS.load_local(
-                    self.db_path,
-                    embedder,
-                    allow_dangerous_deserialization=True
-                )
-                st.info("✅ 已加载现有向量数据库")
-            except Exception as e:
-                st.warning(f"⚠️ 向量数据库为空: {e}")
-                self.vector_db = None
-
-    def process_uploaded_file(self, file: UploadFile):
         try:
-            temp_dir = "./temp_uploads"
-            os.makedirs(temp_dir, exist_ok=True)
-            file_path = os.path.join(temp_dir, file.name)
-            with open(file_path, "wb") as f:
-                f.write(file.getbuffer())
-
-            ext = os.path.splitext(file.name)[1].lower()
-            loaders = {
-                '.pdf': PyPDFLoader,
-                '.docx': Docx2txtLoader,
-                '.doc': Docx2txtLoader,
-                '.txt': TextLoader,
-                '.pptx': UnstructuredPowerPointLoader,
-                '.ppt': UnstructuredPowerPointLoader,
-                '.html': UnstructuredHTMLLoader,
-                '.htm': UnstructuredHTMLLoader,
-                '.csv': UnstructuredCSVLoader,
-                '.md': UnstructuredMarkdownLoader,
-                '.jpg': SimpleImageLoader,
-                '.jpeg': SimpleImageLoader,
-                '.png': SimpleImageLoader
-            }
-
-            if ext not in loaders:
-                raise ValueError(f"不支持的文件类型: {ext}")
-
-            loader = loaders[ext](file_path)
-            docs = loader.load()
-            splits = text_splitter.split_documents(docs)
-
-            os.remove(file_path)
-            return splits
-
+            self.store = open_wal_store(self.db_path, embedder)
+            self.vector_db = self.store.vector_db
+            if self.vector_db is not None:
+                st.info("✅ 已加载现有向量数据库")
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            st.error(f"❌ 文件处理错误: {e}")
-            raise
+            st.warning(f"⚠️ 向量数据库为空: {e}")
+            self.vector_db = None
+
+    def process_saved_files(self, paths):
+        """多进程并行解析已保存的文件(OCR 也在子进程里跑)，按完成顺序切分"""
+        splits = []
+        for result in iter_parallel_load(paths, loaders=LOADERS):
+            if result.docs is None:
+                st.error(f"❌ 文件处理错误: {os.path.basename(result.path)}: {result.error}")
+                continue
+            splits.extend(text_splitter.split_documents(result.docs))
+        return splits
 
     def add_documents(self, documents):
-        if self.vector_db is None:
-            self.vector_db = FAISS.from_documents(documents=documents, embedding=embedder)
-        else:
-            self.vector_db.add_documents(documents)
-        self.save_db()
+        # 只追加 WAL，后台线程负责合并进主索引
+        self.store.add_documents(documents)
+        self.vector_db = self.store.vector_db
 
     def save_db(self):
         if self.vector_db:
-            self.vector_db.save_local(self.db_path)
+            self.store.compact()
             st.info(f"✅ 向量数据库已保存至 {self.db_path}")
 
     def similarity_search(self, query, k=3):
@@ -184,13 +157,14 @@ with st.sidebar:
 
     if st.button("📥 上传并重建向量库"):
         if uploaded_files:
-            documents = []
+            saved_paths = []
             for file in uploaded_files:
                 save_path = os.path.join(DATA_DIR, file.name)
-                documents += vector_db_manager.process_uploaded_file(file)
                 with open(save_path, "wb") as f:
                     f.write(file.getbuffer())
+                saved_paths.append(save_path)
                 st.info(f"{file.name} 已保存至 {save_path}")
+            documents = vector_db_manager.process_saved_files(saved_paths)
             if documents:
                 vector_db_manager.add_documents(documents)
         else:
@@ -198,7 +172,7 @@ with st.sidebar:
 
     if st.button("🧹 清空聊天历史"):
         st.session_state.messages = []
-        st.session_state.session_store = {}
+        get_session_history(st.session_state.session_id).clear()
         st.rerun()
 
 for msg in st.session_state.messages:
@@ -210,8 +184,9 @@ if prompt := st.chat_input("请输入你的问题..."):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    docs = vector_db_manager.similarity_search(prompt, k=3)
-    context = "\n\n".join([doc.page_content for doc in docs])
+    docs = vector_db_manager.similarity_search(prompt, k=CONTEXT_FETCH_K)
+    # 合并相邻块、去重，按相关度填满 token 预算
+    context, context_stats = assemble_context(docs)
 
     response = chat_chain.stream(
         input={
@@ -225,10 +200,12 @@ if prompt := st.chat_input("请输入你的问题..."):
     with st.chat_message("assistant"):
         placeholder = st.empty()
         response_text = ""
-        for chunk in response:
-            response_text += chunk
+        # 分片一到就接收，只按 UI_RENDER_INTERVAL 限制重绘频率
+        for response_text in render_frames(response):
             placeholder.markdown(response_text + "▌")
-            time.sleep(0.005)
         placeholder.markdown(response_text)
+        st.caption(f"上下文 {context_stats['context_tokens']} tokens"
+                   f"(合并 {context_stats['merged']} 块，去重 {context_stats['duplicates']} 段，"
+                   f"节省 {context_stats['saved_tokens']} tokens)")
 
     st.session_state.messages.append({"role": "assistant", "content": response_text})
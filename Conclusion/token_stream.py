@@ -0,0 +1,82 @@
+# token_stream.py
+# 流式输出的流控: 模型吐出的 token 一到就转发，不再每个分片固定 sleep。
+# 服务端按字数或时间窗口把零碎 token 合并成帧再发送，减少小包和系统调用；
+# 合并后的帧由 SSE 缓冲区的后台任务(见 sse.py)按模型的速度拉取，不跟随客户端的读取速度:
+# 客户端读得慢或断开时帧在缓冲区里排队，回答照样生成完(供断线续传、写入会话历史)，
+# 流结束 ttl 秒后缓冲区释放。Streamlit 端只限制重绘频率，不影响接收速度
+import os
+import time
+import asyncio
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List
+
+# 一帧最多攒多少个字符 / 第一个 token 到达后最多等多久就发出
+STREAM_FRAME_CHARS = int(os.getenv("STREAM_FRAME_CHARS", "64"))
+STREAM_FRAME_MS = float(os.getenv("STREAM_FRAME_MS", "30"))
+# Streamlit 两次重绘之间的最小间隔(秒)，只影响界面刷新，不影响生成
+UI_RENDER_INTERVAL = float(os.getenv("UI_RENDER_INTERVAL", "0.05"))
+
+
+async def coalesce_tokens(tokens: AsyncIterable[str], max_chars: int = STREAM_FRAME_CHARS,
+                          max_delay_ms: float = STREAM_FRAME_MS) -> AsyncIterator[str]:
+    """
+    把 token 流合并成帧: 攒够 max_chars 个字符，或者第一个 token 等了 max_delay_ms 毫秒，就立即发出。
+    上游只预读一个 token: 拉取速度由调用方决定(在 /chat 里是 SSE 缓冲区的后台任务，不是客户端)
+    """
+    loop = asyncio.get_running_loop()
+    upstream = tokens.__aiter__()
+    buffer: List[str] = []
+    size = 0
+    deadline = None
+    pending = asyncio.ensure_future(upstream.__anext__())
+    try:
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if pending in done:
+                try:
+                    token = pending.result()
+                except StopAsyncIteration:
+                    break
+                pending = asyncio.ensure_future(upstream.__anext__())
+                if not token:
+                    continue
+                buffer.append(token)
+                size += len(token)
+                if deadline is None:
+                    deadline = loop.time() + max_delay_ms / 1000
+                if size < max_chars:
+                    continue
+            if buffer:
+                yield "".join(buffer)
+            buffer, size, deadline = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if not pending.done():
+            pending.cancel()
+
+
+async def replay_tokens(pieces: Iterable[str]) -> AsyncIterator[str]:
+    """把缓存里的分片当作 token 流重新走一遍合并逻辑"""
+    for piece in pieces:
+        yield piece
+
+
+def render_frames(chunks: Iterable[str], interval: float = UI_RENDER_INTERVAL) -> Iterator[str]:
+    """
+    Streamlit 用: 逐个接收分片，但最多每 interval 秒给出一次累积文本用于重绘；
+    最后一定给出完整文本
+    """
+    text = ""
+    last_render = 0.0
+    rendered = True
+    for chunk in chunks:
+        text += chunk
+        rendered = False
+        now = time.monotonic()
+        if now - last_render >= interval:
+            last_render = now
+            rendered = True
+            yield text
+    if not rendered:
+        yield text
@@ -0,0 +1,263 @@
+# vector_wal.py
+# 向量库的预写日志(WAL): 新增/删除只往日志末尾追加一条记录(O(批大小))，不再每次全量保存索引。
+# 后台线程在日志超过大小或时间阈值时做合并(compaction): 把当前索引写成新的 generation，
+# 并记下从哪个日志段开始回放；启动时只回放这个段之后的日志。
+# 文档正文已经由 chunk_store 持久化，日志里只记录向量和 id
+import os
+import json
+import time
+import uuid
+import zlib
+import struct
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+
+from mmap_store import get_chunk_store, is_mmap_store, load_vector_store, read_store_meta, save_vector_store
+
+WAL_DIR = "wal"
+_HEADER = struct.Struct("<II")  # (header 长度, 向量字节数)
+_CRC = struct.Struct("<I")
+
+
+def _segment_name(seq: int) -> str:
+    return f"seg-{seq:06d}.log"
+
+
+def _segment_seq(name: str) -> int:
+    return int(name[4:10])
+
+
+class WriteAheadLog:
+    """按段切分的追加日志，每条记录: 定长头 + json 头 + float32 向量 + crc32"""
+
+    def __init__(self, wal_dir: str, fsync: bool = True):
+        os.makedirs(wal_dir, exist_ok=True)
+        self.wal_dir = wal_dir
+        self.fsync = fsync
+        seqs = self.segments()
+        self.seq = seqs[-1] if seqs else 1
+        self.file = open(os.path.join(wal_dir, _segment_name(self.seq)), "ab")
+
+    def segments(self) -> List[int]:
+        return sorted(_segment_seq(n) for n in os.listdir(self.wal_dir) if n.startswith("seg-"))
+
+    def append(self, op: str, ids: List[str], vectors: Optional[np.ndarray] = None):
+        meta = {"op": op, "ids": ids}
+        payload = b""
+        if vectors is not None:
+            meta["dim"] = int(vectors.shape[1])
+            payload = np.ascontiguousarray(vectors, dtype=np.float32).tobytes()
+        header = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+        record = _HEADER.pack(len(header), len(payload)) + header + payload
+        self.file.write(record + _CRC.pack(zlib.crc32(record)))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def size(self) -> int:
+        """所有还没合并进主索引的日志段的总字节数"""
+        return sum(os.path.getsize(os.path.join(self.wal_dir, _segment_name(s))) for s in self.segments())
+
+    def rotate(self) -> int:
+        """关闭当前段并开始新段，返回新段号(合并后从这个段开始回放)"""
+        self.file.close()
+        self.seq += 1
+        self.file = open(os.path.join(self.wal_dir, _segment_name(self.seq)), "ab")
+        return self.seq
+
+    def drop_before(self, seq: int):
+        for s in self.segments():
+            if s < seq:
+                os.remove(os.path.join(self.wal_dir, _segment_name(s)))
+
+    def replay(self, from_seq: int) -> Iterator[Tuple[dict, Optional[np.ndarray]]]:
+        """依次读出 from_seq 及之后各段的记录；遇到写了一半的尾部记录就截断丢弃"""
+        for s in self.segments():
+            if s < from_seq:
+                continue
+            path = os.path.join(self.wal_dir, _segment_name(s))
+            good_end = 0
+            with open(path, "rb") as f:
+                data = f.read()
+            pos = 0
+            while pos + _HEADER.size <= len(data):
+                header_len, payload_len = _HEADER.unpack_from(data, pos)
+                end = pos + _HEADER.size + header_len + payload_len
+                if end + _CRC.size > len(data):
+                    break
+                record = data[pos:end]
+                if _CRC.unpack_from(data, end)[0] != zlib.crc32(record):
+                    break
+                header = json.loads(record[_HEADER.size:_HEADER.size + header_len])
+                vectors = None
+                if payload_len:
+                    vectors = np.frombuffer(record[_HEADER.size + header_len:], dtype=np.float32)
+                    vectors = vectors.reshape(-1, header["dim"])
+                yield header, vectors
+                pos = good_end = end + _CRC.size
+            if good_end < len(data):
+                print(f"⚠️ WAL 段 {_segment_name(s)} 尾部有不完整记录，已截断")
+                with open(path, "r+b") as f:
+                    f.truncate(good_end)
+
+    def close(self):
+        self.file.close()
+
+
+class WalVectorStore:
+    """
+    带 WAL 的可写向量库:
+        store = open_wal_store("./vector_db", embedder)
+        store.add_documents(docs)   # 追加日志 + 更新内存索引，不重写整个索引
+        store.vector_db             # 供 similarity_search 使用的 FAISS 对象
+    """
+
+    def __init__(self, db_path: str, embedder, compact_bytes: int = 64 << 20,
+                 compact_interval: float = 600.0, check_interval: float = 5.0):
+        self.db_path = db_path
+        self.embedder = embedder
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+        self.lock = threading.RLock()
+        # 合并从切换日志段到写盘、删旧段必须串行: 否则后台合并和 save/close 触发的合并交错，
+        # 段号小的一次后写 store.json，会把已经删掉的日志段当成回放起点
+        self._compact_lock = threading.Lock()
+        self.vector_db: Optional[FAISS] = None
+        self.last_compact = time.monotonic()
+
+        os.makedirs(db_path, exist_ok=True)
+        if is_mmap_store(db_path):
+            self.vector_db = load_vector_store(db_path, embedder, mmap=False)
+        elif os.path.exists(os.path.join(db_path, "index.faiss")):
+            # 旧的 index.pkl 格式: 先整体转换一次，让正文进入 chunk_store
+            self.vector_db = load_vector_store(db_path, embedder, mmap=False)
+            save_vector_store(self.vector_db, db_path, extra_meta={"wal_segment": 1})
+        start_seq = read_store_meta(db_path).get("wal_segment", 1) if is_mmap_store(db_path) else 1
+        self.wal = WriteAheadLog(os.path.join(db_path, WAL_DIR))
+        replayed = self._replay(start_seq)
+        if replayed:
+            print(f"✅ WAL 回放 {replayed} 条记录")
+
+        self._stop = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, args=(check_interval,), daemon=True)
+        self._compactor.start()
+
+    # ---------- 内部 ----------
+    def _ensure_db(self, dim: int):
+        if self.vector_db is None:
+            self.vector_db = FAISS(self.embedder, faiss.IndexFlatL2(dim), get_chunk_store(self.db_path), {})
+
+    def _apply_add(self, ids: List[str], vectors: np.ndarray):
+        self._ensure_db(vectors.shape[1])
+        vectors = np.array(vectors, dtype=np.float32)
+        if self.vector_db._normalize_L2:
+            faiss.normalize_L2(vectors)
+        self.vector_db.index.add(vectors)
+        start = len(self.vector_db.index_to_docstore_id)
+        self.vector_db.index_to_docstore_id.update({start + j: _id for j, _id in enumerate(ids)})
+
+    def _apply_delete(self, ids: List[str]):
+        present = set(self.vector_db.index_to_docstore_id.values()) if self.vector_db else set()
+        ids = [i for i in ids if i in present]
+        if ids:
+            self.vector_db.delete(ids)
+
+    def _replay(self, start_seq: int) -> int:
+        count = 0
+        known = set(self.vector_db.index_to_docstore_id.values()) if self.vector_db else set()
+        for header, vectors in self.wal.replay(start_seq):
+            if header["op"] == "add":
+                # 崩溃前可能已经合并过，重复的 id 跳过
+                keep = [j for j, _id in enumerate(header["ids"]) if _id not in known]
+                if keep:
+                    self._apply_add([header["ids"][j] for j in keep], vectors[keep])
+                    known.update(header["ids"][j] for j in keep)
+            elif header["op"] == "delete":
+                self._apply_delete(header["ids"])
+                known.difference_update(header["ids"])
+            count += 1
+        return count
+
+    # ---------- 写入 ----------
+    def add_documents(self, documents: List[Document], ids: Optional[List[str]] = None) -> List[str]:
+        if not documents:
+            return []
+        ids = ids or [str(uuid.uuid4()) for _ in documents]
+        vectors = np.array(self.embedder.embed_documents([d.page_content for d in documents]), dtype=np.float32)
+        with self.lock:
+            # 先落正文，再写日志，最后更新内存索引；日志写成功即视为持久化
+            get_chunk_store(self.db_path).add(
+                {_id: Document(id=_id, page_content=d.page_content, metadata=d.metadata)
+                 for _id, d in zip(ids, documents)}
+            )
+            self.wal.append("add", ids, vectors)
+            self._apply_add(ids, vectors)
+        return ids
+
+    def delete(self, ids: List[str]):
+        with self.lock:
+            self.wal.append("delete", list(ids))
+            self._apply_delete(list(ids))
+
+    # ---------- 合并 ----------
+    def compact(self):
+        """把日志合并进主索引: 在锁内切换日志段并复制索引，锁外写盘，不阻塞后续写入"""
+        with self._compact_lock:
+            with self.lock:
+                if self.vector_db is None:
+                    return
+                next_seq = self.wal.rotate()
+                snapshot = FAISS(
+                    self.embedder,
+                    faiss.clone_index(self.vector_db.index),
+                    self.vector_db.docstore,
+                    dict(self.vector_db.index_to_docstore_id),
+                    normalize_L2=self.vector_db._normalize_L2,
+                    distance_strategy=self.vector_db.distance_strategy,
+                )
+            if is_mmap_store(self.db_path) and read_store_meta(self.db_path).get("wal_segment", 1) >= next_seq:
+                # 磁盘上已经是更新的合并结果，不能用这份旧快照覆盖
+                return
+            save_vector_store(snapshot, self.db_path, extra_meta={"wal_segment": next_seq})
+            self.wal.drop_before(next_seq)
+            self.last_compact = time.monotonic()
+        print(f"✅ WAL 已合并进主索引, 向量数: {snapshot.index.ntotal}")
+
+    def _needs_compaction(self) -> bool:
+        size = self.wal.size()
+        if size == 0:
+            return False
+        return size >= self.compact_bytes or time.monotonic() - self.last_compact >= self.compact_interval
+
+    def _compact_loop(self, check_interval: float):
+        while not self._stop.wait(check_interval):
+            try:
+                if self._needs_compaction():
+                    self.compact()
+            except Exception as e:
+                print(f"⚠️ WAL 合并失败: {e}")
+
+    def close(self):
+        self._stop.set()
+        self._compactor.join()
+        if self._needs_compaction():
+            self.compact()
+        self.wal.close()
+
+
+_stores: Dict[str, WalVectorStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_wal_store(db_path: str, embedder, **kwargs) -> WalVectorStore:
+    """进程内每个目录只打开一次(Streamlit 每次重跑脚本都会调用，这里直接复用)"""
+    key = os.path.abspath(db_path)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = WalVectorStore(db_path, embedder, **kwargs)
+        return _stores[key]